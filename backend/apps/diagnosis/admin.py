@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import CropImage, DiagnosisResult
+from .models import CropImage, DiagnosisResult, RecommendationTemplate
 
 
 @admin.register(CropImage)
@@ -16,6 +16,14 @@ class DiagnosisResultAdmin(admin.ModelAdmin):
     list_display = ('crop_image', 'predicted_label', 'confidence', 'processed_at')
     list_filter = ('processed_at', 'model_version')
     search_fields = ('predicted_label', 'crop_image__id')
-    raw_id_fields = ('crop_image',)
+    raw_id_fields = ('crop_image', 'recommendation')
     readonly_fields = ('processed_at',)
 
+
+@admin.register(RecommendationTemplate)
+class RecommendationTemplateAdmin(admin.ModelAdmin):
+    list_display = ('label', 'model_version', 'version', 'created_at')
+    list_filter = ('model_version',)
+    search_fields = ('label',)
+    # Templates are immutable; new content is published as a new version
+    readonly_fields = ('label', 'model_version', 'version', 'content', 'content_hash', 'created_at')
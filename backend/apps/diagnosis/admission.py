@@ -0,0 +1,244 @@
+"""
+Admission control for diagnosis uploads.
+
+Uploads pass three checks before an image is accepted:
+
+* a per-user token bucket (DiagnosisThrottle) that absorbs bursts of field
+  uploads and refills at DIAGNOSIS_ADMISSION_RATE, scaled by the user's
+  role weight,
+* load shedding: when the estimated wait for the diagnosis backlog exceeds
+  DIAGNOSIS_MAX_QUEUE_SECONDS the upload is refused with 503 and a
+  Retry-After computed from the queue depth and measured throughput,
+* in sync mode, a global limit of DIAGNOSIS_MAX_CONCURRENCY requests
+  running inference at once, shared by all web processes through the cache.
+
+The buckets and slots live in the default cache, which is Redis (REDIS_URL)
+so that every web process shares them. Slots are taken with cache.add, an
+atomic SET NX, and a bucket is refilled and drawn from in one Lua script.
+With a process-local cache (LocMemCache, used by the tests) each process
+would enforce the limits on its own.
+
+Accepted images get a weighted fair queueing tag. The batch engine
+(diagnose_pending_batch, run_diagnosis_worker) claims pending images in tag
+order, so one user's burst is interleaved with everyone else's uploads
+instead of delaying them. Per-image diagnose_image tasks, which async mode
+enqueues, run in broker order and do not use the tags; deployments that
+need fairness in async mode should drain with the batch engine.
+"""
+import math
+import time
+import logging
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.db.models import Count, Max, Min
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.throttling import BaseThrottle
+from . import metrics
+from .models import CropImage, DiagnosisResult
+
+logger = logging.getLogger(__name__)
+
+THROUGHPUT_KEY = 'diagnosis:admission:throughput'
+SLOT_KEY = 'diagnosis:admission:slot:{}'
+SLOT_LEASE = 5 * 60  # seconds; frees slots held by a crashed process
+
+# Refill and take one token atomically; returns the seconds to wait (0 if taken).
+# ARGV: rate (tokens/s), capacity, key timeout. Uses the server clock.
+TAKE_TOKEN = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate, capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return tostring(wait)
+"""
+
+
+class Overloaded(APIException):
+    """503 with a Retry-After header (DRF sets it from wait)."""
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Diagnosis is at capacity. Please retry later.'
+    default_code = 'overloaded'
+
+    def __init__(self, wait, detail=None):
+        super().__init__(detail)
+        self.wait = wait
+
+
+def user_weight(user):
+    """Share of diagnosis capacity for a user, from DIAGNOSIS_ADMISSION_WEIGHTS by role."""
+    return settings.DIAGNOSIS_ADMISSION_WEIGHTS.get(getattr(user, 'role', None), 1)
+
+
+class TokenBucket:
+    """
+    Token bucket kept in the cache.
+
+    Args:
+        key: Cache key of the bucket
+        rate: Tokens added per second
+        capacity: Maximum tokens, i.e. the largest burst admitted at once
+    """
+    lock = threading.Lock()
+    script = None  # TAKE_TOKEN, registered on first use
+
+    def __init__(self, key, rate, capacity):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+
+    def take(self):
+        """
+        Take one token if available.
+
+        Returns:
+            0 if a token was taken, otherwise seconds until one is available
+        """
+        backend = caches['default']
+        if isinstance(backend, RedisCache):
+            return self.take_shared(backend)
+        # A process-local cache: serializing the read-modify-write is enough
+        with self.lock:
+            now = time.time()
+            tokens, updated = cache.get(self.key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                cache.set(self.key, (tokens - 1, now), self.timeout)
+                return 0
+            cache.set(self.key, (tokens, now), self.timeout)
+            return (1 - tokens) / self.rate
+
+    def take_shared(self, backend):
+        """take() as one Lua script on Redis, so concurrent processes never lose an update."""
+        key = backend.make_and_validate_key(self.key)
+        # Django's RedisCache has no public accessor for its redis-py client
+        client = backend._cache.get_client(key, write=True)
+        if TokenBucket.script is None:
+            TokenBucket.script = client.register_script(TAKE_TOKEN)
+        wait = TokenBucket.script(keys=[key], args=[self.rate, self.capacity, self.timeout], client=client)
+        return float(wait)
+
+    @property
+    def timeout(self):
+        # A full refill; after that the bucket would be full anyway
+        return math.ceil(self.capacity / self.rate) + 1
+
+
+class DiagnosisThrottle(BaseThrottle):
+    """Per-user token bucket for diagnosis uploads, weighted by role."""
+
+    def allow_request(self, request, view):
+        self.delay = 0
+        if getattr(view, 'action', None) != 'create' or not request.user.is_authenticated:
+            return True
+        weight = user_weight(request.user)
+        bucket = TokenBucket(
+            f'diagnosis:admission:bucket:{request.user.pk}',
+            rate=settings.DIAGNOSIS_ADMISSION_RATE * weight / 60,
+            capacity=settings.DIAGNOSIS_ADMISSION_BURST * weight
+        )
+        self.delay = bucket.take()
+        if self.delay:
+            metrics.increment('admission.throttled')
+        return not self.delay
+
+    def wait(self):
+        return math.ceil(self.delay)
+
+
+def throughput():
+    """
+    Diagnoses completed per second over the last DIAGNOSIS_THROUGHPUT_WINDOW seconds.
+
+    Cached for a few seconds so uploads do not each count results. Falls
+    back to one image per second per DIAGNOSIS_MAX_CONCURRENCY slot when
+    nothing finished recently (e.g. after an idle period).
+    """
+    measured = cache.get(THROUGHPUT_KEY)
+    if measured is None:
+        window = settings.DIAGNOSIS_THROUGHPUT_WINDOW
+        done = DiagnosisResult.objects.filter(
+            processed_at__gte=timezone.now() - timedelta(seconds=window)
+        ).count()
+        measured = done / window
+        cache.set(THROUGHPUT_KEY, measured, 5)
+    return measured or float(settings.DIAGNOSIS_MAX_CONCURRENCY)
+
+
+def backlog():
+    """Images waiting for or undergoing diagnosis."""
+    return CropImage.objects.filter(status__in=['pending', 'processing']).aggregate(total=Count('id'))['total']
+
+
+def check_capacity():
+    """
+    Shed the upload if the backlog would take too long to drain.
+
+    Raises:
+        Overloaded: With the estimated seconds until the backlog is back
+            under DIAGNOSIS_MAX_QUEUE_SECONDS
+    """
+    depth = backlog()
+    rate = throughput()
+    expected_wait = depth / rate
+    limit = settings.DIAGNOSIS_MAX_QUEUE_SECONDS
+    if expected_wait > limit:
+        metrics.increment('admission.shed')
+        logger.warning(f'Shedding diagnosis upload: {depth} queued at {rate:.2f}/s (~{expected_wait:.0f}s wait)')
+        raise Overloaded(math.ceil(expected_wait - limit))
+
+
+def acquire_slot():
+    """
+    Take one of DIAGNOSIS_MAX_CONCURRENCY inference slots shared across processes.
+
+    Returns:
+        the slot key, to pass to release_slot
+
+    Raises:
+        Overloaded: When every slot is taken
+    """
+    slots = settings.DIAGNOSIS_MAX_CONCURRENCY
+    for slot in range(slots):
+        key = SLOT_KEY.format(slot)
+        if cache.add(key, True, SLOT_LEASE):
+            return key
+    metrics.increment('admission.shed')
+    # Every slot frees up within about one image's inference time
+    raise Overloaded(math.ceil(slots / throughput()))
+
+
+def release_slot(key):
+    cache.delete(key)
+
+
+def fair_tag(user):
+    """
+    Weighted fair queueing tag for a new upload (start-time fair queueing).
+
+    The system's virtual time is the lowest pending tag, or the highest tag
+    seen when nothing is pending. A user's next image is tagged 1/weight
+    after the later of that and their own last pending image, so users with
+    a deep backlog queue behind newcomers.
+    """
+    pending = CropImage.objects.filter(status='pending')
+    virtual = pending.aggregate(tag=Min('fair_tag'))['tag']
+    if virtual is None:
+        virtual = CropImage.objects.aggregate(tag=Max('fair_tag'))['tag'] or 0.0
+    last = pending.filter(submitted_by=user).aggregate(tag=Max('fair_tag'))['tag'] or 0.0
+    return max(virtual, last) + 1.0 / user_weight(user)
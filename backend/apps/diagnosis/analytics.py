@@ -0,0 +1,190 @@
+"""
+Regional outbreak analytics for diagnosis results.
+
+Each diagnosis from a farm with coordinates is counted in OutbreakRollup,
+keyed by label, grid cell and day. The rollup is updated in the same
+transaction that writes the results, so heatmaps are read from a small
+table instead of aggregating diagnosis_results on every request.
+
+Grid cells are DIAGNOSIS_HEATMAP_CELL_DEGREES wide in latitude and
+longitude. Changing the cell size requires rebuilding the rollup with
+backfill_outbreak_rollup --reset.
+"""
+import math
+import time
+import logging
+from collections import defaultdict
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from apps.farms.models import Farm
+from .models import DiagnosisResult, OutbreakRollup
+
+logger = logging.getLogger(__name__)
+
+
+def cell_for(latitude, longitude, size=None):
+    """Grid cell (row, column) containing a coordinate."""
+    size = size or settings.DIAGNOSIS_HEATMAP_CELL_DEGREES
+    return math.floor(float(latitude) / size), math.floor(float(longitude) / size)
+
+
+def farm_cells(farm_ids):
+    """Map farm id to grid cell for farms that have coordinates."""
+    farms = Farm.objects.filter(
+        id__in=set(farm_ids), latitude__isnull=False, longitude__isnull=False
+    ).values_list('id', 'latitude', 'longitude')
+    return {farm_id: cell_for(latitude, longitude) for farm_id, latitude, longitude in farms}
+
+
+def increments_for(diagnoses, farm_id_of):
+    """
+    Group diagnoses into rollup increments.
+
+    Args:
+        farm_id_of: Function returning the farm id of a diagnosis
+
+    Returns:
+        dict of (label, cell_row, cell_column, day) -> [count, confidence sum]
+    """
+    cells = farm_cells(filter(None, (farm_id_of(d) for d in diagnoses)))
+    increments = defaultdict(lambda: [0, 0.0])
+    for diagnosis in diagnoses:
+        cell = cells.get(farm_id_of(diagnosis))
+        if cell is None:
+            continue
+        day = timezone.localdate(diagnosis.processed_at or timezone.now())
+        increment = increments[(diagnosis.predicted_label, cell[0], cell[1], day)]
+        increment[0] += 1
+        increment[1] += diagnosis.confidence
+    return increments
+
+
+def apply_increments(increments):
+    """Add increments to the rollup with conditional UPDATEs, creating missing rows."""
+    # A fixed order keeps concurrent writers from deadlocking on the same rows
+    for (label, row, column, day), (count, confidence) in sorted(increments.items()):
+        key = {'label': label, 'cell_row': row, 'cell_column': column, 'day': day}
+        changes = {'count': F('count') + count, 'confidence_sum': F('confidence_sum') + confidence}
+        if OutbreakRollup.objects.filter(**key).update(**changes):
+            continue
+        try:
+            with transaction.atomic():
+                OutbreakRollup.objects.create(count=count, confidence_sum=confidence, **key)
+        except IntegrityError:
+            # Another writer created the row first
+            OutbreakRollup.objects.filter(**key).update(**changes)
+
+
+def record(diagnoses):
+    """
+    Count newly written diagnoses in the rollup.
+
+    Call inside the transaction that inserts the diagnoses. The instances
+    are flagged as counted, so set this before they are saved.
+    """
+    for diagnosis in diagnoses:
+        diagnosis.in_rollup = True
+    apply_increments(increments_for(diagnoses, lambda d: d.crop_image.farm_id))
+
+
+def backfill(chunk_size=1000, pause=0.0):
+    """
+    Count diagnoses written before the rollup existed.
+
+    Works through uncounted results in primary key order, one short
+    transaction per chunk, and flags each chunk as counted in the same
+    transaction. Only the rows of the current chunk are written, so the
+    source tables stay available and the job can be stopped and resumed.
+
+    Returns:
+        number of results counted
+    """
+    counted = 0
+    last_id = 0
+    while True:
+        chunk = list(
+            DiagnosisResult.objects.filter(in_rollup=False, id__gt=last_id)
+            .order_by('id')
+            .values('id', 'predicted_label', 'confidence', 'processed_at', 'crop_image__farm_id')[:chunk_size]
+        )
+        if not chunk:
+            return counted
+        last_id = chunk[-1]['id']
+
+        with transaction.atomic():
+            claimed = set(
+                DiagnosisResult.objects.select_for_update()
+                .filter(id__in=[row['id'] for row in chunk], in_rollup=False)
+                .values_list('id', flat=True)
+            )
+            rows = [DiagnosisResult(
+                id=row['id'],
+                predicted_label=row['predicted_label'],
+                confidence=row['confidence'],
+                processed_at=row['processed_at']
+            ) for row in chunk if row['id'] in claimed]
+            farm_ids = {row['id']: row['crop_image__farm_id'] for row in chunk}
+            apply_increments(increments_for(rows, lambda d: farm_ids[d.id]))
+            DiagnosisResult.objects.filter(id__in=claimed).update(in_rollup=True)
+
+        counted += len(claimed)
+        logger.info(f'Outbreak rollup backfill: {counted} results counted (up to id {last_id})')
+        if pause:
+            time.sleep(pause)
+
+
+def reset(chunk_size=1000):
+    """
+    Empty the rollup and mark existing results as uncounted, in chunks.
+
+    Results written after the reset starts are counted by the live path
+    and left alone.
+    """
+    with transaction.atomic():
+        OutbreakRollup.objects.all().delete()
+        last_id = DiagnosisResult.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    while True:
+        ids = list(DiagnosisResult.objects.filter(
+            in_rollup=True, id__lte=last_id
+        ).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return
+        DiagnosisResult.objects.filter(id__in=ids).update(in_rollup=False)
+
+
+def heatmap(start, end, label=None, bounds=None):
+    """
+    Heatmap tiles for diagnoses between two dates (inclusive).
+
+    Args:
+        label: Only count this diagnosis label
+        bounds: Optional (south, west, north, east) in degrees
+
+    Returns:
+        list of tile dicts with label, cell centre, count and mean confidence
+    """
+    size = settings.DIAGNOSIS_HEATMAP_CELL_DEGREES
+    rollup = OutbreakRollup.objects.filter(day__gte=start, day__lte=end)
+    if label:
+        rollup = rollup.filter(label=label)
+    if bounds:
+        south, west = cell_for(bounds[0], bounds[1])
+        north, east = cell_for(bounds[2], bounds[3])
+        rollup = rollup.filter(
+            cell_row__gte=south, cell_row__lte=north, cell_column__gte=west, cell_column__lte=east
+        )
+
+    tiles = (
+        rollup.values('label', 'cell_row', 'cell_column')
+        .annotate(total=Sum('count'), confidence=Sum('confidence_sum'))
+        .order_by('-total', 'label')
+    )
+    return [{
+        'label': tile['label'],
+        'latitude': round((tile['cell_row'] + 0.5) * size, 6),
+        'longitude': round((tile['cell_column'] + 0.5) * size, 6),
+        'count': tile['total'],
+        'mean_confidence': round(tile['confidence'] / tile['total'], 4),
+    } for tile in tiles]
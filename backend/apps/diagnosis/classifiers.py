@@ -0,0 +1,284 @@
+"""
+Crop diagnosis classifier backends and the per-process model registry.
+
+Each backend is registered under the model version it stamps onto
+DiagnosisResult.model_version. The registry loads a backend the first time it
+is requested in a process and keeps it resident, so web workers and Celery
+workers pay the load cost once instead of on every image.
+"""
+import time
+import logging
+import threading
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BaseClassifier:
+    """
+    Interface for diagnosis classifier backends.
+
+    Subclasses implement load() to read weights into memory and
+    predict(batch) to classify a stacked array of preprocessed images.
+    """
+    version = None
+
+    def load(self):
+        """Load model weights. Called once per process by the registry."""
+
+    def predict(self, batch):
+        """
+        Classify a batch of preprocessed images.
+
+        Args:
+            batch: float32 ndarray of shape (n, height, width, 3) in [0, 1]
+
+        Returns:
+            list of n dicts with 'label' and 'confidence' keys
+        """
+        raise NotImplementedError
+
+
+class HistogramClassifier(BaseClassifier):
+    """
+    Deterministic CPU reference classifier based on colour histograms.
+
+    Each label has a prototype RGB histogram built from a reference leaf
+    colour. Images are scored by histogram intersection against every
+    prototype and the scores are turned into confidences with a softmax.
+    It has no external dependencies beyond NumPy, which makes it suitable
+    for offline benchmarking of the inference pipeline.
+    """
+    version = 'v1.0-histogram'
+
+    bins = 8
+    temperature = 0.05
+
+    # Reference leaf colours (RGB in [0, 1]) for each label
+    reference_colours = {
+        'Healthy Crop': (0.25, 0.55, 0.20),
+        'Nitrogen Deficiency': (0.75, 0.75, 0.30),
+        'Aphids Infestation': (0.50, 0.60, 0.35),
+        'Leaf Blight': (0.45, 0.30, 0.15),
+        'Early Blight (Alternaria solani)': (0.30, 0.25, 0.15),
+    }
+
+    def __init__(self):
+        self.labels = list(self.reference_colours)
+        self.prototypes = None
+
+    def load(self):
+        rng = np.random.default_rng(0)
+        samples = np.stack([
+            np.clip(rng.normal(colour, 0.08, size=(4096, 3)), 0.0, 1.0)
+            for colour in self.reference_colours.values()
+        ])
+        self.prototypes = self.histograms(samples)
+
+    def histograms(self, pixels):
+        """
+        Per-channel normalised histograms.
+
+        Args:
+            pixels: ndarray of shape (n, ..., 3) in [0, 1]
+
+        Returns:
+            ndarray of shape (n, 3 * bins); each channel block sums to 1
+        """
+        n = pixels.shape[0]
+        flat = pixels.reshape(n, -1, 3)
+        idx = np.minimum((flat * self.bins).astype(np.int64), self.bins - 1)
+        # Offset bin indices per image and channel so one bincount covers the batch
+        offsets = (np.arange(n)[:, None, None] * 3 + np.arange(3)[None, None, :]) * self.bins
+        counts = np.bincount((idx + offsets).ravel(), minlength=n * 3 * self.bins)
+        return counts.reshape(n, 3 * self.bins) / flat.shape[1]
+
+    def predict(self, batch):
+        if len(batch) == 0:
+            return []
+
+        features = self.histograms(batch)
+        # Histogram intersection, averaged over the three channels
+        similarity = np.minimum(features[:, None, :], self.prototypes[None, :, :]).sum(axis=2) / 3
+        logits = similarity / self.temperature
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+        best = probabilities.argmax(axis=1)
+        return [
+            {'label': self.labels[i], 'confidence': round(float(probabilities[row, i]), 4)}
+            for row, i in enumerate(best)
+        ]
+
+
+class MeanColourClassifier(BaseClassifier):
+    """
+    Tiny first-stage classifier: distance from the mean leaf colour to each
+    label's reference colour.
+
+    It looks at a sparse grid of pixels only, so it costs a small fraction of
+    the histogram model. Its softmax temperature is fitted at load time on a
+    seeded synthetic calibration set (temperature scaling), so confidences
+    can be compared against a fixed threshold.
+    """
+    version = 'v1.0-mean-colour'
+
+    stride = 8
+    calibration_samples = 200
+    calibration_noise = 0.08
+    temperatures = np.geomspace(0.001, 1.0, 60)
+
+    def __init__(self):
+        self.labels = list(HistogramClassifier.reference_colours)
+        self.colours = np.array(list(HistogramClassifier.reference_colours.values()), dtype=np.float32)
+        self.temperature = None
+
+    def load(self):
+        rng = np.random.default_rng(1)
+        n = self.calibration_samples
+        targets = np.repeat(np.arange(len(self.labels)), n)
+        means = np.clip(self.colours[targets] + rng.normal(0.0, self.calibration_noise, (len(targets), 3)), 0, 1)
+        distances = self.distances(means)
+
+        # Pick the temperature with the lowest negative log-likelihood
+        best_nll = None
+        for temperature in self.temperatures:
+            log_probabilities = self.log_softmax(-distances / temperature)
+            nll = -log_probabilities[np.arange(len(targets)), targets].mean()
+            if best_nll is None or nll < best_nll:
+                best_nll, self.temperature = nll, float(temperature)
+
+    def distances(self, means):
+        return ((means[:, None, :] - self.colours[None, :, :]) ** 2).sum(axis=2)
+
+    @staticmethod
+    def log_softmax(logits):
+        logits = logits - logits.max(axis=1, keepdims=True)
+        return logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+
+    def predict(self, batch):
+        if len(batch) == 0:
+            return []
+
+        means = batch[:, ::self.stride, ::self.stride, :].reshape(len(batch), -1, 3).mean(axis=1)
+        probabilities = np.exp(self.log_softmax(-self.distances(means) / self.temperature))
+        best = probabilities.argmax(axis=1)
+        return [
+            {'label': self.labels[i], 'confidence': round(float(probabilities[row, i]), 4)}
+            for row, i in enumerate(best)
+        ]
+
+
+class CascadeClassifier(BaseClassifier):
+    """
+    Two-stage early-exit cascade.
+
+    The fast stage classifies every image; images whose calibrated
+    confidence reaches DIAGNOSIS_CASCADE_THRESHOLD are answered there and
+    only the rest go to the full model. Each prediction's model_version
+    names the stage that answered, e.g. 'v1.0-cascade/v1.0-mean-colour'.
+    """
+    version = 'v1.0-cascade'
+    fast_version = MeanColourClassifier.version
+    full_version = HistogramClassifier.version
+
+    def __init__(self):
+        self.fast = None
+        self.full = None
+
+    def load(self):
+        self.fast = get_classifier(self.fast_version)
+        self.full = get_classifier(self.full_version)
+
+    def predict(self, batch):
+        if len(batch) == 0:
+            return []
+
+        threshold = settings.DIAGNOSIS_CASCADE_THRESHOLD
+        predictions = self.fast.predict(batch)
+        uncertain = [row for row, p in enumerate(predictions) if p['confidence'] < threshold]
+        for prediction in predictions:
+            prediction['model_version'] = f'{self.version}/{self.fast_version}'
+
+        if uncertain:
+            for row, prediction in zip(uncertain, self.full.predict(batch[uncertain])):
+                prediction['model_version'] = f'{self.version}/{self.full_version}'
+                predictions[row] = prediction
+
+        metrics.increment('classifier.cascade.early_exits', len(predictions) - len(uncertain))
+        metrics.increment('classifier.cascade.full_model', len(uncertain))
+        return predictions
+
+
+# Reentrant: a cascade loads its stages through get_classifier while loading
+_registry_lock = threading.RLock()
+_loaded = {}
+
+
+def get_classifier(version=None):
+    """
+    Return the resident classifier for a model version, loading it if needed.
+
+    Args:
+        version: Model version key from DIAGNOSIS_CLASSIFIERS; defaults to
+            DIAGNOSIS_MODEL_VERSION
+
+    Raises:
+        KeyError if no backend is registered for the version
+    """
+    version = version or settings.DIAGNOSIS_MODEL_VERSION
+    classifier = _loaded.get(version)
+    if classifier is not None:
+        return classifier
+
+    with _registry_lock:
+        classifier = _loaded.get(version)
+        if classifier is None:
+            backend_path = settings.DIAGNOSIS_CLASSIFIERS[version]
+            started = time.perf_counter()
+            classifier = import_string(backend_path)()
+            classifier.load()
+            elapsed = time.perf_counter() - started
+
+            metrics.observe(f'classifier.cold_start_seconds.{version}', elapsed)
+            logger.info(f'Loaded diagnosis classifier {version} in {elapsed:.3f}s')
+            _loaded[version] = classifier
+    return classifier
+
+
+def predict(batch, version=None):
+    """
+    Classify a batch with the resident classifier and record its latency.
+
+    Returns:
+        list of dicts with 'label', 'confidence' and 'model_version' keys;
+        backends such as the cascade may set a more specific model_version
+    """
+    version = version or settings.DIAGNOSIS_MODEL_VERSION
+    classifier = get_classifier(version)
+
+    started = time.perf_counter()
+    predictions = classifier.predict(batch)
+    elapsed = time.perf_counter() - started
+
+    metrics.observe(f'classifier.inference_seconds.{version}', elapsed)
+    metrics.increment(f'classifier.images.{version}', len(predictions))
+    for prediction in predictions:
+        prediction.setdefault('model_version', version)
+    return predictions
+
+
+def warm_up():
+    """Load every registered classifier into this process."""
+    for version in settings.DIAGNOSIS_CLASSIFIERS:
+        get_classifier(version)
+
+
+def unload_all():
+    """Drop all resident classifiers (used by tests and benchmarks)."""
+    with _registry_lock:
+        _loaded.clear()
@@ -0,0 +1,181 @@
+"""
+Perceptual-hash deduplication for repeated crop image uploads.
+
+Every upload gets a 64-bit difference hash (dHash) stored on
+CropImage.image_hash. Before running inference, images whose hash is within
+DIAGNOSIS_DEDUP_MAX_DISTANCE bits of a recently diagnosed image (same model
+version) reuse that DiagnosisResult instead of calling the classifier.
+
+Recent diagnoses are tracked in a per-process index that is bounded in size
+and age and is incrementally refreshed from the database, so results written
+by other workers become visible without rescanning the table.
+"""
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from PIL import Image
+from . import metrics
+from .models import DiagnosisResult
+
+HASH_SIZE = 8
+
+
+def dhash(image_file, hash_size=HASH_SIZE):
+    """
+    Compute the difference hash of an image file.
+
+    Returns:
+        16-character hex string
+    """
+    img = Image.open(image_file)
+    # Let the JPEG decoder downscale while decoding instead of decoding full size
+    img.draft('L', (hash_size * 8, hash_size * 8))
+    return dhash_image(img, hash_size=hash_size)
+
+
+def dhash_image(img, hash_size=HASH_SIZE):
+    """Compute the difference hash of an already opened PIL image."""
+    img = img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(img.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return f'{value:016x}'
+
+
+def hamming_distance(a, b):
+    """Number of differing bits between two hex hashes."""
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+class PerceptualHashIndex:
+    """
+    Bounded, time-windowed index of recently diagnosed image hashes.
+
+    Entries older than window or beyond max_entries (oldest first) are
+    evicted. refresh() pulls DiagnosisResults created since the last refresh.
+    """
+
+    def __init__(self, max_entries=None, window=None):
+        self.max_entries = max_entries or settings.DIAGNOSIS_DEDUP_MAX_ENTRIES
+        self.window = window or timedelta(hours=settings.DIAGNOSIS_DEDUP_WINDOW_HOURS)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # diagnosis id -> (image hash as int, model version, processed_at)
+        self.entries = OrderedDict()
+        self.last_result_id = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, diagnosis_id, image_hash, model_version, processed_at):
+        self.entries[diagnosis_id] = (int(image_hash, 16), model_version, processed_at)
+        self.entries.move_to_end(diagnosis_id)
+        self.last_result_id = max(self.last_result_id, diagnosis_id)
+
+    def evict(self):
+        cutoff = timezone.now() - self.window
+        while self.entries:
+            diagnosis_id, (_, _, processed_at) = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_entries and processed_at >= cutoff:
+                break
+            self.entries.popitem(last=False)
+            metrics.increment('dedup.evictions')
+
+    def refresh(self):
+        """Add diagnoses written since the last refresh (by any process)."""
+        cutoff = timezone.now() - self.window
+        rows = (
+            DiagnosisResult.objects.filter(id__gt=self.last_result_id, processed_at__gte=cutoff)
+            .exclude(crop_image__image_hash='')
+            .order_by('id')
+            .values_list('id', 'crop_image__image_hash', 'model_version', 'processed_at')
+        )
+        for diagnosis_id, image_hash, model_version, processed_at in rows.iterator():
+            self.add(diagnosis_id, image_hash, model_version, processed_at)
+        self.evict()
+
+    def lookup(self, image_hash, model_version, max_distance):
+        """
+        Find the closest recent diagnosis for a hash.
+
+        Returns:
+            DiagnosisResult id, or None if nothing is within max_distance
+        """
+        with self.lock:
+            self.refresh()
+            target = int(image_hash, 16)
+            best_id, best_distance = None, max_distance + 1
+            # Newest first so ties resolve to the most recent diagnosis
+            for diagnosis_id, (value, version, _) in reversed(self.entries.items()):
+                # Cascade results carry the answering stage, e.g. 'v1.0-cascade/v1.0-histogram'
+                if version != model_version and not version.startswith(f'{model_version}/'):
+                    continue
+                distance = bin(target ^ value).count('1')
+                if distance < best_distance:
+                    best_id, best_distance = diagnosis_id, distance
+                    if distance == 0:
+                        break
+            return best_id
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Return the per-process hash index."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = PerceptualHashIndex()
+        return _index
+
+
+def reuse_diagnoses(crop_images, model_version):
+    """
+    Reuse recent diagnoses for near-duplicate images.
+
+    Returns:
+        tuple (reused, remaining) where reused are unsaved DiagnosisResult
+        copies and remaining are the CropImages that still need inference
+    """
+    if not settings.DIAGNOSIS_DEDUP_ENABLED:
+        return [], list(crop_images)
+
+    index = get_index()
+    matches = {}
+    for crop_image in crop_images:
+        if crop_image.image_hash:
+            source_id = index.lookup(crop_image.image_hash, model_version, settings.DIAGNOSIS_DEDUP_MAX_DISTANCE)
+            if source_id is not None:
+                matches[crop_image.id] = source_id
+
+    sources = DiagnosisResult.objects.in_bulk(set(matches.values())) if matches else {}
+
+    reused = []
+    remaining = []
+    for crop_image in crop_images:
+        source = sources.get(matches.get(crop_image.id))
+        if source is None:
+            remaining.append(crop_image)
+            continue
+        reused.append(DiagnosisResult(
+            crop_image=crop_image,
+            predicted_label=source.predicted_label,
+            confidence=source.confidence,
+            recommendation_id=source.recommendation_id,
+            model_version=source.model_version
+        ))
+
+    metrics.increment('dedup.hits', len(reused))
+    metrics.increment('dedup.misses', len(remaining))
+    return reused, remaining
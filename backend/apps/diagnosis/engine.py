@@ -0,0 +1,203 @@
+"""
+Batched inference engine for crop image diagnosis.
+
+Instead of running one Celery task per upload, the engine drains pending
+CropImages in micro-batches, runs the classifier once per batch on a stacked
+array of preprocessed images and writes all results with bulk queries.
+"""
+import time
+import logging
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from . import analytics, classifiers, dedup
+from .models import CropImage, DiagnosisResult
+from .preprocessing import preprocess_batch
+from .recommendations import get_template
+
+logger = logging.getLogger(__name__)
+
+
+def build_diagnoses(crop_images, version=None):
+    """
+    Preprocess and classify CropImages in a single classifier call.
+
+    Near-duplicates of recently diagnosed images reuse the earlier result
+    and skip preprocessing and inference entirely.
+
+    Returns:
+        tuple (diagnoses, loaded, failed) where diagnoses are unsaved
+        DiagnosisResult instances for the loaded images and failed are
+        the CropImages that could not be preprocessed
+    """
+    version = version or settings.DIAGNOSIS_MODEL_VERSION
+    reused, remaining = dedup.reuse_diagnoses(crop_images, version)
+
+    batch, loaded, failed = preprocess_batch(remaining)
+    predictions = classifiers.predict(batch, version=version) if loaded else []
+
+    diagnoses = reused + [
+        DiagnosisResult(
+            crop_image=crop_image,
+            predicted_label=prediction['label'],
+            confidence=prediction['confidence'],
+            recommendation=get_template(prediction['label'], prediction['model_version']),
+            model_version=prediction['model_version']
+        )
+        for crop_image, prediction in zip(loaded, predictions)
+    ]
+    return diagnoses, [d.crop_image for d in reused] + loaded, failed
+
+
+def claim_image(crop_image_id):
+    """
+    Atomically claim a single image for diagnosis.
+
+    Only one caller can move a row from pending (or failed, for retries) to
+    processing, so duplicate or retried tasks never diagnose the same image
+    concurrently.
+
+    Returns:
+        True if this caller now owns the image
+    """
+    return CropImage.objects.filter(
+        id=crop_image_id, status__in=['pending', 'failed']
+    ).update(status='processing', claimed_at=timezone.now()) == 1
+
+
+def claim_pending(limit):
+    """
+    Atomically claim up to limit pending images in fair queueing order.
+
+    Images are taken by their weighted fair queueing tag (see
+    admission.fair_tag), oldest first among equal tags.
+
+    Uses SELECT ... FOR UPDATE SKIP LOCKED where the database supports it so
+    concurrent workers pull disjoint batches without waiting on each other.
+    Elsewhere each row is claimed with a conditional update.
+
+    Returns:
+        list of CropImages now marked as processing by this caller
+    """
+    pending = CropImage.objects.filter(status='pending').order_by('fair_tag', 'timestamp', 'id')
+    now = timezone.now()
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(pending.select_for_update(skip_locked=True).values_list('id', flat=True)[:limit])
+            CropImage.objects.filter(id__in=ids).update(status='processing', claimed_at=now)
+    else:
+        ids = [
+            crop_image_id
+            for crop_image_id in pending.values_list('id', flat=True)[:limit]
+            if CropImage.objects.filter(id=crop_image_id, status='pending')
+            .update(status='processing', claimed_at=now) == 1
+        ]
+
+    return list(CropImage.objects.filter(id__in=ids)) if ids else []
+
+
+def save_diagnoses(diagnoses, loaded, failed):
+    """
+    Write a batch of results and update image statuses in one transaction.
+
+    Results for images that already have one are skipped, so re-running a
+    batch after a crash or a reaper requeue is harmless. New results are
+    counted in the outbreak rollup in the same transaction.
+    """
+    with transaction.atomic():
+        existing = set(DiagnosisResult.objects.filter(
+            crop_image_id__in=[d.crop_image_id for d in diagnoses]
+        ).values_list('crop_image_id', flat=True))
+        new = [d for d in diagnoses if d.crop_image_id not in existing]
+        analytics.record(new)
+        DiagnosisResult.objects.bulk_create(new, ignore_conflicts=True)
+        CropImage.objects.filter(id__in=[c.id for c in loaded]).update(status='processed')
+        if failed:
+            CropImage.objects.filter(id__in=[c.id for c in failed]).update(status='failed')
+
+
+class BatchDiagnosisEngine:
+    """
+    Drain pending CropImages in micro-batches.
+
+    Args:
+        batch_size: Maximum number of images per inference call
+        max_wait: Maximum seconds to wait for a batch to fill up before
+            processing whatever is pending
+        poll_interval: Seconds between checks for new pending images
+    """
+
+    def __init__(self, batch_size=None, max_wait=None, poll_interval=0.2):
+        self.batch_size = batch_size or settings.DIAGNOSIS_BATCH_SIZE
+        self.max_wait = settings.DIAGNOSIS_BATCH_MAX_WAIT if max_wait is None else max_wait
+        self.poll_interval = poll_interval
+
+    def pending_ids(self):
+        """Ids of the next pending images in fair queueing order, up to one batch."""
+        return list(
+            CropImage.objects.filter(status='pending')
+            .order_by('fair_tag', 'timestamp', 'id')
+            .values_list('id', flat=True)[:self.batch_size]
+        )
+
+    def collect_batch(self):
+        """
+        Wait until a full batch is pending or max_wait has elapsed.
+
+        Returns:
+            list of CropImages claimed by this engine
+        """
+        deadline = time.monotonic() + self.max_wait
+        ids = self.pending_ids()
+        while len(ids) < self.batch_size and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            ids = self.pending_ids()
+
+        if not ids:
+            return []
+        return claim_pending(self.batch_size)
+
+    def process_batch(self, crop_images):
+        """
+        Run inference on a batch and persist the results.
+
+        Returns:
+            dict with batch statistics, including throughput in images/sec
+        """
+        started = time.perf_counter()
+
+        diagnoses, loaded, failed = build_diagnoses(crop_images)
+        save_diagnoses(diagnoses, loaded, failed)
+
+        elapsed = time.perf_counter() - started
+        stats = {
+            'batch_size': len(crop_images),
+            'processed': len(loaded),
+            'failed': len(failed),
+            'elapsed_seconds': round(elapsed, 4),
+            'images_per_second': round(len(crop_images) / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+        logger.info(
+            f"Diagnosis batch: {stats['processed']} processed, {stats['failed']} failed "
+            f"in {stats['elapsed_seconds']}s ({stats['images_per_second']} images/sec)"
+        )
+        return stats
+
+    def drain(self, max_batches=None):
+        """
+        Process batches until no pending images remain.
+
+        Args:
+            max_batches: Optional upper bound on the number of batches
+
+        Returns:
+            list of per-batch statistics dicts
+        """
+        all_stats = []
+        while max_batches is None or len(all_stats) < max_batches:
+            crop_images = self.collect_batch()
+            if not crop_images:
+                break
+            all_stats.append(self.process_batch(crop_images))
+        return all_stats
@@ -0,0 +1,300 @@
+"""
+Storage lifecycle for crop images.
+
+Once a diagnosis is older than DIAGNOSIS_ARCHIVE_AFTER_DAYS, the original
+upload is re-encoded to WebP (when that makes it smaller) and packed into
+an archive bundle (see apps.diagnosis.storage). The ingest-time tensor is
+dropped, since it is only needed before diagnosis, and the thumbnail stays
+in hot storage for listings.
+
+The archiver is safe to stop at any point: images are marked archived in
+the same transaction that indexes their bundle, and originals are only
+deleted after that commits, so a re-run simply picks up where the last one
+stopped.
+"""
+import io
+import time
+import uuid
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image
+from .models import ArchiveBundle, ArchivedFile, CropImage
+from .storage import ARCHIVE_PREFIX, BUNDLE_DIR, BundleWriter
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'diagnosis:archive-images'
+LOCK_TIMEOUT = 6 * 60 * 60
+
+
+def reencode(data, quality):
+    """
+    Re-encode image bytes as WebP.
+
+    Returns:
+        WebP bytes, or None when the result would not be smaller
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+    output = io.BytesIO()
+    img.save(output, format='WEBP', quality=quality, method=4)
+    encoded = output.getvalue()
+    return encoded if len(encoded) < len(data) else None
+
+
+def archived_name(name, webp):
+    """
+    Archive name of an original; leaf.jpg becomes archive/leaf.jpg.webp.
+
+    The original extension is kept so that leaf.jpg and leaf.png (or an
+    uploaded leaf.webp) do not map to the same archived file.
+    """
+    if webp:
+        return f'{ARCHIVE_PREFIX}{name}.webp'
+    return f'{ARCHIVE_PREFIX}{name}'
+
+
+class RateLimiter:
+    """Sleeps as needed to keep average I/O under a number of bytes per second."""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.started = time.monotonic()
+        self.bytes = 0
+        self.slept = 0.0
+
+    def consume(self, count):
+        if not self.bytes_per_second:
+            return
+        self.bytes += count
+        ahead = self.bytes / self.bytes_per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+            self.slept += ahead
+
+
+class ImageArchiver:
+    """
+    Moves old crop image originals into archive bundles.
+
+    Args:
+        older_than_days: Archive images whose diagnosis is older than this
+        quality: WebP quality for re-encoded originals
+        bundle_bytes: Target bundle size
+        max_bytes_per_second: I/O budget (bytes read plus written); 0 disables
+        batch_size: Images fetched from the database at a time
+    """
+
+    def __init__(self, older_than_days=None, quality=None, bundle_bytes=None,
+                 max_bytes_per_second=None, batch_size=100):
+        self.older_than_days = (settings.DIAGNOSIS_ARCHIVE_AFTER_DAYS
+                                if older_than_days is None else older_than_days)
+        self.quality = quality or settings.DIAGNOSIS_ARCHIVE_WEBP_QUALITY
+        self.bundle_bytes = bundle_bytes or settings.DIAGNOSIS_ARCHIVE_BUNDLE_MB * 1024 * 1024
+        if max_bytes_per_second is None:
+            max_bytes_per_second = settings.DIAGNOSIS_ARCHIVE_MAX_MB_PER_SECOND * 1024 * 1024
+        self.limiter = RateLimiter(max_bytes_per_second)
+        self.batch_size = batch_size
+        self.bundle = None
+        self.pending = []
+        self.stats = {
+            'images': 0,
+            'reencoded': 0,
+            'skipped': 0,
+            'bundles': 0,
+            'bytes_before': 0,
+            'bytes_archived': 0,
+            'bytes_reclaimed': 0,
+            'read_seconds': 0.0,
+            'encode_seconds': 0.0,
+            'write_seconds': 0.0,
+            'delete_seconds': 0.0,
+        }
+
+    def candidates(self, after_id):
+        cutoff = timezone.now() - timedelta(days=self.older_than_days)
+        return list(
+            CropImage.objects.filter(
+                id__gt=after_id,
+                status='processed',
+                archived_at__isnull=True,
+                diagnosis_result__processed_at__lt=cutoff
+            ).order_by('id')[:self.batch_size]
+        )
+
+    def timed(self, stat, function, *args):
+        started = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.stats[stat] += time.perf_counter() - started
+
+    def read(self, name):
+        with default_storage.open(name, 'rb') as source:
+            return source.read()
+
+    def add(self, crop_image):
+        """Read, re-encode and append one original to the current bundle."""
+        try:
+            original = self.timed('read_seconds', self.read, crop_image.image.name)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Cannot archive CropImage {crop_image.id}: {str(e)}')
+            self.stats['skipped'] += 1
+            return
+        self.limiter.consume(len(original))
+
+        try:
+            encoded = self.timed('encode_seconds', reencode, original, self.quality)
+        except Exception as e:
+            logger.warning(f'Cannot re-encode CropImage {crop_image.id}, archiving as is: {str(e)}')
+            encoded = None
+        data = encoded or original
+
+        if self.bundle is None:
+            stamp = timezone.now().strftime('%Y%m%d%H%M%S')
+            self.bundle = BundleWriter(f'{BUNDLE_DIR}bundle-{stamp}.pack')
+        entry = self.bundle.append(archived_name(crop_image.image.name, encoded is not None), data)
+
+        tensor_size = 0
+        if crop_image.tensor:
+            try:
+                tensor_size = crop_image.tensor.size
+            except OSError:
+                pass
+        self.pending.append((crop_image, entry, len(original) + tensor_size))
+        self.stats['reencoded'] += encoded is not None
+
+        if self.bundle.size >= self.bundle_bytes:
+            self.flush()
+
+    def without_collisions(self, pending):
+        """
+        Pending entries whose archive name is not taken yet.
+
+        An entry that collides with an archived file, or with an earlier
+        entry of the same bundle, is left out and its image stays in hot
+        storage; its bytes in the bundle are simply never referenced.
+        """
+        taken = set(ArchivedFile.objects.filter(
+            name__in=[entry['name'] for _, entry, _ in pending]
+        ).values_list('name', flat=True))
+        kept = []
+        for crop_image, entry, original_size in pending:
+            if entry['name'] in taken:
+                logger.warning(f'Cannot archive CropImage {crop_image.id}: {entry["name"]} is already archived')
+                self.stats['skipped'] += 1
+                continue
+            taken.add(entry['name'])
+            kept.append((crop_image, entry, original_size))
+        return kept
+
+    def flush(self):
+        """Store the current bundle, index it and delete the hot copies."""
+        if self.bundle is None:
+            return
+        bundle, pending = self.bundle, self.pending
+        self.bundle, self.pending = None, []
+
+        size = bundle.size
+        stored = self.timed('write_seconds', bundle.write)
+        try:
+            with transaction.atomic():
+                pending = self.without_collisions(pending)
+                bundle_row = ArchiveBundle.objects.create(name=stored, size=size, file_count=len(pending))
+                ArchivedFile.objects.bulk_create([
+                    ArchivedFile(
+                        name=entry['name'],
+                        bundle=bundle_row,
+                        offset=entry['offset'],
+                        length=entry['length'],
+                        sha256=entry['sha256'],
+                        original_size=original_size
+                    )
+                    for _, entry, original_size in pending
+                ])
+                now = timezone.now()
+                archived = [
+                    (crop_image, original_size) for crop_image, entry, original_size in pending
+                    if CropImage.objects.filter(id=crop_image.id, archived_at__isnull=True).update(
+                        image=entry['name'], tensor='', archived_at=now
+                    )
+                ]
+        except Exception:
+            # Nothing references the bundle yet
+            default_storage.delete(stored)
+            default_storage.delete(f'{stored}.index.json')
+            raise
+        self.limiter.consume(size)
+
+        started = time.perf_counter()
+        for crop_image, _ in archived:
+            default_storage.delete(crop_image.image.name)
+            if crop_image.tensor:
+                default_storage.delete(crop_image.tensor.name)
+        self.stats['delete_seconds'] += time.perf_counter() - started
+
+        before = sum(original_size for _, original_size in archived)
+        self.stats['images'] += len(archived)
+        self.stats['bundles'] += 1
+        self.stats['bytes_before'] += before
+        self.stats['bytes_archived'] += size
+        self.stats['bytes_reclaimed'] += before - size
+        logger.info(f'Archived {len(archived)} crop images into {stored} ({before - size} bytes reclaimed)')
+
+    def run(self, limit=None, max_seconds=None):
+        """
+        Archive eligible images until none are left or a limit is reached.
+
+        Args:
+            limit: Stop after this many images
+            max_seconds: Stop after roughly this long
+
+        Returns:
+            dict of counts, bytes and time spent per I/O stage
+        """
+        started = time.perf_counter()
+        last_id = 0
+        seen = 0
+        done = False
+        while not done:
+            batch = self.candidates(last_id)
+            if not batch:
+                break
+            for crop_image in batch:
+                last_id = crop_image.id
+                self.add(crop_image)
+                seen += 1
+                if (limit and seen >= limit) or (max_seconds and time.perf_counter() - started >= max_seconds):
+                    done = True
+                    break
+        self.flush()
+
+        report = dict(self.stats)
+        report['throttled_seconds'] = self.limiter.slept
+        report['elapsed_seconds'] = time.perf_counter() - started
+        return {key: round(value, 3) if isinstance(value, float) else value for key, value in report.items()}
+
+
+def archive_old_images(limit=None, max_seconds=None, **options):
+    """
+    Run the archiver unless another run holds the lock.
+
+    Returns:
+        the run report, or None if another run is in progress
+    """
+    owner = uuid.uuid4().hex
+    if not cache.add(LOCK_KEY, owner, LOCK_TIMEOUT):
+        logger.info('Crop image archiving already running')
+        return None
+    try:
+        return ImageArchiver(**options).run(limit=limit, max_seconds=max_seconds)
+    finally:
+        # Only release our own lock; a lease that expired may have passed to another run
+        if cache.get(LOCK_KEY) == owner:
+            cache.delete(LOCK_KEY)
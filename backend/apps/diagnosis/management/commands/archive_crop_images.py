@@ -0,0 +1,43 @@
+"""
+Archive the originals of old crop image diagnoses.
+
+Re-encodes originals to WebP, packs them into archive bundles and deletes
+the hot copies, then prints bytes reclaimed and time spent per I/O stage.
+Safe to interrupt and re-run.
+
+Usage:
+    python manage.py archive_crop_images
+    python manage.py archive_crop_images --older-than-days 30 --max-mb-per-second 5
+    python manage.py archive_crop_images --limit 1000 --max-seconds 600
+"""
+import json
+from django.core.management.base import BaseCommand, CommandError
+from apps.diagnosis import lifecycle
+
+
+class Command(BaseCommand):
+    help = 'Move originals of old crop image diagnoses into compact archive bundles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None, help='Minimum diagnosis age')
+        parser.add_argument('--quality', type=int, default=None, help='WebP quality')
+        parser.add_argument('--bundle-mb', type=int, default=None, help='Target bundle size in MB')
+        parser.add_argument('--max-mb-per-second', type=float, default=None,
+                            help='I/O budget in MB per second (0 for unlimited)')
+        parser.add_argument('--limit', type=int, default=None, help='Stop after this many images')
+        parser.add_argument('--max-seconds', type=float, default=None, help='Stop after roughly this long')
+
+    def handle(self, *args, **options):
+        archiver_options = {
+            'older_than_days': options['older_than_days'],
+            'quality': options['quality'],
+            'bundle_bytes': options['bundle_mb'] * 1024 * 1024 if options['bundle_mb'] else None,
+            'max_bytes_per_second': (options['max_mb_per_second'] * 1024 * 1024
+                                     if options['max_mb_per_second'] is not None else None),
+        }
+        report = lifecycle.archive_old_images(
+            limit=options['limit'], max_seconds=options['max_seconds'], **archiver_options
+        )
+        if report is None:
+            raise CommandError('Another archive run is in progress')
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,33 @@
+"""
+Count existing diagnosis results in the outbreak rollup.
+
+New results are counted as they are written; this backfills results from
+before the rollup existed. It works in small chunks and can be stopped and
+re-run at any time: each result is counted exactly once.
+
+Usage:
+    python manage.py backfill_outbreak_rollup
+    python manage.py backfill_outbreak_rollup --chunk-size 500 --pause 0.1
+    python manage.py backfill_outbreak_rollup --reset   # after changing the cell size
+"""
+import time
+from django.core.management.base import BaseCommand
+from apps.diagnosis import analytics
+
+
+class Command(BaseCommand):
+    help = 'Backfill the outbreak heatmap rollup from existing diagnosis results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Results counted per transaction')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to sleep between chunks')
+        parser.add_argument('--reset', action='store_true', help='Empty the rollup and recount every result')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['reset']:
+            analytics.reset(chunk_size=options['chunk_size'])
+            self.stdout.write('Rollup emptied')
+        counted = analytics.backfill(chunk_size=options['chunk_size'], pause=options['pause'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Counted {counted} results in {elapsed:.1f}s'))
@@ -0,0 +1,108 @@
+"""
+Benchmark the early-exit cascade against always running the full model.
+
+Both run over the same preprocessed synthetic corpus. A share of the
+images is made ambiguous by blending in another label's colour, so the
+cascade's fallback path is exercised too.
+
+Usage:
+    python manage.py benchmark_cascade
+    python manage.py benchmark_cascade --images 500 --threshold 0.8 --output cascade.json
+"""
+import time
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from apps.diagnosis import classifiers
+from apps.diagnosis.classifiers import CascadeClassifier
+from apps.diagnosis.preprocessing import decode_payload
+from apps.diagnosis.synthetic import generate_crop_image
+from digi_farm.benchmarking import build_report, summarize, write_report
+
+
+class Command(BaseCommand):
+    help = 'Compare latency and agreement of the diagnosis cascade with the full model'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=200, help='Corpus size')
+        parser.add_argument('--ambiguous', type=float, default=0.3,
+                            help='Share of images blended towards another label')
+        parser.add_argument('--max-blend', type=float, default=0.5,
+                            help='Largest blend for ambiguous images')
+        parser.add_argument('--batch-size', type=int, default=16, help='Images per predict call')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed passes over the corpus')
+        parser.add_argument('--threshold', type=float, help='Override DIAGNOSIS_CASCADE_THRESHOLD')
+        parser.add_argument('--seed', type=int, default=0, help='Corpus seed')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        batch = np.stack([
+            decode_payload('image', generate_crop_image(
+                640, 480, seed=options['seed'] + i,
+                blend=rng.uniform(0, options['max_blend']) if rng.random() < options['ambiguous'] else 0.0
+            ))
+            for i in range(options['images'])
+        ])
+        batches = [batch[i:i + options['batch_size']] for i in range(0, len(batch), options['batch_size'])]
+
+        threshold = options['threshold']
+        if threshold is None:
+            threshold = settings.DIAGNOSIS_CASCADE_THRESHOLD
+        full_version = CascadeClassifier.full_version
+
+        with override_settings(DIAGNOSIS_CASCADE_THRESHOLD=threshold):
+            classifiers.unload_all()
+            cold_start = {}
+            for version in (full_version, CascadeClassifier.version):
+                started = time.perf_counter()
+                classifiers.get_classifier(version)
+                cold_start[version] = round((time.perf_counter() - started) * 1000, 3)
+
+            predictions = {}
+            results = []
+            for version in (full_version, CascadeClassifier.version):
+                samples = []
+                for _ in range(options['repeat']):
+                    predictions[version] = []
+                    for chunk in batches:
+                        started = time.perf_counter()
+                        predictions[version].extend(classifiers.predict(chunk, version=version))
+                        samples.append((time.perf_counter() - started) / len(chunk))
+                results.append({'model': version, 'cold_start_ms': cold_start[version],
+                                'per_image': summarize(samples)})
+            classifiers.unload_all()
+
+        full = predictions[full_version]
+        cascade = predictions[CascadeClassifier.version]
+        fast_stage = f'{CascadeClassifier.version}/{CascadeClassifier.fast_version}'
+        early = [i for i, p in enumerate(cascade) if p['model_version'] == fast_stage]
+        agree = [i for i in range(len(full)) if full[i]['label'] == cascade[i]['label']]
+        speedup = results[0]['per_image']['mean_ms'] / results[1]['per_image']['mean_ms']
+
+        report = build_report('cascade', {
+            'images': options['images'],
+            'ambiguous': options['ambiguous'],
+            'max_blend': options['max_blend'],
+            'batch_size': options['batch_size'],
+            'repeat': options['repeat'],
+            'threshold': threshold,
+            'seed': options['seed'],
+        }, results)
+        report['cascade'] = {
+            'early_exit_rate': round(len(early) / len(cascade), 4),
+            'agreement': round(len(agree) / len(full), 4),
+            # How often the fast stage alone matches the full model when it answers
+            'early_exit_agreement': round(
+                sum(1 for i in early if full[i]['label'] == cascade[i]['label']) / len(early), 4
+            ) if early else None,
+            'mean_speedup': round(speedup, 2),
+        }
+        write_report(report, path=options['output'], stream=self.stdout)
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Cascade: {report['cascade']['mean_speedup']}x faster, "
+                f"{report['cascade']['agreement']:.1%} agreement, "
+                f"{report['cascade']['early_exit_rate']:.1%} early exits"
+            ))
@@ -0,0 +1,192 @@
+"""
+Benchmark the diagnosis request paths end to end on a synthetic corpus.
+
+Two paths are measured against a throwaway database and media directory:
+
+* sync: POST /api/diagnosis/upload/ with DIAGNOSIS_MODE=sync, covering
+  upload parsing, serializer create, storage write, inference and the
+  result write, followed by GET .../result/ to render the response.
+* celery: the same requests with DIAGNOSIS_MODE=async and Celery running
+  tasks eagerly in-process, so diagnose_image runs through the real task
+  code without a broker.
+
+Usage:
+    python manage.py benchmark_diagnosis
+    python manage.py benchmark_diagnosis --resolutions 0.3mp,2mp --images 50
+    python manage.py benchmark_diagnosis --output bench.json --compare baseline.json
+"""
+import json
+import time
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from celery.signals import task_prerun, task_postrun
+from rest_framework.test import APIClient
+from digi_farm.benchmarking import (
+    benchmark_environment, build_report, compare_reports, summarize, track_peak_memory, write_report,
+)
+from digi_farm.celery import app as celery_app
+from apps.diagnosis import classifiers, dedup
+from apps.diagnosis.synthetic import RESOLUTIONS, generate_corpus, generate_crop_image
+
+User = get_user_model()
+
+PATHS = ('sync', 'celery')
+UPLOAD_URL = '/api/diagnosis/upload/'
+
+
+class TaskTimer:
+    """Records diagnose_image run time per task id from Celery signals."""
+
+    def __init__(self):
+        self.started = {}
+        self.samples = []
+
+    def prerun(self, task_id=None, **kwargs):
+        self.started[task_id] = time.perf_counter()
+
+    def postrun(self, task_id=None, **kwargs):
+        started = self.started.pop(task_id, None)
+        if started is not None:
+            self.samples.append(time.perf_counter() - started)
+
+    def __enter__(self):
+        task_prerun.connect(self.prerun, weak=False)
+        task_postrun.connect(self.postrun, weak=False)
+        return self
+
+    def __exit__(self, *exc_info):
+        task_prerun.disconnect(self.prerun)
+        task_postrun.disconnect(self.postrun)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark diagnosis latency, throughput and memory for the sync and Celery paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolutions', default=','.join(RESOLUTIONS),
+                            help=f"Comma-separated resolutions ({', '.join(RESOLUTIONS)})")
+        parser.add_argument('--images', type=int, default=20, help='Images per resolution')
+        parser.add_argument('--paths', default=','.join(PATHS), help='Comma-separated paths to run')
+        parser.add_argument('--warmup', type=int, default=2, help='Unrecorded requests before each run')
+        parser.add_argument('--seed', type=int, default=0, help='Corpus seed')
+        parser.add_argument('--dedup', action='store_true',
+                            help='Keep perceptual deduplication enabled (off by default so every image is classified)')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--compare', help='Baseline JSON report to compare against')
+
+    def handle(self, *args, **options):
+        resolutions = [r.strip() for r in options['resolutions'].split(',') if r.strip()]
+        paths = [p.strip() for p in options['paths'].split(',') if p.strip()]
+        unknown = [r for r in resolutions if r not in RESOLUTIONS] + [p for p in paths if p not in PATHS]
+        if unknown:
+            raise CommandError(f"Unknown resolution or path: {', '.join(unknown)}")
+
+        self.stderr.write(f"Generating {options['images']} images for each of {', '.join(resolutions)}")
+        corpus = generate_corpus(resolutions, per_resolution=options['images'], seed=options['seed'])
+        warmup = [
+            (f'warmup_{i}.jpg', generate_crop_image(*RESOLUTIONS[resolutions[0]], seed=10_000 + i))
+            for i in range(options['warmup'])
+        ]
+
+        results = []
+        # Admission control would throttle a single user uploading the whole corpus
+        with benchmark_environment(DIAGNOSIS_DEDUP_ENABLED=options['dedup'],
+                                   DIAGNOSIS_ADMISSION_BURST=10 ** 6,
+                                   DIAGNOSIS_MAX_QUEUE_SECONDS=10 ** 6):
+            classifiers.warm_up()
+            user = User.objects.create_user(
+                email='bench@example.com', password='benchpass123'
+            )
+            client = APIClient()
+            client.force_authenticate(user=user)
+
+            for path in paths:
+                for resolution in resolutions:
+                    items = [(name, data) for name, key, data in corpus if key == resolution]
+                    self.stderr.write(f'Running {path} path at {resolution} ({len(items)} images)')
+                    results.append(self.run_path(client, path, resolution, items, warmup))
+
+        config = {
+            'resolutions': resolutions,
+            'images_per_resolution': options['images'],
+            'paths': paths,
+            'warmup': options['warmup'],
+            'seed': options['seed'],
+            'dedup': options['dedup'],
+        }
+        report = build_report('diagnosis', config, results)
+        write_report(report, path=options['output'], stream=self.stdout)
+
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+            for change in compare_reports(baseline, report, key_fields=('path', 'resolution')):
+                self.stderr.write(
+                    f"{change['key']:<16} {change['metric']:<28} "
+                    f"{change['baseline']:>12} -> {change['current']:>12} ({change['change_pct']:+}%)"
+                )
+
+    def run_path(self, client, path, resolution, items, warmup):
+        """Upload and fetch every item through one path and summarise the timings."""
+        original_eager = celery_app.conf.task_always_eager
+        mode = 'async' if path == 'celery' else 'sync'
+        celery_app.conf.task_always_eager = path == 'celery'
+        dedup.get_index().reset()
+
+        try:
+            with override_settings(DIAGNOSIS_MODE=mode):
+                for name, data in warmup:
+                    self.request(client, name, data)
+
+                upload, render, end_to_end = [], [], []
+                errors = 0
+                with TaskTimer() as task_timer, track_peak_memory() as memory:
+                    started = time.perf_counter()
+                    for name, data in items:
+                        upload_seconds, render_seconds, ok = self.request(client, name, data)
+                        upload.append(upload_seconds)
+                        render.append(render_seconds)
+                        end_to_end.append(upload_seconds + render_seconds)
+                        errors += not ok
+                    elapsed = time.perf_counter() - started
+        finally:
+            celery_app.conf.task_always_eager = original_eager
+
+        row = {
+            'path': path,
+            'resolution': resolution,
+            'images': len(items),
+            'errors': errors,
+            'elapsed_seconds': round(elapsed, 3),
+            'images_per_second': round(len(items) / elapsed, 2) if elapsed else 0.0,
+            'latency': {
+                'upload': summarize(upload),
+                'result': summarize(render),
+                'end_to_end': summarize(end_to_end),
+            },
+            'memory': memory,
+        }
+        if path == 'celery':
+            row['latency']['task'] = summarize(task_timer.samples)
+        return row
+
+    def request(self, client, name, data):
+        """
+        Upload one image and fetch its result.
+
+        Returns:
+            tuple (upload seconds, result seconds, whether a diagnosis came back)
+        """
+        started = time.perf_counter()
+        response = client.post(
+            UPLOAD_URL, {'image': SimpleUploadedFile(name, data, content_type='image/jpeg')}, format='multipart'
+        )
+        uploaded = time.perf_counter()
+        if response.status_code not in (201, 202):
+            return uploaded - started, 0.0, False
+
+        result = client.get(f"{UPLOAD_URL}{response.data['id']}/result/")
+        finished = time.perf_counter()
+        return uploaded - started, finished - uploaded, result.status_code == 200
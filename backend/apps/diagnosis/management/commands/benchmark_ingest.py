@@ -0,0 +1,96 @@
+"""
+Benchmark image decoding: full-size decode versus the ingest pipeline.
+
+Each measurement runs in a fresh child process so peak RSS reflects a
+single image rather than everything decoded before it.
+
+Usage:
+    python manage.py benchmark_ingest
+    python manage.py benchmark_ingest path/to/a.jpg path/to/b.png --json
+"""
+import io
+import json
+import time
+import resource
+import multiprocessing
+from pathlib import Path
+from django.core.management.base import BaseCommand
+from PIL import Image
+from apps.diagnosis.preprocessing import MODEL_INPUT_SIZE, ingest_upload, to_model_array
+from apps.diagnosis.synthetic import RESOLUTIONS, generate_crop_image
+
+
+def decode_full(data):
+    """What every consumer did before ingest: decode the whole image."""
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    to_model_array(img, size=MODEL_INPUT_SIZE)
+
+
+def decode_ingest(data):
+    ingest_upload(io.BytesIO(data))
+
+
+MODES = {
+    'full': decode_full,
+    'ingest': decode_ingest,
+}
+
+
+def measure(mode, data, queue):
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    MODES[mode](data)
+    elapsed = time.perf_counter() - started
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({'seconds': elapsed, 'peak_rss_delta_kb': max(peak_kb - baseline_kb, 0)})
+
+
+class Command(BaseCommand):
+    help = 'Benchmark per-image decode time and peak RSS for full decode vs ingest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*', help='Image files (default: synthetic corpus)')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per image and mode')
+        parser.add_argument('--json', action='store_true', help='Print machine-readable JSON')
+
+    def handle(self, *args, **options):
+        if options['images']:
+            samples = [(Path(p).name, Path(p).read_bytes()) for p in options['images']]
+        else:
+            samples = [
+                (f'synthetic_{key}.jpg', generate_crop_image(width, height))
+                for key, (width, height) in RESOLUTIONS.items()
+            ]
+
+        context = multiprocessing.get_context('fork')
+        results = []
+        for name, data in samples:
+            width, height = Image.open(io.BytesIO(data)).size
+            for mode in MODES:
+                runs = []
+                for _ in range(options['repeat']):
+                    queue = context.Queue()
+                    process = context.Process(target=measure, args=(mode, data, queue))
+                    process.start()
+                    runs.append(queue.get())
+                    process.join()
+                results.append({
+                    'image': name,
+                    'width': width,
+                    'height': height,
+                    'mode': mode,
+                    'decode_ms': round(min(r['seconds'] for r in runs) * 1000, 2),
+                    'peak_rss_delta_kb': max(r['peak_rss_delta_kb'] for r in runs),
+                })
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'image':<28} {'size':>11} {'mode':>7} {'decode ms':>10} {'peak RSS KB':>12}")
+        for row in results:
+            size = f"{row['width']}x{row['height']}"
+            self.stdout.write(
+                f"{row['image']:<28} {size:>11} {row['mode']:>7} "
+                f"{row['decode_ms']:>10} {row['peak_rss_delta_kb']:>12}"
+            )
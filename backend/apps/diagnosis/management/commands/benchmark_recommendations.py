@@ -0,0 +1,115 @@
+"""
+Measure diagnosis result storage and serialization with the recommendation catalogue.
+
+Creates diagnosis results in a throwaway database and reports:
+
+* the size of the diagnosis_results and recommendation_templates tables,
+  next to the bytes the same rows stored when every result carried an
+  inline copy of its recommendations,
+* DiagnosisDetailSerializer time and payload size with recommendations
+  inlined from the catalogue cache and with catalogue references only.
+
+Usage:
+    python manage.py benchmark_recommendations
+    python manage.py benchmark_recommendations --results 10000 --output recs.json
+"""
+import json
+import time
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from digi_farm.benchmarking import (
+    benchmark_environment, build_report, compare_reports, summarize, table_bytes, write_report,
+)
+from apps.diagnosis import recommendations
+from apps.diagnosis.models import CropImage, DiagnosisResult
+from apps.diagnosis.serializers import DiagnosisDetailSerializer
+
+User = get_user_model()
+
+MODEL_VERSION = 'v1.0-histogram'
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Report diagnosis table size and serialization time with the recommendation catalogue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--results', type=int, default=2000, help='Diagnosis results to create')
+        parser.add_argument('--page-size', type=int, default=20, help='Results serialized per request')
+        parser.add_argument('--repeat', type=int, default=50, help='Serializations per mode')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--compare', help='Baseline JSON report to compare against')
+
+    def handle(self, *args, **options):
+        with benchmark_environment():
+            recommendations.clear_cache()
+            self.populate(options['results'])
+            results = [self.measure_storage(options['results'])]
+            for mode in ('inline', 'ref'):
+                results.append(self.measure_serialization(mode, options['page_size'], options['repeat']))
+            recommendations.clear_cache()
+
+        config = {key: options[key] for key in ('results', 'page_size', 'repeat')}
+        report = build_report('recommendations', config, results)
+        write_report(report, path=options['output'], stream=self.stdout)
+
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)
+            for change in compare_reports(baseline, report, key_fields=('mode',)):
+                self.stderr.write(
+                    f"{change['key']:<8} {change['metric']:<32} "
+                    f"{change['baseline']:>12} -> {change['current']:>12} ({change['change_pct']:+}%)"
+                )
+
+    def populate(self, count):
+        user = User.objects.create_user(email='bench@example.com', password='benchpass123')
+        labels = list(recommendations.RECOMMENDATIONS)
+        for start in range(0, count, BATCH_SIZE):
+            size = min(BATCH_SIZE, count - start)
+            crop_images = CropImage.objects.bulk_create([
+                CropImage(image=f'crop_images/bench_{start + i}.jpg', status='processed', submitted_by=user)
+                for i in range(size)
+            ])
+            DiagnosisResult.objects.bulk_create([
+                DiagnosisResult(
+                    crop_image=crop_image,
+                    predicted_label=labels[(start + i) % len(labels)],
+                    confidence=0.9,
+                    recommendation=recommendations.get_template(labels[(start + i) % len(labels)], MODEL_VERSION),
+                    model_version=MODEL_VERSION
+                )
+                for i, crop_image in enumerate(crop_images)
+            ])
+
+    def measure_storage(self, count):
+        labels = list(recommendations.RECOMMENDATIONS)
+        inline_sizes = [len(json.dumps(recommendations.RECOMMENDATIONS[label])) for label in labels]
+        legacy_bytes = sum(inline_sizes[i % len(labels)] for i in range(count))
+        return {
+            'mode': 'storage',
+            'results': count,
+            'diagnosis_results_bytes': table_bytes(DiagnosisResult._meta.db_table),
+            'recommendation_templates_bytes': table_bytes('recommendation_templates'),
+            'legacy_inline_recommendation_bytes': legacy_bytes,
+        }
+
+    def measure_serialization(self, mode, page_size, repeat):
+        queryset = CropImage.objects.select_related('submitted_by', 'farm', 'diagnosis_result')
+        page = list(queryset[:page_size])
+        context = {'recommendations': mode}
+
+        samples = []
+        payload = b''
+        for _ in range(repeat):
+            started = time.perf_counter()
+            payload = JSONRenderer().render(DiagnosisDetailSerializer(page, many=True, context=context).data)
+            samples.append(time.perf_counter() - started)
+
+        return {
+            'mode': mode,
+            'results': len(page),
+            'payload_bytes': len(payload),
+            'serialize': summarize(samples),
+        }
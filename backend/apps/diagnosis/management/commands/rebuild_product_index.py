@@ -0,0 +1,24 @@
+"""
+Rebuild the diagnosis label to marketplace product index.
+
+The index is kept up to date when products are saved; run this after
+changing the recommendation catalogue or bulk-loading products.
+
+Usage:
+    python manage.py rebuild_product_index
+    python manage.py rebuild_product_index --batch-size 1000
+"""
+from django.core.management.base import BaseCommand
+from apps.marketplace.models import Product
+from apps.diagnosis import products
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the precomputed label to product index used by diagnosis results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Products indexed per transaction')
+
+    def handle(self, *args, **options):
+        count = products.rebuild(Product.objects.all(), batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} products'))
@@ -0,0 +1,30 @@
+"""
+Run the process-pool diagnosis worker.
+
+Usage:
+    python manage.py run_diagnosis_worker
+    python manage.py run_diagnosis_worker --workers 8 --batch-size 64
+    python manage.py run_diagnosis_worker --once
+"""
+import json
+from django.core.management.base import BaseCommand
+from apps.diagnosis.worker import ProcessPoolDiagnosisWorker
+
+
+class Command(BaseCommand):
+    help = 'Diagnose pending crop images using a process pool across all CPU cores'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='Pool processes (default: CPU count)')
+        parser.add_argument('--batch-size', type=int, default=None, help='Images per batch')
+        parser.add_argument('--once', action='store_true', help='Exit when no pending images remain')
+        parser.add_argument('--idle-sleep', type=float, default=1.0, help='Seconds between polls when idle')
+
+    def handle(self, *args, **options):
+        worker = ProcessPoolDiagnosisWorker(workers=options['workers'], batch_size=options['batch_size'])
+        self.stdout.write(f'Starting diagnosis worker with {worker.workers} processes')
+        try:
+            summary = worker.run(once=options['once'], idle_sleep=options['idle_sleep'])
+        except KeyboardInterrupt:
+            summary = worker.summary()
+        self.stdout.write(json.dumps(summary, indent=2))
@@ -0,0 +1,57 @@
+"""
+Lightweight in-process metrics for the diagnosis pipeline.
+
+Metrics are kept per process (web worker or Celery worker) and can be read
+through the diagnosis metrics endpoint or logged by the worker itself.
+"""
+import os
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+
+def increment(name, value=1):
+    """Increment a counter."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    """Record a duration sample (in seconds) for a timing metric."""
+    with _lock:
+        stats = _timings.get(name)
+        if stats is None:
+            stats = _timings[name] = {
+                'count': 0,
+                'total': 0.0,
+                'min': seconds,
+                'max': seconds,
+                'last': seconds,
+            }
+        stats['count'] += 1
+        stats['total'] += seconds
+        stats['min'] = min(stats['min'], seconds)
+        stats['max'] = max(stats['max'], seconds)
+        stats['last'] = seconds
+
+
+def snapshot():
+    """Return a JSON-serializable copy of all metrics for this process."""
+    with _lock:
+        timings = {}
+        for name, stats in _timings.items():
+            timings[name] = dict(stats, mean=stats['total'] / stats['count'])
+        return {
+            'pid': os.getpid(),
+            'counters': dict(_counters),
+            'timings': timings,
+        }
+
+
+def reset():
+    """Clear all metrics (used by tests and benchmarks)."""
+    with _lock:
+        _counters.clear()
+        _timings.clear()
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("diagnosis", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cropimage",
+            name="job_id",
+            field=models.CharField(
+                blank=True,
+                help_text="Celery task id when diagnosed asynchronously",
+                max_length=50,
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("diagnosis", "0002_cropimage_job_id"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cropimage",
+            name="image_hash",
+            field=models.CharField(
+                blank=True,
+                help_text="Perceptual hash (dHash) of the image",
+                max_length=16,
+            ),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("diagnosis", "0003_cropimage_image_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cropimage",
+            name="tensor",
+            field=models.FileField(
+                blank=True,
+                help_text="Preprocessed model input (.npy)",
+                upload_to="crop_images/tensors/",
+            ),
+        ),
+        migrations.AddField(
+            model_name="cropimage",
+            name="thumbnail",
+            field=models.ImageField(blank=True, upload_to="crop_images/thumbnails/"),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("diagnosis", "0004_cropimage_tensor_cropimage_thumbnail"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cropimage",
+            name="claimed_at",
+            field=models.DateTimeField(
+                blank=True, help_text="When a worker started processing", null=True
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="cropimage",
+            index=models.Index(
+                fields=["status", "claimed_at"], name="crop_images_status_a092c2_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,130 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+import hashlib
+import json
+
+BATCH_SIZE = 2000
+
+
+def content_hash(content):
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def deduplicate_recommendations(apps, schema_editor):
+    """Move inline recommendation copies into one template per distinct content."""
+    DiagnosisResult = apps.get_model("diagnosis", "DiagnosisResult")
+    RecommendationTemplate = apps.get_model("diagnosis", "RecommendationTemplate")
+
+    templates = {}  # (label, model_version, hash) -> template id
+    versions = {}  # (label, model_version) -> last version number
+    result_ids = {}  # template id -> result ids
+
+    rows = DiagnosisResult.objects.order_by("id").values_list(
+        "id", "predicted_label", "model_version", "recommendations"
+    )
+    for result_id, label, model_version, content in rows.iterator(
+        chunk_size=BATCH_SIZE
+    ):
+        if not content:
+            continue
+        digest = content_hash(content)
+        key = (label, model_version, digest)
+        if key not in templates:
+            version = versions.get((label, model_version), 0) + 1
+            versions[(label, model_version)] = version
+            templates[key] = RecommendationTemplate.objects.create(
+                label=label,
+                model_version=model_version,
+                version=version,
+                content=content,
+                content_hash=digest,
+            ).id
+        result_ids.setdefault(templates[key], []).append(result_id)
+
+    for template_id, ids in result_ids.items():
+        for start in range(0, len(ids), BATCH_SIZE):
+            DiagnosisResult.objects.filter(
+                id__in=ids[start : start + BATCH_SIZE]
+            ).update(recommendation_id=template_id)
+
+
+def restore_recommendations(apps, schema_editor):
+    """Copy template content back onto each result."""
+    DiagnosisResult = apps.get_model("diagnosis", "DiagnosisResult")
+    RecommendationTemplate = apps.get_model("diagnosis", "RecommendationTemplate")
+
+    for template in RecommendationTemplate.objects.all():
+        DiagnosisResult.objects.filter(recommendation_id=template.id).update(
+            recommendations=template.content
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("diagnosis", "0005_cropimage_claimed_at_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecommendationTemplate",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("label", models.CharField(max_length=200)),
+                (
+                    "model_version",
+                    models.CharField(
+                        help_text="ML model version the label belongs to", max_length=50
+                    ),
+                ),
+                ("version", models.PositiveIntegerField(default=1)),
+                (
+                    "content",
+                    models.JSONField(
+                        default=dict,
+                        help_text="Structured recommendations including treatment, products, etc.",
+                    ),
+                ),
+                (
+                    "content_hash",
+                    models.CharField(
+                        help_text="SHA-256 of the content, used as its ETag",
+                        max_length=64,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "db_table": "recommendation_templates",
+                "ordering": ["label", "model_version", "-version"],
+                "unique_together": {("label", "model_version", "version")},
+            },
+        ),
+        migrations.AddField(
+            model_name="diagnosisresult",
+            name="recommendation",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="diagnosis_results",
+                to="diagnosis.recommendationtemplate",
+            ),
+        ),
+        migrations.RunPython(deduplicate_recommendations, restore_recommendations),
+        migrations.RemoveField(
+            model_name="diagnosisresult",
+            name="recommendations",
+        ),
+    ]
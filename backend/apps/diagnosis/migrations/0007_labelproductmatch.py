@@ -0,0 +1,63 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("marketplace", "0002_alter_product_is_verified"),
+        ("diagnosis", "0006_recommendationtemplate_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LabelProductMatch",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("label", models.CharField(max_length=200)),
+                (
+                    "score",
+                    models.FloatField(
+                        help_text="Relevance of the product to the label"
+                    ),
+                ),
+                ("title", models.CharField(max_length=200)),
+                ("price", models.DecimalField(decimal_places=2, max_digits=10)),
+                (
+                    "available",
+                    models.BooleanField(
+                        default=True, help_text="Active, verified and in stock"
+                    ),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="diagnosis_matches",
+                        to="marketplace.product",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "label_product_matches",
+                "indexes": [
+                    models.Index(
+                        fields=["label", "available", "-score", "price"],
+                        name="label_produ_label_021879_idx",
+                    )
+                ],
+                "unique_together": {("label", "product")},
+            },
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("diagnosis", "0007_labelproductmatch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="diagnosisresult",
+            name="in_rollup",
+            field=models.BooleanField(
+                default=False, help_text="Counted in the outbreak rollup"
+            ),
+        ),
+        migrations.CreateModel(
+            name="OutbreakRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("label", models.CharField(max_length=200)),
+                (
+                    "cell_row",
+                    models.IntegerField(
+                        help_text="floor(latitude / DIAGNOSIS_HEATMAP_CELL_DEGREES)"
+                    ),
+                ),
+                (
+                    "cell_column",
+                    models.IntegerField(
+                        help_text="floor(longitude / DIAGNOSIS_HEATMAP_CELL_DEGREES)"
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("count", models.PositiveIntegerField(default=0)),
+                ("confidence_sum", models.FloatField(default=0.0)),
+            ],
+            options={
+                "db_table": "outbreak_rollups",
+                "indexes": [
+                    models.Index(
+                        fields=["day", "label"], name="outbreak_ro_day_70edd0_idx"
+                    )
+                ],
+                "unique_together": {("label", "cell_row", "cell_column", "day")},
+            },
+        ),
+    ]
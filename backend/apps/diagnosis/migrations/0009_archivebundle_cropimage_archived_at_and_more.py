@@ -0,0 +1,104 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:26
+
+import apps.diagnosis.storage
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("diagnosis", "0008_diagnosisresult_in_rollup_outbreakrollup"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchiveBundle",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(
+                        help_text="Storage name of the bundle",
+                        max_length=255,
+                        unique=True,
+                    ),
+                ),
+                ("size", models.BigIntegerField(help_text="Bundle size in bytes")),
+                ("file_count", models.PositiveIntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "db_table": "archive_bundles",
+                "ordering": ["-created_at"],
+            },
+        ),
+        migrations.AddField(
+            model_name="cropimage",
+            name="archived_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="When the original moved to an archive bundle",
+                null=True,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="cropimage",
+            name="image",
+            field=models.ImageField(
+                storage=apps.diagnosis.storage.get_crop_image_storage,
+                upload_to="crop_images/",
+            ),
+        ),
+        migrations.CreateModel(
+            name="ArchivedFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(
+                        help_text="Storage name under archive/",
+                        max_length=255,
+                        unique=True,
+                    ),
+                ),
+                ("offset", models.BigIntegerField()),
+                ("length", models.BigIntegerField()),
+                ("sha256", models.CharField(max_length=64)),
+                (
+                    "original_size",
+                    models.BigIntegerField(
+                        help_text="Size of the file before archiving"
+                    ),
+                ),
+                ("archived_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "bundle",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="files",
+                        to="diagnosis.archivebundle",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "archived_files",
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("diagnosis", "0009_archivebundle_cropimage_archived_at_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cropimage",
+            name="fair_tag",
+            field=models.FloatField(
+                default=0.0,
+                help_text="Weighted fair queueing tag; lower tags are diagnosed first",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="cropimage",
+            index=models.Index(
+                fields=["status", "fair_tag"], name="crop_images_status_0fe659_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="cropimage",
+            index=models.Index(
+                fields=["fair_tag"], name="crop_images_fair_ta_a30c20_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="diagnosisresult",
+            index=models.Index(
+                fields=["processed_at"], name="diagnosis_r_process_92dc82_idx"
+            ),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from apps.farms.models import Farm
 from apps.users.models import User
+from .storage import get_crop_image_storage
 
 
 class CropImage(models.Model):
@@ -13,17 +14,27 @@ class CropImage(models.Model):
     ]
     
     farm = models.ForeignKey(Farm, on_delete=models.CASCADE, related_name='crop_images', null=True, blank=True)
-    image = models.ImageField(upload_to='crop_images/')
+    image = models.ImageField(upload_to='crop_images/', storage=get_crop_image_storage)
+    thumbnail = models.ImageField(upload_to='crop_images/thumbnails/', blank=True)
+    tensor = models.FileField(upload_to='crop_images/tensors/', blank=True, help_text='Preprocessed model input (.npy)')
     timestamp = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    claimed_at = models.DateTimeField(null=True, blank=True, help_text='When a worker started processing')
     submitted_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='submitted_diagnoses')
     notes = models.TextField(blank=True, help_text='Optional notes about the crop condition')
+    job_id = models.CharField(max_length=50, blank=True, help_text='Celery task id when diagnosed asynchronously')
+    image_hash = models.CharField(max_length=16, blank=True, help_text='Perceptual hash (dHash) of the image')
+    archived_at = models.DateTimeField(null=True, blank=True, help_text='When the original moved to an archive bundle')
+    fair_tag = models.FloatField(default=0.0, help_text='Weighted fair queueing tag; lower tags are diagnosed first')
     
     class Meta:
         db_table = 'crop_images'
         indexes = [
             models.Index(fields=['submitted_by']),
             models.Index(fields=['status']),
+            models.Index(fields=['status', 'claimed_at']),
+            models.Index(fields=['status', 'fair_tag']),
+            models.Index(fields=['fair_tag']),
             models.Index(fields=['timestamp']),
         ]
         ordering = ['-timestamp']
@@ -32,22 +43,132 @@ class CropImage(models.Model):
         return f"Crop Image {self.id} - {self.status}"
 
 
+class RecommendationTemplate(models.Model):
+    """
+    Versioned treatment and prevention recommendations for a diagnosis label.
+    
+    Templates are immutable: changing the content of a label creates a new
+    version, so a content hash identifies a template for caching.
+    """
+    label = models.CharField(max_length=200)
+    model_version = models.CharField(max_length=50, help_text='ML model version the label belongs to')
+    version = models.PositiveIntegerField(default=1)
+    content = models.JSONField(
+        default=dict,
+        help_text='Structured recommendations including treatment, products, etc.'
+    )
+    content_hash = models.CharField(max_length=64, help_text='SHA-256 of the content, used as its ETag')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'recommendation_templates'
+        unique_together = ['label', 'model_version', 'version']
+        ordering = ['label', 'model_version', '-version']
+    
+    def __str__(self):
+        return f"{self.label} ({self.model_version} v{self.version})"
+
+
 class DiagnosisResult(models.Model):
     """Model for storing AI diagnosis results."""
     crop_image = models.OneToOneField(CropImage, on_delete=models.CASCADE, related_name='diagnosis_result')
     predicted_label = models.CharField(max_length=200, help_text='Predicted disease or issue')
     confidence = models.FloatField(help_text='Confidence score (0.0 to 1.0)')
-    recommendations = models.JSONField(
-        default=dict,
-        help_text='Structured recommendations including treatment, products, etc.'
+    recommendation = models.ForeignKey(
+        RecommendationTemplate,
+        on_delete=models.PROTECT,
+        related_name='diagnosis_results',
+        null=True,
+        blank=True
     )
     processed_at = models.DateTimeField(auto_now_add=True)
     model_version = models.CharField(max_length=50, default='v1.0', help_text='ML model version used')
+    in_rollup = models.BooleanField(default=False, help_text='Counted in the outbreak rollup')
     
     class Meta:
         db_table = 'diagnosis_results'
         ordering = ['-processed_at']
+        indexes = [
+            models.Index(fields=['processed_at']),
+        ]
     
     def __str__(self):
         return f"Diagnosis for Image {self.crop_image.id}: {self.predicted_label} ({self.confidence:.2%})"
 
+
+class LabelProductMatch(models.Model):
+    """
+    Precomputed match between a diagnosis label and a marketplace product.
+    
+    Maintained by apps.diagnosis.products when products are saved; price
+    and availability are copied from the product so lookups need no join.
+    """
+    label = models.CharField(max_length=200)
+    product = models.ForeignKey('marketplace.Product', on_delete=models.CASCADE, related_name='diagnosis_matches')
+    score = models.FloatField(help_text='Relevance of the product to the label')
+    title = models.CharField(max_length=200)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    available = models.BooleanField(default=True, help_text='Active, verified and in stock')
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'label_product_matches'
+        unique_together = ['label', 'product']
+        indexes = [
+            models.Index(fields=['label', 'available', '-score', 'price']),
+        ]
+    
+    def __str__(self):
+        return f"{self.label} -> {self.title} ({self.score})"
+
+
+class OutbreakRollup(models.Model):
+    """Number of diagnoses per label, grid cell and day, for outbreak heatmaps."""
+    label = models.CharField(max_length=200)
+    cell_row = models.IntegerField(help_text='floor(latitude / DIAGNOSIS_HEATMAP_CELL_DEGREES)')
+    cell_column = models.IntegerField(help_text='floor(longitude / DIAGNOSIS_HEATMAP_CELL_DEGREES)')
+    day = models.DateField()
+    count = models.PositiveIntegerField(default=0)
+    confidence_sum = models.FloatField(default=0.0)
+    
+    class Meta:
+        db_table = 'outbreak_rollups'
+        unique_together = ['label', 'cell_row', 'cell_column', 'day']
+        indexes = [
+            models.Index(fields=['day', 'label']),
+        ]
+    
+    def __str__(self):
+        return f"{self.label} at ({self.cell_row}, {self.cell_column}) on {self.day}: {self.count}"
+
+
+class ArchiveBundle(models.Model):
+    """An immutable file in storage holding many archived crop images."""
+    name = models.CharField(max_length=255, unique=True, help_text='Storage name of the bundle')
+    size = models.BigIntegerField(help_text='Bundle size in bytes')
+    file_count = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'archive_bundles'
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"{self.name} ({self.file_count} files)"
+
+
+class ArchivedFile(models.Model):
+    """Location of an archived file inside its bundle."""
+    name = models.CharField(max_length=255, unique=True, help_text='Storage name under archive/')
+    bundle = models.ForeignKey(ArchiveBundle, on_delete=models.PROTECT, related_name='files')
+    offset = models.BigIntegerField()
+    length = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    original_size = models.BigIntegerField(help_text='Size of the file before archiving')
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'archived_files'
+    
+    def __str__(self):
+        return f"{self.name} in {self.bundle.name}"
@@ -0,0 +1,143 @@
+"""
+Image preprocessing helpers for crop diagnosis inference.
+
+Uploads are decoded once at ingest time into two small derived artifacts
+stored next to the original: a normalised model-input tensor (.npy) and a
+JPEG thumbnail. Inference loads the tensor and list views serve the
+thumbnail, so the full-size original is never decoded again.
+"""
+import io
+import logging
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image
+from .dedup import dhash_image
+
+logger = logging.getLogger(__name__)
+
+# Input resolution expected by the diagnosis classifiers
+MODEL_INPUT_SIZE = (224, 224)
+
+
+def open_reduced(image_file, min_size):
+    """
+    Open an image and decode it at the smallest scale that still covers min_size.
+
+    JPEGs are downscaled inside the decoder (draft mode) so a 12 MP photo is
+    never materialised at full resolution. Other formats are decoded in full
+    and then reduced by an integer factor.
+
+    Raises:
+        ValueError if the image has more pixels than DIAGNOSIS_MAX_IMAGE_PIXELS
+    """
+    img = Image.open(image_file)
+    width, height = img.size
+    if width * height > settings.DIAGNOSIS_MAX_IMAGE_PIXELS:
+        raise ValueError(f'Image is too large ({width}x{height})')
+
+    img.draft('RGB', (min_size, min_size))
+    factor = min(img.size[0] // min_size, img.size[1] // min_size)
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img.convert('RGB')
+
+
+def to_model_array(img, size=MODEL_INPUT_SIZE):
+    """Resize a PIL image to the model input size, scaled to [0, 1]."""
+    return np.asarray(img.resize(size), dtype=np.float32) / 255.0
+
+
+def ingest_upload(image_file):
+    """
+    Decode an upload once and derive everything downstream stages need.
+
+    Returns:
+        dict with 'image_hash' (dHash hex string), 'tensor' (ContentFile
+        holding a float16 .npy array) and 'thumbnail' (ContentFile JPEG)
+    """
+    thumbnail_size = settings.DIAGNOSIS_THUMBNAIL_SIZE
+    img = open_reduced(image_file, max(thumbnail_size, *MODEL_INPUT_SIZE))
+
+    tensor_io = io.BytesIO()
+    np.save(tensor_io, to_model_array(img).astype(np.float16))
+
+    thumbnail = img.copy()
+    thumbnail.thumbnail((thumbnail_size, thumbnail_size))
+    thumbnail_io = io.BytesIO()
+    thumbnail.save(thumbnail_io, format='JPEG', quality=80)
+
+    return {
+        'image_hash': dhash_image(img),
+        'tensor': ContentFile(tensor_io.getvalue()),
+        'thumbnail': ContentFile(thumbnail_io.getvalue()),
+    }
+
+
+def read_payload(crop_image, size=MODEL_INPUT_SIZE):
+    """
+    Read the bytes needed to preprocess a CropImage.
+
+    Returns:
+        tuple (kind, data) where kind is 'tensor' when the ingest-time
+        tensor can be used and 'image' when the original must be decoded
+    """
+    if crop_image.tensor and tuple(size) == MODEL_INPUT_SIZE:
+        with crop_image.tensor.open('rb') as tensor_file:
+            return 'tensor', tensor_file.read()
+    with crop_image.image.open('rb') as image_file:
+        return 'image', image_file.read()
+
+
+def decode_payload(kind, data, size=MODEL_INPUT_SIZE):
+    """Turn bytes from read_payload into a float32 model-input array."""
+    if kind == 'tensor':
+        return np.load(io.BytesIO(data)).astype(np.float32)
+    img = open_reduced(io.BytesIO(data), max(size))
+    return to_model_array(img, size=size)
+
+
+def preprocess_image(crop_image, size=MODEL_INPUT_SIZE):
+    """
+    Load a CropImage as a model-ready array.
+
+    Uses the tensor cached at ingest time when available and falls back to
+    decoding the original (at reduced scale) otherwise.
+
+    Returns:
+        float32 ndarray of shape (height, width, 3) scaled to [0, 1]
+    """
+    kind, data = read_payload(crop_image, size=size)
+    return decode_payload(kind, data, size=size)
+
+
+def preprocess_batch(crop_images, size=MODEL_INPUT_SIZE):
+    """
+    Preprocess a list of CropImages into one stacked array.
+
+    Images that cannot be read or decoded are skipped so that a single
+    corrupt upload does not fail the whole batch.
+
+    Returns:
+        tuple (batch, loaded, failed) where batch is an ndarray of shape
+        (len(loaded), height, width, 3), loaded is the list of CropImages
+        in batch order and failed is the list of CropImages that were skipped
+    """
+    arrays = []
+    loaded = []
+    failed = []
+
+    for crop_image in crop_images:
+        try:
+            arrays.append(preprocess_image(crop_image, size=size))
+            loaded.append(crop_image)
+        except Exception as e:
+            logger.warning(f'Failed to preprocess CropImage {crop_image.id}: {str(e)}')
+            failed.append(crop_image)
+
+    if arrays:
+        batch = np.stack(arrays)
+    else:
+        batch = np.empty((0, size[1], size[0], 3), dtype=np.float32)
+
+    return batch, loaded, failed
@@ -0,0 +1,128 @@
+"""
+Precomputed index of marketplace products matching each diagnosis label.
+
+The recommendations for a label name products only as free text (e.g.
+"Copper Fungicide", category "fungicide"). Instead of searching products
+with LIKE queries on every request, each product is scored against every
+label when it is saved and the matches are stored in LabelProductMatch with
+the price and availability copied in. Looking up the best products for a
+diagnosis is then a single indexed query.
+"""
+import re
+import logging
+from django.conf import settings
+from django.db import transaction
+from .models import LabelProductMatch
+from .recommendations import RECOMMENDATIONS
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """Lowercase word tokens of three or more characters."""
+    return {token for token in TOKEN_RE.findall((text or '').lower()) if len(token) > 2}
+
+
+def category_matches(wanted, product_tokens):
+    """True if every word of a recommended category (e.g. organic-fungicide) prefixes a product token."""
+    wanted_tokens = tokenize(wanted.replace('-', ' '))
+    return bool(wanted_tokens) and all(
+        any(token.startswith(word) for token in product_tokens) for word in wanted_tokens
+    )
+
+
+def score_product(product, label):
+    """
+    Relevance of a product to a diagnosis label.
+
+    The score is the best match over the label's recommended products:
+    the share of the recommended name found in the title (weighted 2) or
+    description (weighted 0.5), plus 1 when the product category (or title)
+    matches the recommended category.
+
+    Returns:
+        float, 0.0 when the product is unrelated to the label
+    """
+    title = tokenize(product.title)
+    description = tokenize(product.description)
+    category = tokenize(product.category.name) | tokenize(product.category.slug) if product.category else set()
+
+    best = 0.0
+    for recommended in RECOMMENDATIONS.get(label, {}).get('recommended_products', []):
+        name = tokenize(recommended['name'])
+        if not name:
+            continue
+        score = 2 * len(name & title) / len(name) + 0.5 * len(name & description) / len(name)
+        if category_matches(recommended.get('category', ''), category | title):
+            score += 1
+        best = max(best, score)
+    return round(best, 4)
+
+
+def is_available(product):
+    return product.is_active and product.is_verified and product.stock > 0
+
+
+def build_matches(product):
+    """Unsaved LabelProductMatch rows for every label the product matches."""
+    matches = []
+    for label in RECOMMENDATIONS:
+        score = score_product(product, label)
+        if score > 0:
+            matches.append(LabelProductMatch(
+                label=label,
+                product=product,
+                score=score,
+                title=product.title[:200],
+                price=product.price,
+                available=is_available(product)
+            ))
+    return matches
+
+
+def refresh_product(product):
+    """Replace the index rows of one product."""
+    with transaction.atomic():
+        LabelProductMatch.objects.filter(product=product).delete()
+        LabelProductMatch.objects.bulk_create(build_matches(product))
+
+
+def rebuild(products, batch_size=500):
+    """
+    Rebuild the index for a product queryset in batches.
+
+    Returns:
+        number of products indexed
+    """
+    count = 0
+    queryset = products.select_related('category').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return count
+        with transaction.atomic():
+            LabelProductMatch.objects.filter(product__in=batch).delete()
+            LabelProductMatch.objects.bulk_create(
+                [match for product in batch for match in build_matches(product)]
+            )
+        count += len(batch)
+        last_id = batch[-1].id
+        logger.info(f'Indexed {count} products for diagnosis recommendations')
+
+
+def top_products(label, limit=None):
+    """
+    Best available products for a label, from the precomputed index.
+
+    Returns:
+        list of dicts with id, title and price
+    """
+    limit = settings.DIAGNOSIS_PRODUCT_MATCHES if limit is None else limit
+    rows = LabelProductMatch.objects.filter(label=label, available=True).order_by('-score', 'price')
+    return [
+        {'id': product_id, 'title': title, 'price': price}
+        for product_id, title, price in rows.values_list('product_id', 'title', 'price')[:limit]
+    ]
@@ -0,0 +1,204 @@
+"""
+Recommendation catalogue for diagnosis labels.
+
+RECOMMENDATIONS holds the current treatment and prevention content for each
+label. DiagnosisResults reference a RecommendationTemplate row instead of
+storing a copy of the content, and templates are cached per process: they
+are immutable, so a cached entry never goes stale.
+"""
+import json
+import hashlib
+import threading
+from django.db import IntegrityError, transaction
+from .models import RecommendationTemplate
+
+RECOMMENDATIONS = {
+    'Early Blight (Alternaria solani)': {
+        'issue': 'Severe fungal infection identified as Early Blight. Characterized by concentric ring patterns on leaves and fruit rot.',
+        'severity': 'high',
+        'treatment': [
+            'IMMEDIATE ACTION: Remove and burn all infected lower leaves to stop upward spread.',
+            'Apply fungicide containing Chlorothalonil or Mancozeb every 7 days.',
+            'Copper-based fungicides are effective organic alternatives.',
+            'Improve air circulation by pruning excess foliage.',
+            'Water only at the base of the plant to keep leaves dry.'
+        ],
+        'prevention': [
+            'Implement 3-year crop rotation (avoid planting solanaceous crops in same spot).',
+            'Mulch soil to prevent spores from splashing onto leaves.',
+            'Use certified disease-free seeds.',
+            'Drip irrigation is highly recommended.'
+        ],
+        'recommended_products': [
+            {'name': 'Daconil Fungicide', 'category': 'fungicide'},
+            {'name': 'Liquid Copper Fungicide', 'category': 'organic-fungicide'},
+        ],
+        'timeline': 'With immediate treatment, spread can be contained in 3-5 days. Infected leaves will not recover.'
+    },
+    'Aphids Infestation': {
+        'issue': 'Aphids are small insects that feed on plant sap, causing yellowing and stunted growth.',
+        'severity': 'moderate',
+        'treatment': [
+            'Spray with soap solution (2 tablespoons liquid soap per gallon of water)',
+            'Apply approved insecticide such as neem oil or pyrethrin-based products',
+            'Remove heavily infested leaves',
+            'Introduce beneficial insects like ladybugs',
+            'Ensure proper plant spacing for air circulation'
+        ],
+        'prevention': [
+            'Regular monitoring of plants',
+            'Crop rotation',
+            'Maintain healthy soil with proper nutrients',
+            'Use companion planting with repellent plants'
+        ],
+        'recommended_products': [
+            {'name': 'Neem Oil Insecticide', 'category': 'pesticide'},
+            {'name': 'Organic Soap Spray', 'category': 'pesticide'},
+        ],
+        'timeline': 'Treatment should show results within 1-2 weeks'
+    },
+    'Leaf Blight': {
+        'issue': 'Fungal disease causing brown spots and leaf death.',
+        'severity': 'high',
+        'treatment': [
+            'Remove and destroy infected leaves immediately',
+            'Apply fungicide containing copper or chlorothalonil',
+            'Improve air circulation around plants',
+            'Avoid overhead watering',
+            'Apply treatment every 7-10 days until resolved'
+        ],
+        'prevention': [
+            'Water at base of plants, not on leaves',
+            'Ensure proper spacing',
+            'Use disease-resistant varieties',
+            'Practice crop rotation'
+        ],
+        'recommended_products': [
+            {'name': 'Copper Fungicide', 'category': 'fungicide'},
+            {'name': 'Chlorothalonil Spray', 'category': 'fungicide'},
+        ],
+        'timeline': 'Treatment should show improvement within 2-3 weeks'
+    },
+    'Nitrogen Deficiency': {
+        'issue': 'Plants showing yellowing leaves, indicating lack of nitrogen.',
+        'severity': 'moderate',
+        'treatment': [
+            'Apply nitrogen-rich fertilizer (NPK 20-10-10 or similar)',
+            'Use organic options like compost or manure',
+            'Side-dress plants with nitrogen fertilizer',
+            'Ensure proper soil pH (6.0-7.0) for nutrient uptake'
+        ],
+        'prevention': [
+            'Regular soil testing',
+            'Maintain balanced fertilization schedule',
+            'Use cover crops to fix nitrogen',
+            'Practice crop rotation with legumes'
+        ],
+        'recommended_products': [
+            {'name': 'NPK 20-10-10 Fertilizer', 'category': 'fertilizer'},
+            {'name': 'Organic Compost', 'category': 'fertilizer'},
+        ],
+        'timeline': 'Improvement visible within 1-2 weeks of application'
+    },
+    'Healthy Crop': {
+        'issue': 'No significant issues detected. Crop appears healthy.',
+        'severity': 'none',
+        'treatment': [
+            'Continue current care practices',
+            'Maintain regular monitoring',
+            'Ensure adequate water and nutrients'
+        ],
+        'prevention': [
+            'Continue good agricultural practices',
+            'Regular crop monitoring',
+            'Maintain soil health',
+            'Practice integrated pest management'
+        ],
+        'recommended_products': [],
+        'timeline': 'Continue monitoring'
+    },
+}
+
+
+_lock = threading.Lock()
+_current = {}  # (label, model_version) -> current RecommendationTemplate
+_by_id = {}
+
+
+def content_hash(content):
+    """SHA-256 of the canonical JSON form of a template's content."""
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def get_template(label, model_version):
+    """
+    Current catalogue entry for a label and model version.
+    
+    The first call in a process looks the template up in the database and
+    creates a new version if RECOMMENDATIONS has changed since the latest one.
+    
+    Returns:
+        RecommendationTemplate, or None for labels without recommendations
+    """
+    key = (label, model_version)
+    template = _current.get(key)
+    if template is not None:
+        return template
+    
+    content = RECOMMENDATIONS.get(label)
+    if not content:
+        return None
+    
+    with _lock:
+        template = _current.get(key)
+        if template is None:
+            template = _current_template(label, model_version, content)
+            _current[key] = template
+            _by_id[template.id] = template
+    return template
+
+
+def _current_template(label, model_version, content):
+    digest = content_hash(content)
+    templates = RecommendationTemplate.objects.filter(label=label, model_version=model_version)
+    latest = templates.order_by('-version').first()
+    if latest is not None and latest.content_hash == digest:
+        return latest
+    
+    try:
+        with transaction.atomic():
+            return RecommendationTemplate.objects.create(
+                label=label,
+                model_version=model_version,
+                version=latest.version + 1 if latest else 1,
+                content=content,
+                content_hash=digest
+            )
+    except IntegrityError:
+        # Another process published the same version first
+        return (templates.filter(content_hash=digest).order_by('-version').first()
+                or templates.order_by('-version').first())
+
+
+def get_cached(template_id):
+    """Return a template by id from the process cache, loading it on a miss."""
+    template = _by_id.get(template_id)
+    if template is None and template_id is not None:
+        template = RecommendationTemplate.objects.filter(id=template_id).first()
+        if template is not None:
+            _by_id[template_id] = template
+    return template
+
+
+def get_content(template_id):
+    """Recommendation content for a template id, or an empty dict."""
+    template = get_cached(template_id)
+    return template.content if template is not None else {}
+
+
+def clear_cache():
+    """Forget cached templates (used by tests)."""
+    with _lock:
+        _current.clear()
+        _by_id.clear()
@@ -1,7 +1,15 @@
+import os
+import logging
+from django.conf import settings
+from PIL import Image
 from rest_framework import serializers
-from .models import CropImage, DiagnosisResult
+from . import products, recommendations
+from .models import CropImage, DiagnosisResult, RecommendationTemplate
+from .preprocessing import ingest_upload
 from apps.farms.serializers import FarmListSerializer
 
+logger = logging.getLogger(__name__)
+
 
 class CropImageSerializer(serializers.ModelSerializer):
     """Serializer for CropImage model."""
@@ -10,25 +18,90 @@ class CropImageSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = CropImage
-        fields = ('id', 'farm', 'farm_id', 'image', 'timestamp', 'status', 
-                  'submitted_by', 'notes')
-        read_only_fields = ('id', 'timestamp', 'status', 'submitted_by')
+        fields = ('id', 'farm', 'farm_id', 'image', 'thumbnail', 'timestamp', 'status', 
+                  'submitted_by', 'notes', 'job_id')
+        read_only_fields = ('id', 'thumbnail', 'timestamp', 'status', 'submitted_by', 'job_id')
+    
+    def validate_image(self, value):
+        # Only the header is read here; this bounds decode memory per upload
+        width, height = Image.open(value).size
+        value.seek(0)
+        if width * height > settings.DIAGNOSIS_MAX_IMAGE_PIXELS:
+            raise serializers.ValidationError(
+                f'Image is too large ({width}x{height}). '
+                f'Maximum is {settings.DIAGNOSIS_MAX_IMAGE_PIXELS} pixels.'
+            )
+        return value
     
     def create(self, validated_data):
         validated_data.pop('farm_id', None)
         validated_data['submitted_by'] = self.context['request'].user
-        return super().create(validated_data)
+        
+        image = validated_data['image']
+        try:
+            artifacts = ingest_upload(image)
+        except Exception as e:
+            logger.warning(f'Could not preprocess uploaded image: {str(e)}')
+            artifacts = None
+        image.seek(0)
+        
+        if artifacts:
+            validated_data['image_hash'] = artifacts['image_hash']
+        crop_image = super().create(validated_data)
+        
+        if artifacts:
+            # Derived artifacts are stored next to the original
+            base_name = os.path.splitext(os.path.basename(crop_image.image.name))[0]
+            crop_image.thumbnail.save(f'{base_name}.jpg', artifacts['thumbnail'], save=False)
+            crop_image.tensor.save(f'{base_name}.npy', artifacts['tensor'], save=False)
+            crop_image.save(update_fields=['thumbnail', 'tensor'])
+        
+        return crop_image
+
+
+class RecommendationTemplateSerializer(serializers.ModelSerializer):
+    """Serializer for RecommendationTemplate model."""
+    
+    class Meta:
+        model = RecommendationTemplate
+        fields = ('id', 'label', 'model_version', 'version', 'content', 'content_hash', 'created_at')
+        read_only_fields = fields
 
 
 class DiagnosisResultSerializer(serializers.ModelSerializer):
-    """Serializer for DiagnosisResult model."""
+    """
+    Serializer for DiagnosisResult model.
+    
+    Recommendation content comes from the in-process catalogue cache. When
+    the serializer context has recommendations='ref' only the template id is
+    returned and clients fetch the content from the catalogue endpoint.
+    Matching in-stock products come from the precomputed label index.
+    """
     crop_image = CropImageSerializer(read_only=True)
+    recommendations = serializers.SerializerMethodField()
+    products = serializers.SerializerMethodField()
     
     class Meta:
         model = DiagnosisResult
         fields = ('id', 'crop_image', 'predicted_label', 'confidence', 
-                  'recommendations', 'processed_at', 'model_version')
-        read_only_fields = ('id', 'processed_at')
+                  'recommendation', 'recommendations', 'products', 'processed_at', 'model_version')
+        read_only_fields = ('id', 'recommendation', 'processed_at')
+    
+    def get_recommendations(self, obj):
+        return recommendations.get_content(obj.recommendation_id)
+    
+    def get_products(self, obj):
+        # One index lookup per label, shared by every row of a list
+        cache = self.__dict__.setdefault('_products_by_label', {})
+        if obj.predicted_label not in cache:
+            cache[obj.predicted_label] = products.top_products(obj.predicted_label)
+        return cache[obj.predicted_label]
+    
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if self.context.get('recommendations') == 'ref':
+            data.pop('recommendations')
+        return data
 
 
 class DiagnosisDetailSerializer(serializers.ModelSerializer):
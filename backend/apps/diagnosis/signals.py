@@ -0,0 +1,19 @@
+"""
+Keep the label to product index in step with the marketplace.
+"""
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from apps.marketplace.models import Product, ProductCategory
+from . import products
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        products.refresh_product(instance)
+
+
+@receiver(post_save, sender=ProductCategory)
+def reindex_category(sender, instance, raw=False, **kwargs):
+    if not raw:
+        products.rebuild(instance.products.all())
@@ -0,0 +1,172 @@
+"""
+Tiered storage for crop images.
+
+Recent images live as individual files in the default storage (local
+MEDIA_ROOT or S3). Old originals are moved by apps.diagnosis.lifecycle into
+archive bundles: large, immutable files that each hold many images, with
+an ArchivedFile row recording where every image sits inside its bundle.
+
+Archived images get a name under ARCHIVE_PREFIX. TieredStorage serves
+those names from the bundles and everything else from the default storage,
+so CropImage.image.open() and CropImage.image.url keep working after an
+image has been archived. Only the entry's own bytes are read from its
+bundle: a seek on local storage, a ranged GET on S3 (whose file objects
+would otherwise download the whole bundle).
+"""
+import io
+import json
+import hashlib
+import tempfile
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import Storage, default_storage
+from django.urls import reverse
+from django.utils.deconstruct import deconstructible
+
+ARCHIVE_PREFIX = 'archive/'
+BUNDLE_DIR = 'archive_bundles/'
+
+
+def is_archived_name(name):
+    return bool(name) and name.startswith(ARCHIVE_PREFIX)
+
+
+def read_archived(name):
+    """
+    Read an archived file from its bundle.
+
+    Returns:
+        tuple (ArchivedFile, bytes)
+
+    Raises:
+        FileNotFoundError: If the name is not in the archive index
+    """
+    from .models import ArchivedFile
+
+    entry = ArchivedFile.objects.select_related('bundle').filter(name=name).first()
+    if entry is None:
+        raise FileNotFoundError(name)
+    return entry, read_range(default_storage, entry.bundle.name, entry.offset, entry.length)
+
+
+def read_range(storage, name, offset, length):
+    """Read length bytes at offset of a stored file without fetching the rest."""
+    if not length:
+        return b''
+    if hasattr(storage, 'bucket'):
+        # S3Boto3Storage: its file objects download the whole object on first read
+        response = storage.bucket.Object(storage._normalize_name(name)).get(
+            Range=f'bytes={offset}-{offset + length - 1}'
+        )
+        return response['Body'].read()
+    with storage.open(name, 'rb') as stored:
+        stored.seek(offset)
+        return stored.read(length)
+
+
+@deconstructible
+class TieredStorage(Storage):
+    """Default storage for hot files, archive bundles for names under ARCHIVE_PREFIX."""
+
+    def _open(self, name, mode='rb'):
+        if not is_archived_name(name):
+            return default_storage.open(name, mode)
+        if 'w' in mode or 'a' in mode:
+            raise ValueError('Archived files are read-only')
+        _, data = read_archived(name)
+        return File(io.BytesIO(data), name=name)
+
+    def _save(self, name, content):
+        return default_storage.save(name, content)
+
+    def get_available_name(self, name, max_length=None):
+        return default_storage.get_available_name(name, max_length=max_length)
+
+    def generate_filename(self, filename):
+        return default_storage.generate_filename(filename)
+
+    def delete(self, name):
+        if is_archived_name(name):
+            # Bundles are append-only; the bytes are dropped when a bundle is compacted
+            from .models import ArchivedFile
+            ArchivedFile.objects.filter(name=name).delete()
+        else:
+            default_storage.delete(name)
+
+    def exists(self, name):
+        if is_archived_name(name):
+            from .models import ArchivedFile
+            return ArchivedFile.objects.filter(name=name).exists()
+        return default_storage.exists(name)
+
+    def size(self, name):
+        if is_archived_name(name):
+            from .models import ArchivedFile
+            return ArchivedFile.objects.get(name=name).length
+        return default_storage.size(name)
+
+    def url(self, name):
+        if is_archived_name(name):
+            return reverse('archived-image', kwargs={'name': name[len(ARCHIVE_PREFIX):]})
+        return default_storage.url(name)
+
+    def path(self, name):
+        if is_archived_name(name):
+            raise NotImplementedError('Archived files have no filesystem path')
+        return default_storage.path(name)
+
+    def listdir(self, path):
+        return default_storage.listdir(path)
+
+    def get_modified_time(self, name):
+        return default_storage.get_modified_time(name)
+
+
+tiered_storage = TieredStorage()
+
+
+def get_crop_image_storage():
+    return tiered_storage
+
+
+class BundleWriter:
+    """
+    Builds one archive bundle in memory-bounded temporary storage.
+
+    Files are appended back to back; the bundle is written to the default
+    storage once, together with a JSON index, and never modified afterwards.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+        self.entries = []
+
+    @property
+    def size(self):
+        return self.buffer.tell()
+
+    def append(self, name, data):
+        """Append a file and return its index entry."""
+        entry = {
+            'name': name,
+            'offset': self.buffer.tell(),
+            'length': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+        }
+        self.buffer.write(data)
+        self.entries.append(entry)
+        return entry
+
+    def write(self):
+        """
+        Store the bundle and its index.
+
+        Returns:
+            the stored bundle name
+        """
+        self.buffer.seek(0)
+        stored = default_storage.save(self.name, File(self.buffer, name=self.name))
+        index = json.dumps({'bundle': stored, 'entries': self.entries}, indent=1).encode()
+        default_storage.save(f'{stored}.index.json', ContentFile(index))
+        self.buffer.close()
+        return stored
@@ -0,0 +1,71 @@
+"""
+Synthetic crop images for benchmarks.
+
+Images are generated deterministically from a seed so benchmark runs are
+reproducible across machines and releases.
+"""
+import io
+import numpy as np
+from PIL import Image
+from .classifiers import HistogramClassifier
+
+# Common phone camera resolutions
+RESOLUTIONS = {
+    '0.3mp': (640, 480),
+    '2mp': (1600, 1200),
+    '8mp': (3264, 2448),
+    '12mp': (4032, 3024),
+}
+
+
+def generate_crop_image(width, height, seed=0, label=None, quality=90, blend=0.0):
+    """
+    Generate a leaf-like JPEG: a base colour with texture and darker lesions.
+
+    Args:
+        label: Diagnosis label whose reference colour is used; picked from
+            the seed when omitted
+        blend: Share (0-1) of another label's colour mixed in, for
+            ambiguous images
+
+    Returns:
+        JPEG bytes
+    """
+    rng = np.random.default_rng(seed)
+    labels = list(HistogramClassifier.reference_colours)
+    label = label or labels[seed % len(labels)]
+    colour = np.array(HistogramClassifier.reference_colours[label], dtype=np.float32)
+    if blend:
+        other = labels[(labels.index(label) + 1 + seed) % len(labels)]
+        if other == label:
+            other = labels[(labels.index(label) + 1) % len(labels)]
+        colour = (1 - blend) * colour + blend * np.array(HistogramClassifier.reference_colours[other], dtype=np.float32)
+
+    # Texture at low resolution, upscaled, keeps generation cheap at 12 MP
+    small = rng.normal(0.0, 0.06, size=(height // 16 + 1, width // 16 + 1, 3)).astype(np.float32)
+    texture = np.asarray(
+        Image.fromarray(((small + 0.5) * 255).clip(0, 255).astype(np.uint8)).resize((width, height))
+    ).astype(np.float32) / 255.0 - 0.5
+    pixels = np.clip(colour + texture, 0.0, 1.0)
+
+    img = Image.fromarray((pixels * 255).astype(np.uint8))
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def generate_corpus(resolutions=None, per_resolution=4, seed=0):
+    """
+    Generate a corpus of synthetic images.
+
+    Returns:
+        list of (name, resolution key, jpeg bytes)
+    """
+    resolutions = resolutions or list(RESOLUTIONS)
+    corpus = []
+    for key in resolutions:
+        width, height = RESOLUTIONS[key]
+        for i in range(per_resolution):
+            image_seed = seed + i
+            corpus.append((f'synthetic_{key}_{i}.jpg', key, generate_crop_image(width, height, seed=image_seed)))
+    return corpus
@@ -1,47 +1,61 @@
 """
 Celery tasks for crop image diagnosis.
 """
-import os
-import json
+import uuid
+import logging
+from datetime import timedelta
 from celery import shared_task
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+from . import analytics, lifecycle
+from .engine import BatchDiagnosisEngine, build_diagnoses, claim_image
 from .models import CropImage, DiagnosisResult
 
+logger = logging.getLogger(__name__)
+
 
 @shared_task(bind=True, max_retries=3)
 def diagnose_image(self, crop_image_id):
     """
     Process a crop image and generate diagnosis.
     
-    This is a mock implementation. In production, this would:
-    1. Load the image from storage (local or S3)
-    2. Preprocess the image
-    3. Call ML inference service or run model locally
-    4. Parse results and generate recommendations
-    5. Save DiagnosisResult
+    The image is preprocessed and classified by the resident classifier for
+    DIAGNOSIS_MODEL_VERSION (see classifiers.get_classifier).
     
-    For now, it uses a simple rule-based classifier for demonstration.
+    The task is idempotent: it atomically claims the image first, so a
+    duplicate or concurrent delivery for an image that is already being
+    processed or is done returns immediately instead of retrying.
     """
+    if not claim_image(crop_image_id):
+        current = CropImage.objects.filter(id=crop_image_id).values_list('status', flat=True).first()
+        if current is None:
+            return {'error': f'CropImage {crop_image_id} not found'}
+        return {'crop_image_id': crop_image_id, 'status': 'skipped', 'reason': f'already {current}'}
+    
     try:
         crop_image = CropImage.objects.get(id=crop_image_id)
-        crop_image.status = 'processing'
-        crop_image.save()
         
-        # Mock ML inference - replace with actual model call
-        # Example: call external API or run TensorFlow/PyTorch model
-        result = mock_crop_diagnosis(crop_image)
+        diagnoses, _, failed = build_diagnoses([crop_image])
+        if failed:
+            raise ValueError(f'CropImage {crop_image_id} could not be preprocessed')
         
-        # Create diagnosis result
-        diagnosis = DiagnosisResult.objects.create(
-            crop_image=crop_image,
-            predicted_label=result['label'],
-            confidence=result['confidence'],
-            recommendations=result['recommendations'],
-            model_version='v1.0-mock'
-        )
-        
-        crop_image.status = 'processed'
-        crop_image.save()
+        result = diagnoses[0]
+        with transaction.atomic():
+            diagnosis, created = DiagnosisResult.objects.get_or_create(
+                crop_image=crop_image,
+                defaults={
+                    'predicted_label': result.predicted_label,
+                    'confidence': result.confidence,
+                    'recommendation_id': result.recommendation_id,
+                    'model_version': result.model_version,
+                    'in_rollup': True,
+                }
+            )
+            if created:
+                analytics.record([diagnosis])
+        CropImage.objects.filter(id=crop_image_id, status='processing').update(status='processed')
         
         return {
             'crop_image_id': crop_image_id,
@@ -52,174 +66,111 @@ def diagnose_image(self, crop_image_id):
     except CropImage.DoesNotExist:
         return {'error': f'CropImage {crop_image_id} not found'}
     except Exception as exc:
-        # Update status to failed
-        try:
-            crop_image = CropImage.objects.get(id=crop_image_id)
-            crop_image.status = 'failed'
-            crop_image.save()
-        except:
-            pass
-        
-        # Retry the task
+        # Release the claim so the retry can pick the image up again
+        CropImage.objects.filter(id=crop_image_id, status='processing').update(status='failed')
         raise self.retry(exc=exc, countdown=60)
 
 
-def mock_crop_diagnosis(crop_image):
+@shared_task
+def diagnose_pending_batch(batch_size=None, max_wait=None, max_batches=None):
     """
-    Mock diagnosis function that simulates ML model inference.
+    Drain pending crop images in micro-batches.
     
-    In production, replace this with:
-    - API call to ML inference service
-    - Local model inference (TensorFlow/PyTorch)
-    - Or integrate with cloud ML services (AWS SageMaker, Google AI Platform, etc.)
+    Batch size and maximum wait default to the DIAGNOSIS_BATCH_SIZE and
+    DIAGNOSIS_BATCH_MAX_WAIT settings.
+    
+    Returns:
+        list of per-batch statistics (size, elapsed time, images/sec)
     """
-    # Simple rule-based mock classifier
-    # In reality, this would analyze the image pixels/features
+    engine = BatchDiagnosisEngine(batch_size=batch_size, max_wait=max_wait)
+    return engine.drain(max_batches=max_batches)
+
+
+@shared_task
+def reap_stuck_diagnoses(timeout_minutes=None):
+    """
+    Return images stuck in processing (e.g. after a worker crash) to pending.
     
-    # Mock predictions based on filename or simple heuristics
-    filename = crop_image.image.name.lower()
+    Images claimed more than DIAGNOSIS_CLAIM_TIMEOUT minutes ago are reset;
+    in async mode they are also re-enqueued.
     
-    # Heuristic: Check filename for "sick" to force a specific detailed result
-    if 'sick' in filename or 'issue' in filename or 'blight' in filename:
-        return {
-            'label': 'Early Blight (Alternaria solani)',
-            'confidence': 0.98,
-            'recommendations': {
-                'issue': 'Severe fungal infection identified as Early Blight. Characterized by concentric ring patterns on leaves and fruit rot.',
-                'severity': 'high',
-                'treatment': [
-                    'IMMEDIATE ACTION: Remove and burn all infected lower leaves to stop upward spread.',
-                    'Apply fungicide containing Chlorothalonil or Mancozeb every 7 days.',
-                    'Copper-based fungicides are effective organic alternatives.',
-                    'Improve air circulation by pruning excess foliage.',
-                    'Water only at the base of the plant to keep leaves dry.'
-                ],
-                'prevention': [
-                    'Implement 3-year crop rotation (avoid planting solanaceous crops in same spot).',
-                    'Mulch soil to prevent spores from splashing onto leaves.',
-                    'Use certified disease-free seeds.',
-                    'Drip irrigation is highly recommended.'
-                ],
-                'recommended_products': [
-                    {'name': 'Daconil Fungicide', 'category': 'fungicide'},
-                    {'name': 'Liquid Copper Fungicide', 'category': 'organic-fungicide'},
-                ],
-                'timeline': 'With immediate treatment, spread can be contained in 3-5 days. Infected leaves will not recover.'
-            }
-        }
+    Returns:
+        number of images reaped
+    """
+    timeout_minutes = timeout_minutes or settings.DIAGNOSIS_CLAIM_TIMEOUT
+    cutoff = timezone.now() - timedelta(minutes=timeout_minutes)
+    stuck = CropImage.objects.filter(status='processing').filter(
+        Q(claimed_at__lt=cutoff) | Q(claimed_at__isnull=True, timestamp__lt=cutoff)
+    )
     
-    # Mock disease/issue predictions
-    mock_results = [
-        {
-            'label': 'Aphids Infestation',
-            'confidence': 0.85,
-            'recommendations': {
-                'issue': 'Aphids are small insects that feed on plant sap, causing yellowing and stunted growth.',
-                'severity': 'moderate',
-                'treatment': [
-                    'Spray with soap solution (2 tablespoons liquid soap per gallon of water)',
-                    'Apply approved insecticide such as neem oil or pyrethrin-based products',
-                    'Remove heavily infested leaves',
-                    'Introduce beneficial insects like ladybugs',
-                    'Ensure proper plant spacing for air circulation'
-                ],
-                'prevention': [
-                    'Regular monitoring of plants',
-                    'Crop rotation',
-                    'Maintain healthy soil with proper nutrients',
-                    'Use companion planting with repellent plants'
-                ],
-                'recommended_products': [
-                    {'name': 'Neem Oil Insecticide', 'category': 'pesticide'},
-                    {'name': 'Organic Soap Spray', 'category': 'pesticide'},
-                ],
-                'timeline': 'Treatment should show results within 1-2 weeks'
-            }
-        },
-        {
-            'label': 'Leaf Blight',
-            'confidence': 0.78,
-            'recommendations': {
-                'issue': 'Fungal disease causing brown spots and leaf death.',
-                'severity': 'high',
-                'treatment': [
-                    'Remove and destroy infected leaves immediately',
-                    'Apply fungicide containing copper or chlorothalonil',
-                    'Improve air circulation around plants',
-                    'Avoid overhead watering',
-                    'Apply treatment every 7-10 days until resolved'
-                ],
-                'prevention': [
-                    'Water at base of plants, not on leaves',
-                    'Ensure proper spacing',
-                    'Use disease-resistant varieties',
-                    'Practice crop rotation'
-                ],
-                'recommended_products': [
-                    {'name': 'Copper Fungicide', 'category': 'fungicide'},
-                    {'name': 'Chlorothalonil Spray', 'category': 'fungicide'},
-                ],
-                'timeline': 'Treatment should show improvement within 2-3 weeks'
-            }
-        },
-        {
-            'label': 'Nitrogen Deficiency',
-            'confidence': 0.72,
-            'recommendations': {
-                'issue': 'Plants showing yellowing leaves, indicating lack of nitrogen.',
-                'severity': 'moderate',
-                'treatment': [
-                    'Apply nitrogen-rich fertilizer (NPK 20-10-10 or similar)',
-                    'Use organic options like compost or manure',
-                    'Side-dress plants with nitrogen fertilizer',
-                    'Ensure proper soil pH (6.0-7.0) for nutrient uptake'
-                ],
-                'prevention': [
-                    'Regular soil testing',
-                    'Maintain balanced fertilization schedule',
-                    'Use cover crops to fix nitrogen',
-                    'Practice crop rotation with legumes'
-                ],
-                'recommended_products': [
-                    {'name': 'NPK 20-10-10 Fertilizer', 'category': 'fertilizer'},
-                    {'name': 'Organic Compost', 'category': 'fertilizer'},
-                ],
-                'timeline': 'Improvement visible within 1-2 weeks of application'
-            }
-        },
-        {
-            'label': 'Healthy Crop',
-            'confidence': 0.90,
-            'recommendations': {
-                'issue': 'No significant issues detected. Crop appears healthy.',
-                'severity': 'none',
-                'treatment': [
-                    'Continue current care practices',
-                    'Maintain regular monitoring',
-                    'Ensure adequate water and nutrients'
-                ],
-                'prevention': [
-                    'Continue good agricultural practices',
-                    'Regular crop monitoring',
-                    'Maintain soil health',
-                    'Practice integrated pest management'
-                ],
-                'recommended_products': [],
-                'timeline': 'Continue monitoring'
-            }
-        }
-    ]
+    reaped = []
+    for crop_image in stuck.only('id', 'claimed_at'):
+        # Conditional on the claim we saw, so a worker finishing right now wins
+        if CropImage.objects.filter(
+            id=crop_image.id, status='processing', claimed_at=crop_image.claimed_at
+        ).update(status='pending', claimed_at=None):
+            reaped.append(crop_image)
+    
+    if settings.DIAGNOSIS_MODE == 'async':
+        for crop_image in reaped:
+            enqueue_diagnosis(crop_image)
     
-    # Simple heuristic: use filename or random selection for demo
-    import random
-    result = random.choice(mock_results)
+    if reaped:
+        logger.warning(f'Reaped {len(reaped)} diagnoses stuck in processing')
+    return len(reaped)
+
+
+@shared_task
+def archive_old_images(limit=None, max_seconds=None):
+    """Move originals of old diagnoses into archive bundles (see lifecycle)."""
+    return lifecycle.archive_old_images(limit=limit, max_seconds=max_seconds)
+
+
+def enqueue_diagnosis(crop_image):
+    """
+    Queue a CropImage on the diagnosis queue once the current transaction commits.
     
-    # In production, replace with actual model inference:
-    # from tensorflow import keras
-    # model = keras.models.load_model('path/to/model.h5')
-    # image = preprocess_image(crop_image.image.path)
-    # prediction = model.predict(image)
-    # result = parse_prediction(prediction)
+    Returns:
+        job id (the Celery task id) assigned to the diagnosis
+    """
+    job_id = str(uuid.uuid4())
+    CropImage.objects.filter(id=crop_image.id).update(job_id=job_id)
+    crop_image.job_id = job_id
     
-    return result
+    transaction.on_commit(lambda: diagnose_image.apply_async(
+        args=[crop_image.id],
+        task_id=job_id,
+        queue=settings.DIAGNOSIS_QUEUE
+    ))
+    return job_id
+
 
+def queue_depth():
+    """
+    Report the diagnosis backlog.
+    
+    Returns:
+        dict with pending/processing CropImage counts and the number of
+        messages waiting on the broker queue (None if the broker is unreachable)
+    """
+    counts = dict(
+        CropImage.objects.filter(status__in=['pending', 'processing'])
+        .values_list('status')
+        .annotate(total=Count('id'))
+    )
+    
+    broker_messages = None
+    try:
+        with diagnose_image.app.connection_for_read() as conn:
+            conn.ensure_connection(max_retries=1)
+            declared = conn.default_channel.queue_declare(queue=settings.DIAGNOSIS_QUEUE, passive=True)
+            broker_messages = declared.message_count
+    except Exception as e:
+        logger.warning(f'Could not read diagnosis queue depth from broker: {str(e)}')
+    
+    return {
+        'queue': settings.DIAGNOSIS_QUEUE,
+        'pending': counts.get('pending', 0),
+        'processing': counts.get('processing', 0),
+        'broker_messages': broker_messages,
+    }
@@ -32,24 +32,81 @@ def create_test_image():
     img = Image.new('RGB', (100, 100), color='green')
     img_io = BytesIO()
     img.save(img_io, format='JPEG')
+    img_io.name = 'test.jpg'
     img_io.seek(0)
     return img_io
 
 
 @pytest.mark.django_db
 class TestCropImageUpload:
-    def test_upload_image_authenticated(self, authenticated_user):
+    def test_upload_image_authenticated(self, authenticated_user, settings, media_root, monkeypatch,
+                                        django_capture_on_commit_callbacks):
+        from apps.diagnosis.tasks import diagnose_image
+        
+        settings.DIAGNOSIS_MODE = 'async'
+        enqueued = []
+        monkeypatch.setattr(diagnose_image, 'apply_async', lambda **kwargs: enqueued.append(kwargs))
+        api_client, user = authenticated_user
+        
+        image_file = create_test_image()
+        with django_capture_on_commit_callbacks(execute=True):
+            response = api_client.post('/api/diagnosis/upload/', {
+                'image': image_file,
+                'notes': 'Test crop image'
+            }, format='multipart')
+        
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert 'id' in response.data
+        assert response.data['status'] == 'pending'
+        assert response.data['job_id']
+        assert enqueued == [{
+            'args': [response.data['id']],
+            'task_id': response.data['job_id'],
+            'queue': settings.DIAGNOSIS_QUEUE,
+        }]
+    
+    def test_upload_image_sync_mode(self, authenticated_user, settings, media_root):
+        settings.DIAGNOSIS_MODE = 'sync'
         api_client, user = authenticated_user
         
         image_file = create_test_image()
         response = api_client.post('/api/diagnosis/upload/', {
-            'image': image_file,
-            'notes': 'Test crop image'
+            'image': image_file
         }, format='multipart')
         
         assert response.status_code == status.HTTP_201_CREATED
-        assert 'id' in response.data
-        assert response.data['status'] == 'pending'
+        assert response.data['status'] == 'processed'
+    
+    def test_result_streams_events(self, authenticated_user, settings, media_root):
+        settings.DIAGNOSIS_MODE = 'sync'
+        api_client, user = authenticated_user
+        
+        image_file = create_test_image()
+        upload = api_client.post('/api/diagnosis/upload/', {'image': image_file}, format='multipart')
+        
+        response = api_client.get(
+            f"/api/diagnosis/upload/{upload.data['id']}/result/",
+            HTTP_ACCEPT='text/event-stream'
+        )
+        body = b''.join(response.streaming_content).decode()
+        
+        assert response['Content-Type'] == 'text/event-stream'
+        assert 'event: status' in body
+        assert 'event: result' in body
+    
+    def test_unfinished_result_waits_briefly_then_asks_for_a_retry(self, authenticated_user, settings, media_root):
+        api_client, user = authenticated_user
+        crop_image = create_crop_image(User.objects.get(id=user['id']))
+        settings.DIAGNOSIS_RESULT_MAX_WAIT = 0
+        settings.DIAGNOSIS_RESULT_RETRY_AFTER = 3
+        url = f'/api/diagnosis/upload/{crop_image.id}/result/'
+        
+        response = api_client.get(url, {'wait': 30})
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert response['Retry-After'] == '3'
+        
+        body = b''.join(api_client.get(url, HTTP_ACCEPT='text/event-stream').streaming_content).decode()
+        assert 'retry: 3000\nevent: timeout' in body
     
     def test_upload_image_unauthenticated(self, api_client):
         image_file = create_test_image()
@@ -59,7 +116,7 @@ class TestCropImageUpload:
         
         assert response.status_code == status.HTTP_401_UNAUTHORIZED
     
-    def test_get_diagnosis_list(self, authenticated_user):
+    def test_get_diagnosis_list(self, authenticated_user, media_root):
         api_client, user = authenticated_user
         
         # Upload an image first
@@ -73,3 +130,749 @@ class TestCropImageUpload:
         assert response.status_code == status.HTTP_200_OK
         assert len(response.data) > 0
 
+
+@pytest.fixture
+def media_root(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def recommendation_cache():
+    # Catalogue rows are rolled back after each test, so the cache must be too
+    from apps.diagnosis import recommendations
+    recommendations.clear_cache()
+    yield
+    recommendations.clear_cache()
+
+
+@pytest.fixture(autouse=True)
+def admission_state():
+    # Token buckets, slots and throughput estimates live in the cache
+    from django.core.cache import cache
+    cache.clear()
+    yield
+    cache.clear()
+
+
+def create_crop_image(user, name='leaf.jpg', color='green'):
+    """Create a pending CropImage backed by a real image file."""
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from apps.diagnosis.models import CropImage
+    
+    img = Image.new('RGB', (64, 64), color=color)
+    img_io = BytesIO()
+    img.save(img_io, format='JPEG')
+    upload = SimpleUploadedFile(name, img_io.getvalue(), content_type='image/jpeg')
+    return CropImage.objects.create(image=upload, submitted_by=user)
+
+
+@pytest.mark.django_db
+class TestBatchDiagnosisEngine:
+    def test_drain_processes_pending_in_batches(self, media_root):
+        from apps.diagnosis.engine import BatchDiagnosisEngine
+        from apps.diagnosis.models import CropImage, DiagnosisResult
+        
+        user = User.objects.create_user(email='batch@example.com', password='test')
+        for i in range(5):
+            create_crop_image(user, name=f'leaf{i}.jpg')
+        
+        engine = BatchDiagnosisEngine(batch_size=2, max_wait=0)
+        stats = engine.drain()
+        
+        assert [s['batch_size'] for s in stats] == [2, 2, 1]
+        assert all(s['images_per_second'] > 0 for s in stats)
+        assert DiagnosisResult.objects.count() == 5
+        assert not CropImage.objects.exclude(status='processed').exists()
+    
+    def test_unreadable_image_marked_failed(self, media_root):
+        from apps.diagnosis.engine import BatchDiagnosisEngine
+        from apps.diagnosis.models import CropImage, DiagnosisResult
+        
+        user = User.objects.create_user(email='batch@example.com', password='test')
+        good = create_crop_image(user)
+        bad = create_crop_image(user, name='broken.jpg')
+        bad.image.storage.delete(bad.image.name)
+        
+        stats = BatchDiagnosisEngine(batch_size=10, max_wait=0).drain()
+        
+        assert stats[0]['processed'] == 1
+        assert stats[0]['failed'] == 1
+        assert CropImage.objects.get(id=good.id).status == 'processed'
+        assert CropImage.objects.get(id=bad.id).status == 'failed'
+        assert DiagnosisResult.objects.count() == 1
+
+
+class TestClassifierRegistry:
+    def setup_method(self):
+        from apps.diagnosis import classifiers, metrics
+        classifiers.unload_all()
+        metrics.reset()
+    
+    def test_histogram_classifier_is_deterministic(self):
+        import numpy as np
+        from apps.diagnosis.classifiers import get_classifier
+        
+        green = np.zeros((1, 32, 32, 3), dtype=np.float32) + np.array([0.25, 0.55, 0.2], dtype=np.float32)
+        yellow = np.zeros((1, 32, 32, 3), dtype=np.float32) + np.array([0.75, 0.75, 0.3], dtype=np.float32)
+        batch = np.concatenate([green, yellow])
+        
+        classifier = get_classifier('v1.0-histogram')
+        first = classifier.predict(batch)
+        assert first == classifier.predict(batch)
+        assert first[0]['label'] == 'Healthy Crop'
+        assert first[1]['label'] == 'Nitrogen Deficiency'
+        assert all(0.0 < p['confidence'] <= 1.0 for p in first)
+    
+    def test_classifier_loaded_once_per_process(self):
+        import numpy as np
+        from apps.diagnosis import classifiers, metrics
+        
+        assert classifiers.get_classifier('v1.0-histogram') is classifiers.get_classifier('v1.0-histogram')
+        predictions = classifiers.predict(np.zeros((3, 16, 16, 3), dtype=np.float32), version='v1.0-histogram')
+        
+        assert [p['model_version'] for p in predictions] == ['v1.0-histogram'] * 3
+        snapshot = metrics.snapshot()
+        assert snapshot['timings']['classifier.cold_start_seconds.v1.0-histogram']['count'] == 1
+        assert snapshot['timings']['classifier.inference_seconds.v1.0-histogram']['count'] == 1
+        assert snapshot['counters']['classifier.images.v1.0-histogram'] == 3
+    
+    def test_cascade_records_answering_stage(self, settings):
+        import numpy as np
+        from apps.diagnosis import classifiers, metrics
+        
+        settings.DIAGNOSIS_CASCADE_THRESHOLD = 0.5
+        clear = np.zeros((1, 32, 32, 3), dtype=np.float32) + np.array([0.25, 0.55, 0.2], dtype=np.float32)
+        # Halfway between the healthy and aphids colours
+        ambiguous = np.zeros((1, 32, 32, 3), dtype=np.float32) + np.array([0.375, 0.575, 0.275], dtype=np.float32)
+        
+        predictions = classifiers.predict(np.concatenate([clear, ambiguous]), version='v1.0-cascade')
+        
+        assert predictions[0]['label'] == 'Healthy Crop'
+        assert predictions[0]['model_version'] == 'v1.0-cascade/v1.0-mean-colour'
+        assert predictions[1]['model_version'] == 'v1.0-cascade/v1.0-histogram'
+        assert predictions[1] == {
+            **classifiers.predict(ambiguous, version='v1.0-histogram')[0],
+            'model_version': 'v1.0-cascade/v1.0-histogram'
+        }
+        counters = metrics.snapshot()['counters']
+        assert counters['classifier.cascade.early_exits'] == 1
+        assert counters['classifier.cascade.full_model'] == 1
+
+
+@pytest.mark.django_db
+class TestPerceptualDedup:
+    def setup_method(self):
+        from apps.diagnosis import dedup, metrics
+        dedup.get_index().reset()
+        metrics.reset()
+    
+    def test_dhash_tolerates_small_changes(self):
+        from apps.diagnosis.dedup import dhash, hamming_distance
+        
+        def gradient(shift, direction=1):
+            img = Image.new('RGB', (120, 80))
+            img.putdata([(120 + direction * x + shift, 120, y * 3) for y in range(80) for x in range(120)])
+            img_io = BytesIO()
+            img.save(img_io, format='JPEG', quality=70 + shift)
+            img_io.seek(0)
+            return img_io
+        
+        original = dhash(gradient(0))
+        assert len(original) == 16
+        assert hamming_distance(original, dhash(gradient(1))) <= 4
+        assert hamming_distance(original, dhash(gradient(0, direction=-1))) > 4
+    
+    def test_repeat_upload_reuses_diagnosis(self, authenticated_user, settings, media_root):
+        from apps.diagnosis import metrics
+        from apps.diagnosis.models import DiagnosisResult
+        
+        settings.DIAGNOSIS_MODE = 'sync'
+        api_client, user = authenticated_user
+        
+        first = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        second = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        
+        assert second.data['status'] == 'processed'
+        first_result = DiagnosisResult.objects.get(crop_image_id=first.data['id'])
+        second_result = DiagnosisResult.objects.get(crop_image_id=second.data['id'])
+        assert second_result.predicted_label == first_result.predicted_label
+        assert second_result.model_version == first_result.model_version
+        counters = metrics.snapshot()['counters']
+        assert counters['dedup.hits'] == 1
+        assert counters['dedup.misses'] == 1
+    
+    def test_cascade_diagnoses_reused_across_stages(self, authenticated_user, settings, media_root):
+        from apps.diagnosis.models import DiagnosisResult
+        
+        settings.DIAGNOSIS_MODE = 'sync'
+        settings.DIAGNOSIS_MODEL_VERSION = 'v1.0-cascade'
+        api_client, user = authenticated_user
+        
+        first = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        second = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        
+        first_result = DiagnosisResult.objects.get(crop_image_id=first.data['id'])
+        second_result = DiagnosisResult.objects.get(crop_image_id=second.data['id'])
+        assert first_result.model_version.startswith('v1.0-cascade/')
+        assert second_result.model_version == first_result.model_version
+    
+    def test_index_evicts_oldest_beyond_max_entries(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.diagnosis.dedup import PerceptualHashIndex
+        
+        index = PerceptualHashIndex(max_entries=2, window=timedelta(hours=1))
+        now = timezone.now()
+        index.add(1, '00000000000000ff', 'v1', now - timedelta(hours=2))
+        index.add(2, '000000000000ff00', 'v1', now)
+        index.add(3, '0000000000ff0000', 'v1', now)
+        index.add(4, '00000000ff000000', 'v1', now)
+        index.evict()
+        
+        assert list(index.entries) == [3, 4]
+
+
+@pytest.mark.django_db
+class TestRecommendationCatalogue:
+    def test_results_share_catalogue_entry(self, authenticated_user, settings, media_root):
+        from apps.diagnosis.models import DiagnosisResult, RecommendationTemplate
+        
+        settings.DIAGNOSIS_MODE = 'sync'
+        settings.DIAGNOSIS_DEDUP_ENABLED = False
+        api_client, user = authenticated_user
+        
+        first = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        second = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        
+        results = DiagnosisResult.objects.filter(crop_image_id__in=[first.data['id'], second.data['id']])
+        assert len({r.recommendation_id for r in results}) == 1
+        assert RecommendationTemplate.objects.count() == 1
+        
+        inline = api_client.get(f"/api/diagnosis/upload/{first.data['id']}/result/")
+        template = RecommendationTemplate.objects.get()
+        assert inline.data['diagnosis_result']['recommendation'] == template.id
+        assert inline.data['diagnosis_result']['recommendations'] == template.content
+        
+        ref = api_client.get(f"/api/diagnosis/upload/{first.data['id']}/result/?recommendations=ref")
+        assert ref.data['diagnosis_result']['recommendation'] == template.id
+        assert 'recommendations' not in ref.data['diagnosis_result']
+    
+    def test_changed_content_publishes_new_version(self, monkeypatch):
+        from apps.diagnosis import recommendations
+        
+        first = recommendations.get_template('Leaf Blight', 'v1')
+        assert recommendations.get_template('Leaf Blight', 'v1') is first
+        
+        changed = dict(recommendations.RECOMMENDATIONS['Leaf Blight'], timeline='Within 10 days')
+        monkeypatch.setitem(recommendations.RECOMMENDATIONS, 'Leaf Blight', changed)
+        recommendations.clear_cache()
+        second = recommendations.get_template('Leaf Blight', 'v1')
+        
+        assert second.version == first.version + 1
+        assert second.content_hash != first.content_hash
+        assert recommendations.get_template('Unknown label', 'v1') is None
+    
+    def test_catalogue_served_with_etag(self, authenticated_user):
+        from apps.diagnosis import recommendations
+        
+        api_client, user = authenticated_user
+        template = recommendations.get_template('Healthy Crop', 'v1')
+        
+        response = api_client.get(f'/api/diagnosis/recommendations/{template.id}/')
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['content'] == template.content
+        assert response['ETag'] == f'"{template.content_hash}"'
+        assert 'immutable' in response['Cache-Control']
+        
+        cached = api_client.get(f'/api/diagnosis/recommendations/{template.id}/',
+                                HTTP_IF_NONE_MATCH=response['ETag'])
+        assert cached.status_code == status.HTTP_304_NOT_MODIFIED
+        
+        listing = api_client.get('/api/diagnosis/recommendations/')
+        assert [t['id'] for t in listing.data] == [template.id]
+        assert api_client.get('/api/diagnosis/recommendations/',
+                              HTTP_IF_NONE_MATCH=listing['ETag']).status_code == status.HTTP_304_NOT_MODIFIED
+
+
+@pytest.mark.django_db
+class TestProductIndex:
+    def create_products(self):
+        from decimal import Decimal
+        from apps.marketplace.models import Product, ProductCategory, Vendor
+        
+        vendor_user = User.objects.create_user(email='vendor@example.com', password='test', role='vendor')
+        vendor = Vendor.objects.create(user=vendor_user, business_name='Agro Supplies')
+        fungicides = ProductCategory.objects.create(name='Fungicides', slug='fungicides')
+        fertilizers = ProductCategory.objects.create(name='Fertilizers', slug='fertilizers')
+        
+        def create(title, category, price, stock=10):
+            return Product.objects.create(vendor=vendor, title=title, description=title, price=Decimal(price),
+                                          stock=stock, category=category)
+        
+        return {
+            'copper': create('Copper Fungicide 1L', fungicides, '900.00'),
+            'generic': create('Mancozeb 80WP', fungicides, '500.00'),
+            'sold_out': create('Copper Fungicide 5L', fungicides, '3000.00', stock=0),
+            'npk': create('NPK 20-10-10 Fertilizer', fertilizers, '2500.00'),
+        }
+    
+    def test_top_products_for_label(self):
+        from apps.diagnosis.products import top_products
+        
+        created = self.create_products()
+        
+        matches = top_products('Leaf Blight')
+        assert [m['id'] for m in matches] == [created['copper'].id, created['generic'].id]
+        assert matches[0]['price'] == created['copper'].price
+        assert [m['id'] for m in top_products('Nitrogen Deficiency')] == [created['npk'].id]
+        assert top_products('Healthy Crop') == []
+    
+    def test_index_follows_product_changes(self):
+        from apps.diagnosis.products import top_products
+        
+        created = self.create_products()
+        created['copper'].stock = 0
+        created['copper'].save()
+        created['sold_out'].stock = 4
+        created['sold_out'].save()
+        
+        assert [m['id'] for m in top_products('Leaf Blight')] == [created['sold_out'].id, created['generic'].id]
+    
+    def test_result_embeds_products(self, authenticated_user, settings, media_root):
+        from apps.diagnosis.models import CropImage, DiagnosisResult
+        
+        created = self.create_products()
+        api_client, user = authenticated_user
+        crop_image = create_crop_image(User.objects.get(id=user['id']))
+        CropImage.objects.filter(id=crop_image.id).update(status='processed')
+        DiagnosisResult.objects.create(crop_image=crop_image, predicted_label='Leaf Blight', confidence=0.9)
+        
+        response = api_client.get(f'/api/diagnosis/upload/{crop_image.id}/result/')
+        
+        products = response.data['diagnosis_result']['products']
+        assert [p['id'] for p in products] == [created['copper'].id, created['generic'].id]
+        assert products[0]['title'] == 'Copper Fungicide 1L'
+
+
+@pytest.mark.django_db
+class TestOutbreakRollup:
+    def create_farm_images(self, count, latitude='-1.286389', longitude='36.817223'):
+        from decimal import Decimal
+        from apps.diagnosis.models import CropImage
+        from apps.farms.models import Farm
+        
+        user = User.objects.create_user(email='rollup@example.com', password='test')
+        farm = Farm.objects.create(owner=user, name='Shamba', location='Nairobi',
+                                   latitude=Decimal(latitude), longitude=Decimal(longitude))
+        images = [create_crop_image(user, name=f'leaf{i}.jpg') for i in range(count)]
+        CropImage.objects.filter(id__in=[c.id for c in images]).update(farm=farm)
+        return user, images
+    
+    def test_rollup_updated_on_write(self, authenticated_user, media_root):
+        from apps.diagnosis.engine import BatchDiagnosisEngine
+        from apps.diagnosis.models import DiagnosisResult, OutbreakRollup
+        
+        self.create_farm_images(3)
+        BatchDiagnosisEngine(batch_size=2, max_wait=0).drain()
+        
+        rollup = OutbreakRollup.objects.get()
+        assert rollup.count == 3
+        assert (rollup.cell_row, rollup.cell_column) == (-13, 368)
+        assert not DiagnosisResult.objects.filter(in_rollup=False).exists()
+        
+        api_client, user = authenticated_user
+        response = api_client.get('/api/diagnosis/heatmap/', {'bbox': '-2,36,0,38'})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['tiles'] == [{
+            'label': rollup.label,
+            'latitude': -1.25,
+            'longitude': 36.85,
+            'count': 3,
+            'mean_confidence': round(rollup.confidence_sum / 3, 4),
+        }]
+        assert api_client.get('/api/diagnosis/heatmap/', {'bbox': '1,36,2,38'}).data['tiles'] == []
+        assert api_client.get('/api/diagnosis/heatmap/', {'start': 'soon'}).status_code == \
+            status.HTTP_400_BAD_REQUEST
+    
+    def test_backfill_counts_each_result_once(self, media_root):
+        from apps.diagnosis import analytics
+        from apps.diagnosis.models import DiagnosisResult, OutbreakRollup
+        
+        user, images = self.create_farm_images(5)
+        for crop_image in images:
+            DiagnosisResult.objects.create(crop_image=crop_image, predicted_label='Leaf Blight', confidence=0.8)
+        
+        assert analytics.backfill(chunk_size=2) == 5
+        assert analytics.backfill(chunk_size=2) == 0
+        assert OutbreakRollup.objects.get().count == 5
+        
+        analytics.reset(chunk_size=2)
+        assert not OutbreakRollup.objects.exists()
+        assert analytics.backfill() == 5
+        assert OutbreakRollup.objects.get().count == 5
+
+
+@pytest.mark.django_db
+class TestImageArchiving:
+    def create_old_diagnoses(self, count, names=None):
+        from datetime import timedelta
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.utils import timezone
+        from apps.diagnosis.models import CropImage, DiagnosisResult
+        from apps.diagnosis.synthetic import generate_crop_image
+        
+        user = User.objects.create_user(email='archive@example.com', password='test')
+        images = []
+        for i, name in enumerate(names or [f'leaf{i}.jpg' for i in range(count)]):
+            data = generate_crop_image(640, 480, seed=i)
+            if name.endswith('.png'):
+                png = BytesIO()
+                Image.open(BytesIO(data)).save(png, format='PNG')
+                data = png.getvalue()
+            upload = SimpleUploadedFile(name, data)
+            crop_image = CropImage.objects.create(image=upload, submitted_by=user, status='processed')
+            DiagnosisResult.objects.create(crop_image=crop_image, predicted_label='Leaf Blight', confidence=0.9)
+            images.append(crop_image)
+        DiagnosisResult.objects.update(processed_at=timezone.now() - timedelta(days=60))
+        return images
+    
+    def test_originals_move_to_bundles(self, authenticated_user, media_root):
+        from django.core.files.storage import default_storage
+        from apps.diagnosis.lifecycle import ImageArchiver
+        from apps.diagnosis.models import ArchiveBundle, CropImage
+        
+        images = self.create_old_diagnoses(3)
+        originals = [c.image.name for c in images]
+        
+        report = ImageArchiver(older_than_days=30, bundle_bytes=1, max_bytes_per_second=0).run()
+        
+        assert report['images'] == 3
+        assert report['bundles'] == ArchiveBundle.objects.count() == 3
+        assert report['reencoded'] == 3
+        assert report['bytes_reclaimed'] > 0
+        assert not any(default_storage.exists(name) for name in originals)
+        
+        archived = CropImage.objects.get(id=images[0].id)
+        assert archived.image.name == 'archive/crop_images/leaf0.jpg.webp'
+        with archived.image.open('rb') as image_file:
+            assert Image.open(image_file).format == 'WEBP'
+        
+        api_client, user = authenticated_user
+        response = api_client.get(archived.image.url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response['Content-Type'] == 'image/webp'
+        assert api_client.get(archived.image.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+    
+    def test_archiving_resumes_where_it_stopped(self, media_root):
+        from apps.diagnosis.lifecycle import ImageArchiver
+        from apps.diagnosis.models import CropImage
+        
+        self.create_old_diagnoses(3)
+        
+        assert ImageArchiver(older_than_days=90, max_bytes_per_second=0).candidates(0) == []
+        assert ImageArchiver(older_than_days=30, max_bytes_per_second=0).run(limit=2)['images'] == 2
+        assert ImageArchiver(older_than_days=30, max_bytes_per_second=0).run()['images'] == 1
+        assert ImageArchiver(older_than_days=30, max_bytes_per_second=0).run()['images'] == 0
+        assert not CropImage.objects.filter(archived_at__isnull=True).exists()
+    
+    def test_originals_sharing_a_stem_archive_separately(self, media_root):
+        from apps.diagnosis.lifecycle import ImageArchiver
+        from apps.diagnosis.models import ArchivedFile, CropImage
+        
+        self.create_old_diagnoses(2, names=['leaf.jpg', 'leaf.png'])
+        
+        assert ImageArchiver(older_than_days=30, max_bytes_per_second=0).run()['images'] == 2
+        assert sorted(CropImage.objects.values_list('image', flat=True)) == [
+            'archive/crop_images/leaf.jpg.webp', 'archive/crop_images/leaf.png.webp'
+        ]
+        assert ArchivedFile.objects.count() == 2
+    
+    def test_colliding_entry_is_skipped_not_the_bundle(self, media_root):
+        from apps.diagnosis.lifecycle import ImageArchiver, archived_name
+        from apps.diagnosis.models import ArchiveBundle, ArchivedFile, CropImage
+        
+        images = self.create_old_diagnoses(3)
+        taken = archived_name(images[1].image.name, webp=True)
+        bundle = ArchiveBundle.objects.create(name='archive/bundles/old.pack', size=1, file_count=1)
+        ArchivedFile.objects.create(name=taken, bundle=bundle, offset=0, length=1, sha256='0' * 64, original_size=1)
+        
+        report = ImageArchiver(older_than_days=30, max_bytes_per_second=0).run()
+        
+        assert (report['images'], report['skipped']) == (2, 1)
+        assert list(CropImage.objects.filter(archived_at__isnull=True).values_list('id', flat=True)) == [images[1].id]
+    
+    def test_archived_entries_are_read_with_a_ranged_get_on_s3(self):
+        from apps.diagnosis.storage import read_range
+        
+        class Bucket:
+            def __init__(self):
+                self.requests = []
+            
+            def Object(self, key):
+                bucket = self
+                
+                class S3Object:
+                    def get(self, Range):
+                        bucket.requests.append((key, Range))
+                        return {'Body': BytesIO(b'entry')}
+                return S3Object()
+        
+        class S3Storage:
+            bucket = Bucket()
+            
+            def _normalize_name(self, name):
+                return f'media/{name}'
+            
+            def open(self, name, mode='rb'):
+                raise AssertionError('the whole bundle was opened')
+        
+        storage = S3Storage()
+        
+        assert read_range(storage, 'archive_bundles/b1.pack', 1000, 5) == b'entry'
+        assert storage.bucket.requests == [('media/archive_bundles/b1.pack', 'bytes=1000-1004')]
+    
+    def test_scheduled_archiving_runs_on_the_maintenance_queue(self, settings):
+        from digi_farm.celery import app
+        
+        route = app.amqp.router.route({}, 'apps.diagnosis.tasks.archive_old_images')
+        assert route['queue'].name == settings.MAINTENANCE_QUEUE
+        assert app.amqp.router.route({}, 'apps.diagnosis.tasks.diagnose_image')['queue'].name == settings.DIAGNOSIS_QUEUE
+        entry = settings.CELERY_BEAT_SCHEDULE['archive-old-crop-images']
+        assert entry['kwargs']['max_seconds'] < settings.CELERY_TASK_TIME_LIMIT
+    
+    def test_archiving_leaves_a_lock_it_does_not_own(self, media_root, monkeypatch):
+        from django.core.cache import cache
+        from apps.diagnosis import lifecycle
+        
+        def run_past_the_lease(archiver, limit=None, max_seconds=None):
+            cache.set(lifecycle.LOCK_KEY, 'another-run', 60)
+            return {}
+        
+        monkeypatch.setattr(lifecycle.ImageArchiver, 'run', run_past_the_lease)
+        
+        assert lifecycle.archive_old_images() == {}
+        assert cache.get(lifecycle.LOCK_KEY) == 'another-run'
+        cache.delete(lifecycle.LOCK_KEY)
+
+
+@pytest.mark.django_db
+class TestIngestPipeline:
+    def test_upload_stores_thumbnail_and_tensor(self, authenticated_user, settings, media_root):
+        import numpy as np
+        from apps.diagnosis.models import CropImage
+        from apps.diagnosis.preprocessing import MODEL_INPUT_SIZE, preprocess_image
+        from apps.diagnosis.synthetic import generate_crop_image
+        
+        settings.DIAGNOSIS_MODE = 'sync'
+        api_client, user = authenticated_user
+        
+        upload = BytesIO(generate_crop_image(1600, 1200))
+        upload.name = 'field.jpg'
+        response = api_client.post('/api/diagnosis/upload/', {'image': upload}, format='multipart')
+        
+        crop_image = CropImage.objects.get(id=response.data['id'])
+        assert crop_image.image_hash
+        thumbnail = Image.open(crop_image.thumbnail.path)
+        assert max(thumbnail.size) == settings.DIAGNOSIS_THUMBNAIL_SIZE
+        
+        array = preprocess_image(crop_image)
+        assert array.shape == (MODEL_INPUT_SIZE[1], MODEL_INPUT_SIZE[0], 3)
+        assert array.dtype == np.float32
+    
+    def test_upload_rejects_oversized_image(self, authenticated_user, settings, media_root):
+        settings.DIAGNOSIS_MAX_IMAGE_PIXELS = 50 * 50
+        api_client, user = authenticated_user
+        
+        response = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert 'image' in response.data
+
+
+@pytest.mark.django_db(transaction=True)
+class TestProcessPoolWorker:
+    def test_worker_drains_pending_images(self, media_root):
+        from apps.diagnosis.models import CropImage, DiagnosisResult
+        from apps.diagnosis.worker import ProcessPoolDiagnosisWorker
+        
+        user = User.objects.create_user(email='pool@example.com', password='test')
+        for i, color in enumerate(['green', 'yellow', 'brown', 'green', 'olive']):
+            create_crop_image(user, name=f'leaf{i}.jpg', color=color)
+        broken = create_crop_image(user, name='broken.jpg')
+        broken.image.storage.delete(broken.image.name)
+        
+        summary = ProcessPoolDiagnosisWorker(workers=2, batch_size=4).run(once=True)
+        
+        assert summary['images'] == 6
+        assert summary['images_per_second'] > 0
+        assert set(summary['stage_utilisation']) == {'io', 'decode', 'inference', 'write'}
+        assert DiagnosisResult.objects.count() == 5
+        assert CropImage.objects.get(id=broken.id).status == 'failed'
+        assert not CropImage.objects.filter(status__in=['pending', 'processing']).exists()
+    
+    def test_released_batch_drops_its_claim(self, media_root):
+        from concurrent.futures import Future
+        from apps.diagnosis.engine import claim_pending
+        from apps.diagnosis.models import CropImage
+        from apps.diagnosis.worker import ProcessPoolDiagnosisWorker
+        
+        user = User.objects.create_user(email='pool@example.com', password='test')
+        create_crop_image(user)
+        prefetched = Future()
+        prefetched.set_result({'crop_images': claim_pending(1)})
+        
+        ProcessPoolDiagnosisWorker(workers=1).release(prefetched)
+        
+        assert list(CropImage.objects.values_list('status', 'claimed_at')) == [('pending', None)]
+
+
+@pytest.mark.django_db
+class TestDiagnosisClaiming:
+    def test_duplicate_delivery_is_skipped(self, media_root):
+        from apps.diagnosis.models import DiagnosisResult
+        from apps.diagnosis.tasks import diagnose_image
+        
+        user = User.objects.create_user(email='claim@example.com', password='test')
+        crop_image = create_crop_image(user)
+        
+        first = diagnose_image.apply(args=[crop_image.id]).get()
+        second = diagnose_image.apply(args=[crop_image.id]).get()
+        
+        assert first['status'] == 'success'
+        assert second == {'crop_image_id': crop_image.id, 'status': 'skipped', 'reason': 'already processed'}
+        assert DiagnosisResult.objects.filter(crop_image=crop_image).count() == 1
+    
+    def test_claims_are_exclusive(self, media_root):
+        from apps.diagnosis.engine import claim_image, claim_pending
+        
+        user = User.objects.create_user(email='claim@example.com', password='test')
+        images = [create_crop_image(user, name=f'leaf{i}.jpg') for i in range(3)]
+        
+        assert claim_image(images[0].id)
+        assert not claim_image(images[0].id)
+        claimed = claim_pending(10)
+        assert sorted(c.id for c in claimed) == sorted(c.id for c in images[1:])
+        assert claim_pending(10) == []
+    
+    def test_reaper_resets_stuck_images(self, media_root, settings):
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.diagnosis.models import CropImage
+        from apps.diagnosis.tasks import reap_stuck_diagnoses
+        
+        settings.DIAGNOSIS_MODE = 'sync'
+        user = User.objects.create_user(email='claim@example.com', password='test')
+        stuck = create_crop_image(user, name='stuck.jpg')
+        active = create_crop_image(user, name='active.jpg')
+        CropImage.objects.filter(id=stuck.id).update(
+            status='processing', claimed_at=timezone.now() - timedelta(hours=1)
+        )
+        CropImage.objects.filter(id=active.id).update(status='processing', claimed_at=timezone.now())
+        
+        assert reap_stuck_diagnoses(timeout_minutes=10) == 1
+        assert CropImage.objects.get(id=stuck.id).status == 'pending'
+        assert CropImage.objects.get(id=active.id).status == 'processing'
+
+
+@pytest.mark.django_db
+class TestAdmissionControl:
+    def test_token_bucket_absorbs_burst_then_throttles(self, authenticated_user, settings, media_root):
+        settings.DIAGNOSIS_MODE = 'sync'
+        settings.DIAGNOSIS_ADMISSION_BURST = 2
+        settings.DIAGNOSIS_ADMISSION_RATE = 6  # one token every 10 seconds
+        api_client, user = authenticated_user
+        
+        responses = [
+            api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+            for _ in range(3)
+        ]
+        
+        assert [r.status_code for r in responses] == [201, 201, 429]
+        assert 1 <= int(responses[2]['Retry-After']) <= 10
+        # Reads are not admission controlled
+        assert api_client.get('/api/diagnosis/upload/').status_code == 200
+    
+    def test_shared_token_bucket_script_admits_a_burst_once(self):
+        import threading
+        from django.core.cache.backends.redis import RedisCache
+        from apps.diagnosis.admission import TokenBucket
+        
+        fakeredis = pytest.importorskip('fakeredis')
+        pytest.importorskip('lupa')  # fakeredis runs Lua scripts through lupa
+        backend = RedisCache('redis://localhost:6379/0', {
+            'OPTIONS': {'connection_class': fakeredis.FakeConnection, 'server': fakeredis.FakeServer()},
+        })
+        bucket = TokenBucket('diagnosis:test:bucket', rate=0.01, capacity=5)
+        barrier = threading.Barrier(20)
+        waits = []
+        
+        def take():
+            barrier.wait()
+            waits.append(bucket.take_shared(backend))
+        
+        threads = [threading.Thread(target=take) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert waits.count(0) == 5
+        assert all(95 < wait <= 100 for wait in waits if wait)
+    
+    def test_fair_queueing_interleaves_users(self, media_root):
+        from apps.diagnosis import admission
+        from apps.diagnosis.engine import claim_pending
+        from apps.diagnosis.models import CropImage
+        
+        busy = User.objects.create_user(email='busy@example.com', password='test')
+        other = User.objects.create_user(email='other@example.com', password='test')
+        admin = User.objects.create_user(email='admin@example.com', password='test', role='admin')
+        
+        def upload(user, name):
+            # Tagged before the row exists, as in the upload view
+            tag = admission.fair_tag(user)
+            crop_image = create_crop_image(user, name=name)
+            CropImage.objects.filter(id=crop_image.id).update(fair_tag=tag)
+            return crop_image
+        
+        burst = [upload(busy, f'busy{i}.jpg') for i in range(4)]
+        late = upload(other, 'other.jpg')
+        weighted = [upload(admin, f'admin{i}.jpg') for i in range(2)]
+        
+        claimed = {c.id for c in claim_pending(5)}
+        # Later users overtake the rest of the burst; the admin's weight of 2
+        # fits both of their images into the first two rounds
+        assert claimed == {burst[0].id, burst[1].id, late.id, weighted[0].id, weighted[1].id}
+        assert set(CropImage.objects.filter(status='pending').values_list('id', flat=True)) == {
+            burst[2].id, burst[3].id
+        }
+    
+    def test_sheds_load_with_retry_after_from_backlog(self, authenticated_user, settings, media_root):
+        settings.DIAGNOSIS_MODE = 'async'
+        settings.DIAGNOSIS_MAX_QUEUE_SECONDS = 1
+        settings.DIAGNOSIS_MAX_CONCURRENCY = 1  # assumed 1 image/sec with nothing measured
+        api_client, user = authenticated_user
+        for i in range(5):
+            create_crop_image(User.objects.get(id=user['id']), name=f'queued{i}.jpg')
+        
+        response = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        
+        assert response.status_code == 503
+        assert response['Retry-After'] == '4'
+    
+    def test_sync_inference_slots_are_global(self, authenticated_user, settings, media_root):
+        from apps.diagnosis import admission
+        
+        settings.DIAGNOSIS_MODE = 'sync'
+        settings.DIAGNOSIS_MAX_CONCURRENCY = 1
+        api_client, user = authenticated_user
+        
+        slot = admission.acquire_slot()
+        busy = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        admission.release_slot(slot)
+        accepted = api_client.post('/api/diagnosis/upload/', {'image': create_test_image()}, format='multipart')
+        
+        assert busy.status_code == 503
+        assert 'Retry-After' in busy
+        assert accepted.status_code == 201
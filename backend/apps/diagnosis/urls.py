@@ -1,11 +1,14 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import CropImageViewSet
+from .views import CropImageViewSet, RecommendationTemplateViewSet, archived_image, outbreak_heatmap
 
 router = DefaultRouter()
 router.register(r'upload', CropImageViewSet, basename='diagnosis')
+router.register(r'recommendations', RecommendationTemplateViewSet, basename='recommendation')
 
 urlpatterns = [
+    path('heatmap/', outbreak_heatmap, name='outbreak-heatmap'),
+    path('archive/<path:name>', archived_image, name='archived-image'),
     path('', include(router.urls)),
 ]
 
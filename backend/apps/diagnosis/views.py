@@ -1,18 +1,54 @@
+import json
+import time
+import mimetypes
+import hashlib
+import logging
+from datetime import date, timedelta
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.http import require_GET
 from rest_framework import viewsets, status
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
 from rest_framework.throttling import UserRateThrottle
-from .models import CropImage, DiagnosisResult
-from .serializers import CropImageSerializer, DiagnosisResultSerializer, DiagnosisDetailSerializer
-from .tasks import diagnose_image, mock_crop_diagnosis
-from .models import DiagnosisResult
+from rest_framework.utils.encoders import JSONEncoder
+from . import admission, analytics, metrics, recommendations
+from .admission import DiagnosisThrottle
+from .engine import build_diagnoses, save_diagnoses
+from .models import CropImage, RecommendationTemplate
+from .serializers import (
+    CropImageSerializer, DiagnosisResultSerializer, DiagnosisDetailSerializer, RecommendationTemplateSerializer
+)
+from .storage import ARCHIVE_PREFIX, read_archived
+from .tasks import enqueue_diagnosis, queue_depth
 
+logger = logging.getLogger(__name__)
 
-class DiagnosisThrottle(UserRateThrottle):
-    """Custom throttle for diagnosis uploads."""
-    rate = '100/hour'
+TERMINAL_STATUSES = ('processed', 'failed')
+
+
+def format_event(event, data, retry=None):
+    """Format a Server-Sent Event; retry (seconds) sets the client's reconnection delay."""
+    prefix = f'retry: {retry * 1000}\n' if retry else ''
+    return f'{prefix}event: {event}\ndata: {json.dumps(data, cls=JSONEncoder)}\n\n'
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets clients request the result action with Accept: text/event-stream."""
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+    
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Only non-streaming responses (e.g. 404s) are rendered here
+        return format_event('error', data)
 
 
 class CropImageViewSet(viewsets.ModelViewSet):
@@ -21,7 +57,9 @@ class CropImageViewSet(viewsets.ModelViewSet):
     serializer_class = CropImageSerializer
     permission_classes = [IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser]
-    # throttle_classes = [DiagnosisThrottle]
+    # Uploads also pass the per-user token bucket (see admission)
+    throttle_classes = [UserRateThrottle, DiagnosisThrottle]
+    poll_interval = 0.5  # seconds between status checks when long-polling
     
     def get_serializer_class(self):
         if self.action == 'retrieve':
@@ -32,48 +70,250 @@ class CropImageViewSet(viewsets.ModelViewSet):
         # Users can only see their own diagnoses
         return self.queryset.filter(submitted_by=self.request.user)
     
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        # ?recommendations=ref returns catalogue ids instead of inline content
+        context['recommendations'] = self.request.query_params.get('recommendations', 'inline')
+        return context
+    
+    def create(self, request, *args, **kwargs):
+        if settings.DIAGNOSIS_MODE == 'async':
+            admission.check_capacity()
+            response = super().create(request, *args, **kwargs)
+            # Upload accepted, diagnosis will complete in the background
+            response.status_code = status.HTTP_202_ACCEPTED
+            return response
+        
+        # Sync mode runs inference in the request, so hold an inference slot
+        slot = admission.acquire_slot()
+        try:
+            return super().create(request, *args, **kwargs)
+        finally:
+            admission.release_slot(slot)
+    
     def perform_create(self, serializer):
-        crop_image = serializer.save()
+        crop_image = serializer.save(fair_tag=admission.fair_tag(self.request.user))
         
-        # DEMO MODE: Process synchronously to avoid needing Celery worker
+        if settings.DIAGNOSIS_MODE == 'async':
+            enqueue_diagnosis(crop_image)
+            return crop_image
+        
+        # Sync mode: diagnose inside the request so no Celery worker is needed
         try:
-             result = mock_crop_diagnosis(crop_image)
-             DiagnosisResult.objects.create(
-                crop_image=crop_image,
-                predicted_label=result['label'],
-                confidence=result['confidence'],
-                recommendations=result['recommendations'],
-                model_version='v1.0-mock'
-             )
-             crop_image.status = 'processed'
-             crop_image.save()
+            diagnoses, _, failed = build_diagnoses([crop_image])
+            if failed:
+                raise ValueError('Image could not be preprocessed')
+            save_diagnoses(diagnoses, [crop_image], [])
+            crop_image.status = 'processed'
         except Exception as e:
-             # Fallback to async if needed, or log error
-             pass
-
+            logger.error(f'Synchronous diagnosis failed for CropImage {crop_image.id}: {str(e)}')
+            crop_image.status = 'failed'
+        crop_image.save()
+        
         return crop_image
     
-    @action(detail=True, methods=['get'], url_path='result')
+    def get_wait_seconds(self, request):
+        """Long-poll timeout from ?wait=<seconds>, capped at DIAGNOSIS_RESULT_MAX_WAIT."""
+        try:
+            wait = float(request.query_params.get('wait', 0))
+        except ValueError:
+            return 0
+        return max(0, min(wait, settings.DIAGNOSIS_RESULT_MAX_WAIT))
+    
+    def wait_for_result(self, crop_image, timeout):
+        """Block until the diagnosis reaches a terminal status or the timeout expires."""
+        deadline = time.monotonic() + timeout
+        while crop_image.status not in TERMINAL_STATUSES and time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            crop_image.refresh_from_db(fields=['status'])
+        return crop_image
+    
+    def result_response(self, crop_image):
+        if crop_image.status == 'processed' and hasattr(crop_image, 'diagnosis_result'):
+            serializer = DiagnosisDetailSerializer(crop_image, context=self.get_serializer_context())
+            return Response(serializer.data)
+        elif crop_image.status == 'failed':
+            return Response(
+                {'error': 'Diagnosis processing failed. Please try uploading again.'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        else:
+            # Waits are kept short so clients do not hold web workers; they poll again
+            return Response(
+                {'status': crop_image.status, 'job_id': crop_image.job_id,
+                 'message': 'Diagnosis is still being processed.'},
+                status=status.HTTP_202_ACCEPTED,
+                headers={'Retry-After': str(settings.DIAGNOSIS_RESULT_RETRY_AFTER)}
+            )
+    
+    def event_stream(self, crop_image, timeout):
+        """Yield status events until the diagnosis finishes or the timeout expires."""
+        deadline = time.monotonic() + timeout
+        last_status = None
+        while True:
+            if crop_image.status != last_status:
+                last_status = crop_image.status
+                yield format_event('status', {'id': crop_image.id, 'status': crop_image.status})
+            
+            if crop_image.status in TERMINAL_STATUSES:
+                if crop_image.status == 'processed':
+                    serializer = DiagnosisDetailSerializer(crop_image, context=self.get_serializer_context())
+                    yield format_event('result', serializer.data)
+                return
+            if time.monotonic() >= deadline:
+                # EventSource reconnects after retry and resumes from the current status
+                yield format_event('timeout', {'id': crop_image.id, 'status': crop_image.status},
+                                   retry=settings.DIAGNOSIS_RESULT_RETRY_AFTER)
+                return
+            
+            time.sleep(self.poll_interval)
+            crop_image.refresh_from_db(fields=['status'])
+    
+    @action(detail=True, methods=['get'], url_path='result',
+            renderer_classes=list(api_settings.DEFAULT_RENDERER_CLASSES) + [EventStreamRenderer])
     def result(self, request, pk=None):
-        """Get diagnosis result for a specific crop image."""
+        """
+        Get diagnosis result for a specific crop image.
+        
+        Pass ?wait=<seconds> to long-poll until the diagnosis finishes, or
+        request text/event-stream (or ?stream=true) to receive status
+        updates as Server-Sent Events. Both hold a web worker, so they end
+        after at most DIAGNOSIS_RESULT_MAX_WAIT seconds; an unfinished
+        result then tells the client when to ask again (Retry-After, or the
+        SSE retry field).
+        """
         try:
             crop_image = self.get_object()
-            if crop_image.status == 'processed' and hasattr(crop_image, 'diagnosis_result'):
-                serializer = DiagnosisDetailSerializer(crop_image)
-                return Response(serializer.data)
-            elif crop_image.status == 'failed':
-                return Response(
-                    {'error': 'Diagnosis processing failed. Please try uploading again.'},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-            else:
-                return Response(
-                    {'status': crop_image.status, 'message': 'Diagnosis is still being processed.'},
-                    status=status.HTTP_202_ACCEPTED
-                )
         except CropImage.DoesNotExist:
             return Response(
                 {'error': 'Crop image not found'},
                 status=status.HTTP_404_NOT_FOUND
             )
+        
+        if request.accepted_renderer.format == 'sse' or request.query_params.get('stream') == 'true':
+            response = StreamingHttpResponse(
+                self.event_stream(crop_image, settings.DIAGNOSIS_RESULT_MAX_WAIT),
+                content_type='text/event-stream'
+            )
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+        
+        wait = self.get_wait_seconds(request)
+        if wait:
+            crop_image = self.wait_for_result(crop_image, wait)
+        return self.result_response(crop_image)
+    
+    @action(detail=False, methods=['get'], url_path='metrics', permission_classes=[IsAdminUser])
+    def metrics_summary(self, request):
+        """Classifier latency metrics for this process and the diagnosis queue depth."""
+        data = metrics.snapshot()
+        data['queue'] = queue_depth()
+        return Response(data)
+
+
+def not_modified(request, etag):
+    """True when the client's If-None-Match already contains etag."""
+    return etag in parse_etags(request.headers.get('If-None-Match', ''))
+
+
+class RecommendationTemplateViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Recommendation catalogue referenced by diagnosis results.
+    
+    Templates never change once published, so a template is served with its
+    content hash as a long-lived ETag. The list is revalidated on every use.
+    """
+    queryset = RecommendationTemplate.objects.all()
+    serializer_class = RecommendationTemplateSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = None
+    max_age = 365 * 24 * 60 * 60
+    
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        versions = ','.join(f'{pk}:{digest}' for pk, digest in queryset.values_list('id', 'content_hash'))
+        etag = quote_etag(hashlib.sha256(versions.encode()).hexdigest())
+        if not_modified(request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(self.get_serializer(queryset, many=True).data)
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    
+    def retrieve(self, request, pk=None):
+        try:
+            template = recommendations.get_cached(int(pk))
+        except ValueError:
+            template = None
+        if template is None:
+            return Response({'error': 'Recommendation not found'}, status=status.HTTP_404_NOT_FOUND)
+        
+        etag = quote_etag(template.content_hash)
+        if not_modified(request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(self.get_serializer(template).data)
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, max_age=self.max_age, immutable=True)
+        return response
 
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def outbreak_heatmap(request):
+    """
+    Diagnosis counts per label and grid cell for a time window.
+    
+    Query parameters: start and end (YYYY-MM-DD, default the last 7 days),
+    label, and bbox=south,west,north,east to limit the area.
+    """
+    params = request.query_params
+    try:
+        end = date.fromisoformat(params['end']) if params.get('end') else timezone.localdate()
+        start = date.fromisoformat(params['start']) if params.get('start') else end - timedelta(days=6)
+        bounds = None
+        if params.get('bbox'):
+            bounds = [float(value) for value in params['bbox'].split(',')]
+            if len(bounds) != 4:
+                raise ValueError('bbox needs four values')
+    except ValueError as e:
+        return Response({'error': f'Invalid parameters: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if start > end or (end - start).days >= settings.DIAGNOSIS_HEATMAP_MAX_DAYS:
+        return Response(
+            {'error': f'The window must be between 1 and {settings.DIAGNOSIS_HEATMAP_MAX_DAYS} days'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    return Response({
+        'start': start,
+        'end': end,
+        'cell_degrees': settings.DIAGNOSIS_HEATMAP_CELL_DEGREES,
+        'tiles': analytics.heatmap(start, end, label=params.get('label'), bounds=bounds),
+    })
+
+
+@require_GET
+def archived_image(request, name):
+    """
+    Serve an archived crop image from its bundle.
+    
+    This is the URL TieredStorage gives archived images, so image.url keeps
+    working after archiving. Archived files never change.
+    """
+    try:
+        entry, data = read_archived(ARCHIVE_PREFIX + name)
+    except FileNotFoundError:
+        raise Http404('Archived image not found')
+    
+    etag = quote_etag(entry.sha256)
+    if not_modified(request, etag):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        response = HttpResponse(data, content_type=content_type)
+    response['ETag'] = etag
+    patch_cache_control(response, max_age=RecommendationTemplateViewSet.max_age, immutable=True)
+    return response
@@ -0,0 +1,272 @@
+"""
+Process-pool diagnosis worker for CPU-bound inference.
+
+The worker runs two overlapped stages:
+
+* an I/O stage (one thread) that claims the next batch of pending
+  CropImages, applies deduplication and reads their bytes from storage,
+* a CPU stage that decodes and classifies the current batch in parallel on
+  a ProcessPoolExecutor.
+
+Decoded arrays are handed from the decode step to the inference step through
+a shared-memory block, so image data is never pickled between processes.
+Results are written with the same bulk queries as the batch engine.
+"""
+import os
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from django.conf import settings
+from django.db import connections
+from . import classifiers, dedup
+from .engine import BatchDiagnosisEngine, save_diagnoses
+from .models import CropImage, DiagnosisResult
+from .preprocessing import MODEL_INPUT_SIZE, decode_payload, read_payload
+from .recommendations import get_template
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('io', 'decode', 'inference', 'write')
+
+
+def _init_worker():
+    """Load classifiers once in each pool process."""
+    classifiers.warm_up()
+
+
+def _decode_chunk(shm_name, shape, start, payloads):
+    """
+    Decode payloads into rows [start, start + len(payloads)) of the shared batch.
+
+    Returns:
+        tuple (busy seconds, list of row indices that failed to decode)
+    """
+    started = time.perf_counter()
+    failed = []
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        batch = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        for offset, (kind, data) in enumerate(payloads):
+            try:
+                batch[start + offset] = decode_payload(kind, data)
+            except Exception:
+                failed.append(start + offset)
+        del batch
+    finally:
+        shm.close()
+    return time.perf_counter() - started, failed
+
+
+def _predict_chunk(shm_name, shape, start, stop, version):
+    """
+    Classify rows [start, stop) of the shared batch.
+
+    Returns:
+        tuple (busy seconds, list of predictions)
+    """
+    started = time.perf_counter()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        batch = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        predictions = classifiers.predict(batch[start:stop], version=version)
+        del batch
+    finally:
+        shm.close()
+    return time.perf_counter() - started, predictions
+
+
+class ProcessPoolDiagnosisWorker:
+    """
+    Long-running diagnosis worker using every CPU core.
+
+    Args:
+        workers: Number of pool processes (defaults to the CPU count)
+        batch_size: Images claimed per batch
+        version: Model version to run (defaults to DIAGNOSIS_MODEL_VERSION)
+    """
+
+    def __init__(self, workers=None, batch_size=None, version=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.version = version or settings.DIAGNOSIS_MODEL_VERSION
+        self.engine = BatchDiagnosisEngine(batch_size=batch_size, max_wait=0)
+        self.images = 0
+        self.started = None
+        self.wall = dict.fromkeys(STAGES, 0.0)
+        self.busy = dict.fromkeys(STAGES, 0.0)
+
+    def chunks(self, n):
+        """Split n rows into at most one contiguous chunk per pool process."""
+        size = -(-n // self.workers)
+        return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+    def fetch_batch(self):
+        """I/O stage: claim pending images, reuse duplicates and read image bytes."""
+        started = time.perf_counter()
+        crop_images = self.engine.collect_batch()
+        reused, remaining = dedup.reuse_diagnoses(crop_images, self.version)
+
+        readable, payloads, failed = [], [], []
+        for crop_image in remaining:
+            try:
+                payloads.append(read_payload(crop_image))
+                readable.append(crop_image)
+            except Exception as e:
+                logger.warning(f'Failed to read CropImage {crop_image.id}: {str(e)}')
+                failed.append(crop_image)
+
+        elapsed = time.perf_counter() - started
+        self.wall['io'] += elapsed
+        self.busy['io'] += elapsed
+        return {
+            'crop_images': crop_images,
+            'reused': reused,
+            'readable': readable,
+            'payloads': payloads,
+            'failed': failed,
+        }
+
+    def run_stage(self, pool, stage, function, argument_sets):
+        """Run one CPU stage across the pool and record its utilisation."""
+        started = time.perf_counter()
+        futures = [pool.submit(function, *arguments) for arguments in argument_sets]
+        results = [future.result() for future in futures]
+        self.wall[stage] += time.perf_counter() - started
+        self.busy[stage] += sum(busy for busy, _ in results)
+        return [result for _, result in results]
+
+    def infer(self, pool, payloads):
+        """
+        CPU stage: decode and classify payloads in parallel.
+
+        Returns:
+            tuple (predictions by row, set of rows that failed to decode)
+        """
+        shape = (len(payloads), MODEL_INPUT_SIZE[1], MODEL_INPUT_SIZE[0], 3)
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+        try:
+            chunks = self.chunks(len(payloads))
+            decode_results = self.run_stage(pool, 'decode', _decode_chunk, [
+                (shm.name, shape, start, payloads[start:stop]) for start, stop in chunks
+            ])
+            predict_results = self.run_stage(pool, 'inference', _predict_chunk, [
+                (shm.name, shape, start, stop, self.version) for start, stop in chunks
+            ])
+        finally:
+            shm.close()
+            shm.unlink()
+
+        failed_rows = {row for rows in decode_results for row in rows}
+        predictions = [prediction for chunk in predict_results for prediction in chunk]
+        return predictions, failed_rows
+
+    def process(self, pool, batch):
+        """Run the CPU stage for a fetched batch and write the results."""
+        diagnoses = list(batch['reused'])
+        loaded = [d.crop_image for d in diagnoses]
+        failed = list(batch['failed'])
+
+        if batch['payloads']:
+            predictions, failed_rows = self.infer(pool, batch['payloads'])
+            for row, (crop_image, prediction) in enumerate(zip(batch['readable'], predictions)):
+                if row in failed_rows:
+                    failed.append(crop_image)
+                    continue
+                loaded.append(crop_image)
+                diagnoses.append(DiagnosisResult(
+                    crop_image=crop_image,
+                    predicted_label=prediction['label'],
+                    confidence=prediction['confidence'],
+                    recommendation=get_template(prediction['label'], prediction['model_version']),
+                    model_version=prediction['model_version']
+                ))
+
+        started = time.perf_counter()
+        save_diagnoses(diagnoses, loaded, failed)
+        elapsed = time.perf_counter() - started
+        self.wall['write'] += elapsed
+        self.busy['write'] += elapsed
+
+        self.images += len(batch['crop_images'])
+        logger.info(
+            f"Diagnosis worker batch: {len(loaded)} processed, {len(failed)} failed "
+            f"({len(batch['reused'])} deduplicated)"
+        )
+
+    def summary(self):
+        """
+        Throughput and per-stage utilisation so far.
+
+        Utilisation is busy time over available time: for the pool stages
+        the available time is wall time multiplied by the number of workers.
+        """
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        utilisation = {}
+        for stage in STAGES:
+            capacity = elapsed * (self.workers if stage in ('decode', 'inference') else 1)
+            utilisation[stage] = round(self.busy[stage] / capacity, 3) if capacity else 0.0
+        return {
+            'workers': self.workers,
+            'images': self.images,
+            'elapsed_seconds': round(elapsed, 3),
+            'images_per_second': round(self.images / elapsed, 2) if elapsed else 0.0,
+            'stage_wall_seconds': {stage: round(self.wall[stage], 3) for stage in STAGES},
+            'stage_utilisation': utilisation,
+        }
+
+    def run(self, once=False, idle_sleep=1.0):
+        """
+        Process batches until interrupted.
+
+        Args:
+            once: Stop as soon as no pending images remain
+            idle_sleep: Seconds to wait before polling again when idle
+
+        Returns:
+            summary dict (see summary())
+        """
+        # Forked pool processes must not inherit open database connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        self.started = time.perf_counter()
+
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                 initializer=_init_worker) as pool:
+            # Start every pool process before the I/O thread exists
+            pool.submit(os.getpid).result()
+
+            with ThreadPoolExecutor(max_workers=1) as io:
+                next_batch = io.submit(self.fetch_batch)
+                try:
+                    while True:
+                        batch = next_batch.result()
+                        next_batch = None
+                        if not batch['crop_images']:
+                            if once:
+                                break
+                            time.sleep(idle_sleep)
+                            next_batch = io.submit(self.fetch_batch)
+                            continue
+
+                        # Prefetch the next batch while this one is on the CPU
+                        next_batch = io.submit(self.fetch_batch)
+                        self.process(pool, batch)
+                finally:
+                    self.release(next_batch)
+                    io.submit(connections.close_all).result()
+
+        return self.summary()
+
+    def release(self, future):
+        """Put a prefetched but unprocessed batch back in the pending set."""
+        if future is None:
+            return
+        try:
+            batch = future.result()
+        except Exception:
+            return
+        ids = [c.id for c in batch['crop_images']]
+        if ids:
+            CropImage.objects.filter(id__in=ids, status='processing').update(status='pending', claimed_at=None)
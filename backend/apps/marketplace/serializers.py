@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from decimal import Decimal
+from django.db import transaction
+from . import stock
 from .models import Vendor, Product, ProductCategory, ProductImage, Order, OrderItem, Rating
 from apps.users.serializers import UserSerializer
 
@@ -89,54 +91,43 @@ class OrderSerializer(serializers.ModelSerializer):
                   'order_items', 'created_at', 'updated_at')
         read_only_fields = ('id', 'customer', 'status', 'total_amount', 'created_at', 'updated_at')
     
+    def validate_order_items(self, value):
+        """[(product_id, quantity), ...] with repeated products merged into one line."""
+        lines = {}
+        for item in value:
+            try:
+                product_id, quantity = int(item['product_id']), int(item['quantity'])
+            except (KeyError, TypeError, ValueError):
+                raise serializers.ValidationError('Each item needs an integer product_id and quantity')
+            if quantity < 1:
+                raise serializers.ValidationError('Quantity must be at least 1')
+            lines[product_id] = lines.get(product_id, 0) + quantity
+        if not lines:
+            raise serializers.ValidationError('An order needs at least one item')
+        return list(lines.items())
+    
     def create(self, validated_data):
-        order_items_data = validated_data.pop('order_items')
+        lines = validated_data.pop('order_items')
         customer = self.context['request'].user
         
-        # Calculate total amount
-        total = Decimal('0.00')
-        items_to_create = []
-        
-        for item_data in order_items_data:
-            product_id = item_data['product_id']
-            quantity = item_data['quantity']
-            
+        # Stock is taken atomically and comes back if anything below fails (see stock)
+        with transaction.atomic():
             try:
-                product = Product.objects.get(id=product_id, is_active=True)
-            except Product.DoesNotExist:
-                raise serializers.ValidationError(f'Product {product_id} not found or inactive')
+                products = stock.reserve(lines)
+            except stock.StockError as e:
+                raise serializers.ValidationError(str(e))
             
-            if product.stock < quantity:
-                raise serializers.ValidationError(
-                    f'Insufficient stock for {product.title}. Available: {product.stock}'
-                )
-            
-            price = product.price
-            subtotal = price * quantity
-            total += subtotal
-            
-            items_to_create.append({
-                'product': product,
-                'quantity': quantity,
-                'price': price
-            })
-        
-        # Create order
-        order = Order.objects.create(
-            customer=customer,
-            total_amount=total,
-            **validated_data
-        )
-        
-        # Create order items and update stock
-        for item_data in items_to_create:
-            OrderItem.objects.create(
-                order=order,
-                **item_data
+            total = sum((products[product_id].price * quantity for product_id, quantity in lines), Decimal('0.00'))
+            order = Order.objects.create(
+                customer=customer,
+                total_amount=total,
+                **validated_data
             )
-            # Update product stock
-            item_data['product'].stock -= item_data['quantity']
-            item_data['product'].save()
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=products[product_id], quantity=quantity,
+                          price=products[product_id].price)
+                for product_id, quantity in lines
+            ])
         
         return order
 
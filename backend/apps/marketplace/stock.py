@@ -0,0 +1,199 @@
+"""
+Stock reservation for orders.
+
+Placing an order takes its stock with one conditional UPDATE per product:
+
+    UPDATE products SET stock = stock - qty WHERE id = ... AND stock >= qty
+
+The database checks and decrements in one step, so concurrent checkouts
+can never sell more than is in stock and no decrement is lost, without
+reading rows first or holding locks across the request. If any product
+runs short the whole order is rolled back. Products are updated in id
+order, so two orders sharing products take their row locks in the same
+order and cannot deadlock.
+
+Stock is returned when an order is cancelled, or when an unpaid order
+expires after ORDER_RESERVATION_TTL seconds (release_expired_orders runs
+from Celery beat). An order moves to cancelled with a conditional UPDATE
+as well, so its stock is returned exactly once however many cancels race.
+The same UPDATE requires that no payment is in flight for the order, so a
+push started just before an expiry keeps its order.
+If a payment is confirmed for an order cancelled in the meantime, restore
+takes its stock back and marks it paid.
+
+These UPDATEs bypass Product.save(), so the diagnosis product index is
+refreshed here for products that sold out or came back in stock.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Sum
+from django.utils import timezone
+from apps.diagnosis import products as product_index
+from apps.payments.models import Transaction
+from apps.payments.transitions import OPEN_STATUSES
+from .models import Order, OrderItem, Product
+
+logger = logging.getLogger(__name__)
+
+
+class StockError(Exception):
+    """An order cannot be reserved."""
+
+
+class ProductUnavailable(StockError):
+    def __init__(self, product_id):
+        super().__init__(f'Product {product_id} not found or inactive')
+        self.product_id = product_id
+
+
+class InsufficientStock(StockError):
+    def __init__(self, product):
+        super().__init__(f'Insufficient stock for {product.title}. Available: {product.stock}')
+        self.product = product
+
+
+def refresh_index(product_ids):
+    """Rebuild the diagnosis index rows of products once the change commits."""
+    if product_ids:
+        transaction.on_commit(
+            lambda: product_index.rebuild(Product.objects.filter(id__in=product_ids)), robust=True
+        )
+
+
+def reserve(lines):
+    """
+    Take stock for an order.
+
+    Args:
+        lines: (product_id, quantity) pairs; a product may appear more than once
+
+    Returns:
+        dict of product id -> Product, as loaded before the reservation
+
+    Raises:
+        ProductUnavailable: When a product does not exist or is inactive
+        InsufficientStock: When a product has less stock than ordered;
+            nothing is reserved
+    """
+    quantities = defaultdict(int)
+    for product_id, quantity in lines:
+        quantities[product_id] += quantity
+
+    products = Product.objects.filter(is_active=True).in_bulk(list(quantities))
+    for product_id in quantities:
+        if product_id not in products:
+            raise ProductUnavailable(product_id)
+
+    now = timezone.now()
+    with transaction.atomic():
+        for product_id in sorted(quantities):
+            quantity = quantities[product_id]
+            taken = Product.objects.filter(id=product_id, is_active=True, stock__gte=quantity).update(
+                stock=F('stock') - quantity, updated_at=now
+            )
+            if not taken:
+                product = products[product_id]
+                product.refresh_from_db(fields=['stock'])
+                raise InsufficientStock(product)
+        refresh_index(list(Product.objects.filter(id__in=list(quantities), stock=0).values_list('id', flat=True)))
+    return products
+
+
+def release(order_ids):
+    """
+    Return the stock held by the items of orders.
+
+    Call only for orders that have just been cancelled (see cancel), so
+    each order's stock is returned once.
+    """
+    quantities = dict(
+        OrderItem.objects.filter(order_id__in=order_ids)
+        .values_list('product_id')
+        .annotate(quantity=Sum('quantity'))
+        .order_by('product_id')
+    )
+    if not quantities:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        for product_id, quantity in quantities.items():
+            Product.objects.filter(id=product_id).update(stock=F('stock') + quantity, updated_at=now)
+        # Products whose stock is now exactly what came back were sold out
+        refresh_index([
+            product_id
+            for product_id, stock in Product.objects.filter(id__in=list(quantities)).values_list('id', 'stock')
+            if stock == quantities[product_id]
+        ])
+
+
+def cancel(order_id, statuses=('pending', 'paid')):
+    """
+    Cancel an order and return its stock, if its status allows it and no
+    payment for it is in flight.
+
+    Returns:
+        True if this call cancelled the order
+    """
+    paying = Transaction.objects.filter(order=OuterRef('pk'), status__in=OPEN_STATUSES)
+    with transaction.atomic():
+        cancelled = Order.objects.filter(~Exists(paying), id=order_id, status__in=statuses).update(
+            status='cancelled', updated_at=timezone.now()
+        )
+        if cancelled:
+            release([order_id])
+    return bool(cancelled)
+
+
+def restore(order_id, now=None):
+    """
+    Mark a cancelled order paid and take its stock again, for a payment
+    confirmed after the order was cancelled.
+
+    Returns:
+        True if the order was restored; False if it is not cancelled or its
+        stock has been sold since (the payment then needs a refund)
+    """
+    now = now or timezone.now()
+    lines = list(OrderItem.objects.filter(order_id=order_id).values_list('product_id', 'quantity'))
+    try:
+        with transaction.atomic():
+            if not Order.objects.filter(id=order_id, status='cancelled').update(status='paid', updated_at=now):
+                return False
+            reserve(lines)
+    except StockError as e:
+        logger.error(f'Cannot restore paid order {order_id}: {str(e)}')
+        return False
+    return True
+
+
+def expire_unpaid(now=None, batch_size=500):
+    """
+    Cancel pending orders older than ORDER_RESERVATION_TTL and return their stock.
+
+    Orders with a payment still in flight are skipped until it settles.
+
+    Returns:
+        number of orders cancelled
+    """
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=settings.ORDER_RESERVATION_TTL)
+    expired = 0
+    last_id = 0
+    while True:
+        order_ids = list(
+            Order.objects.filter(status='pending', created_at__lt=cutoff, id__gt=last_id)
+            .exclude(transactions__status__in=OPEN_STATUSES)
+            .order_by('id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not order_ids:
+            break
+        # One by one: an order paid, or being paid, since it was read keeps its stock
+        expired += sum(cancel(order_id, statuses=('pending',)) for order_id in order_ids)
+        last_id = order_ids[-1]
+    if expired:
+        logger.info(f'Released stock of {expired} unpaid orders')
+    return expired
@@ -0,0 +1,11 @@
+"""
+Celery tasks for the marketplace.
+"""
+from celery import shared_task
+from . import stock
+
+
+@shared_task
+def release_expired_orders():
+    """Cancel unpaid orders past ORDER_RESERVATION_TTL and return their stock."""
+    return {'expired': stock.expire_unpaid()}
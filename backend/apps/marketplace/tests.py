@@ -0,0 +1,210 @@
+import pytest
+from datetime import timedelta
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework import status
+from apps.marketplace.models import Order, OrderItem, Product, ProductCategory, Vendor
+
+User = get_user_model()
+ORDERS_URL = '/api/marketplace/orders/'
+
+
+@pytest.fixture
+def customer_client():
+    client = APIClient()
+    customer = User.objects.create_user(email='customer@example.com', password='testpass123')
+    client.force_authenticate(customer)
+    return client
+
+
+@pytest.fixture
+def products():
+    vendor_user = User.objects.create_user(email='vendor@example.com', password='testpass123', role='vendor')
+    vendor = Vendor.objects.create(user=vendor_user, business_name='Agro Supplies')
+    fungicides = ProductCategory.objects.create(name='Fungicides', slug='fungicides')
+    return {
+        'copper': Product.objects.create(vendor=vendor, title='Copper Fungicide 1L', description='Copper fungicide',
+                                         price=Decimal('900.00'), stock=5, category=fungicides),
+        'seeds': Product.objects.create(vendor=vendor, title='Maize Seeds 2kg', description='Hybrid maize',
+                                        price=Decimal('450.00'), stock=3),
+    }
+
+
+def order_body(*lines):
+    return {
+        'shipping_address': 'Farm road',
+        'shipping_county': 'Nakuru',
+        'shipping_phone': '+254712345678',
+        'order_items': [{'product_id': product.id, 'quantity': quantity} for product, quantity in lines],
+    }
+
+
+def stock_of(product):
+    return Product.objects.values_list('stock', flat=True).get(id=product.id)
+
+
+@pytest.mark.django_db
+class TestStockReservation:
+    def test_order_takes_stock(self, customer_client, products):
+        copper, seeds = products['copper'], products['seeds']
+
+        response = customer_client.post(ORDERS_URL, order_body((copper, 2), (seeds, 1), (copper, 1)), format='json')
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert (stock_of(copper), stock_of(seeds)) == (2, 2)
+        order = Order.objects.get(id=response.data['id'])
+        assert order.total_amount == Decimal('3150.00')
+        assert sorted(order.items.values_list('product_id', 'quantity', 'price')) == sorted([
+            (copper.id, 3, Decimal('900.00')), (seeds.id, 1, Decimal('450.00'))
+        ])
+
+    def test_products_are_loaded_once(self, products, django_assert_num_queries):
+        from types import SimpleNamespace
+        from apps.marketplace.serializers import OrderSerializer
+
+        customer = User.objects.create_user(email='customer@example.com', password='testpass123')
+        serializer = OrderSerializer(data=order_body((products['copper'], 1), (products['seeds'], 1)),
+                                     context={'request': SimpleNamespace(user=customer)})
+        assert serializer.is_valid(), serializer.errors
+
+        # Savepoints, one SELECT, one UPDATE per product, the sold-out check and two INSERTs
+        with django_assert_num_queries(10):
+            serializer.save()
+
+    def test_short_product_reserves_nothing(self, customer_client, products):
+        copper, seeds = products['copper'], products['seeds']
+
+        response = customer_client.post(ORDERS_URL, order_body((copper, 2), (seeds, 4)), format='json')
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert 'Insufficient stock for Maize Seeds 2kg. Available: 3' in str(response.data)
+        assert (stock_of(copper), stock_of(seeds)) == (5, 3)
+        assert not Order.objects.exists() and not OrderItem.objects.exists()
+
+    def test_invalid_quantities_are_rejected(self, customer_client, products):
+        for quantity in (0, -3, 'two'):
+            response = customer_client.post(ORDERS_URL, order_body((products['seeds'], quantity)), format='json')
+            assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert stock_of(products['seeds']) == 3
+
+    def test_cancel_returns_stock_once(self, customer_client, products):
+        copper = products['copper']
+        order_id = customer_client.post(ORDERS_URL, order_body((copper, 4)), format='json').data['id']
+
+        assert customer_client.patch(f'{ORDERS_URL}{order_id}/cancel/').status_code == status.HTTP_200_OK
+        assert customer_client.patch(f'{ORDERS_URL}{order_id}/cancel/').status_code == status.HTTP_400_BAD_REQUEST
+        assert stock_of(copper) == 5
+        assert Order.objects.get(id=order_id).status == 'cancelled'
+
+    def test_unpaid_orders_expire(self, customer_client, products, settings):
+        from apps.marketplace import stock
+        from apps.payments.models import Transaction
+
+        settings.ORDER_RESERVATION_TTL = 600
+        copper = products['copper']
+        expired, paying, recent = [
+            customer_client.post(ORDERS_URL, order_body((copper, 1)), format='json').data['id'] for _ in range(3)
+        ]
+        Order.objects.filter(id__in=[expired, paying]).update(created_at=timezone.now() - timedelta(minutes=30))
+        Transaction.objects.create(order_id=paying, checkout_request_id='ws_CO_PAYING', amount=Decimal('900.00'),
+                                   phone='+254712345678', status='pending')
+
+        assert stock.expire_unpaid() == 1
+        assert stock.expire_unpaid() == 0
+        assert dict(Order.objects.values_list('id', 'status')) == {
+            expired: 'cancelled', paying: 'pending', recent: 'pending'
+        }
+        assert stock_of(copper) == 3
+
+    def test_expired_order_cannot_be_paid(self, customer_client, products, settings):
+        from apps.marketplace import stock
+        from apps.payments.models import Transaction
+
+        cache.clear()  # payment throttle
+        settings.ORDER_RESERVATION_TTL = 600
+        order_id = customer_client.post(ORDERS_URL, order_body((products['copper'], 1)), format='json').data['id']
+        Order.objects.filter(id=order_id).update(created_at=timezone.now() - timedelta(minutes=30))
+        assert stock.expire_unpaid() == 1
+
+        response = customer_client.post('/api/payments/mpesa/initiate/',
+                                        {'order_id': order_id, 'phone': '+254712345678'}, format='json')
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.data == {'error': 'Order is cancelled and cannot be paid'}
+        assert not Transaction.objects.exists()
+
+    def test_order_being_paid_is_not_cancelled(self, customer_client, products):
+        from apps.marketplace import stock
+        from apps.payments.models import Transaction
+
+        order_id = customer_client.post(ORDERS_URL, order_body((products['copper'], 2)), format='json').data['id']
+        # A push started after expiry read its candidates
+        Transaction.objects.create(order_id=order_id, checkout_request_id='ws_CO_LATE', amount=Decimal('1800.00'),
+                                   phone='+254712345678', status='initiated')
+
+        assert not stock.cancel(order_id, statuses=('pending',))
+        response = customer_client.patch(f'{ORDERS_URL}{order_id}/cancel/')
+        assert response.status_code == status.HTTP_409_CONFLICT
+        assert Order.objects.get(id=order_id).status == 'pending'
+        assert stock_of(products['copper']) == 3
+
+    def test_product_index_follows_reservations(self, customer_client, products,
+                                                django_capture_on_commit_callbacks):
+        from apps.diagnosis.products import top_products
+
+        copper = products['copper']
+        with django_capture_on_commit_callbacks(execute=True):
+            order_id = customer_client.post(ORDERS_URL, order_body((copper, 5)), format='json').data['id']
+        assert copper.id not in [m['id'] for m in top_products('Leaf Blight')]
+
+        with django_capture_on_commit_callbacks(execute=True):
+            customer_client.patch(f'{ORDERS_URL}{order_id}/cancel/')
+        assert copper.id in [m['id'] for m in top_products('Leaf Blight')]
+
+
+@pytest.mark.django_db(transaction=True)
+class TestStockReservationConcurrency:
+    def test_concurrent_reservations_never_oversell(self):
+        import threading
+        from django.db import OperationalError, connection
+        from apps.marketplace import stock
+
+        vendor_user = User.objects.create_user(email='vendor@example.com', password='testpass123', role='vendor')
+        vendor = Vendor.objects.create(user=vendor_user, business_name='Flash Sale Farm')
+        product = Product.objects.create(vendor=vendor, title='Avocado Seedlings', description='Hass',
+                                         price=Decimal('150.00'), stock=10)
+        threads = 16
+        barrier = threading.Barrier(threads)
+        results = []
+
+        def checkout(quantity):
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        stock.reserve([(product.id, quantity)])
+                        reserved = True
+                        break
+                    except stock.InsufficientStock:
+                        reserved = False
+                        break
+                    except OperationalError:
+                        # SQLite reports a locked table instead of waiting for the lock
+                        continue
+                results.append((quantity, reserved))
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=checkout, args=(1 + i % 2,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        sold = sum(quantity for quantity, reserved in results if reserved)
+        assert len(results) == threads
+        assert 9 <= sold <= 10
+        assert stock_of(product) == 10 - sold
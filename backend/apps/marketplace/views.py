@@ -5,6 +5,7 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import filters
 from django.db.models import Q
+from . import stock
 from .models import Product, ProductCategory, Order, Rating, Vendor, ProductImage
 from .serializers import (
     ProductSerializer, ProductCategorySerializer, OrderSerializer,
@@ -95,17 +96,18 @@ class OrderViewSet(viewsets.ModelViewSet):
     def cancel(self, request, pk=None):
         """Cancel an order."""
         order = self.get_object()
-        if order.status not in ['pending', 'paid']:
+        # Stock comes back only for the request that actually cancels the order
+        if not stock.cancel(order.id):
+            order.refresh_from_db(fields=['status'])
+            if order.status in ['pending', 'paid']:
+                return Response(
+                    {'error': 'A payment for this order is in progress'},
+                    status=status.HTTP_409_CONFLICT
+                )
             return Response(
                 {'error': 'Only pending or paid orders can be cancelled'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        order.status = 'cancelled'
-        order.save()
-        # Restore stock
-        for item in order.items.all():
-            item.product.stock += item.quantity
-            item.product.save()
         return Response({'status': 'Order cancelled'})
 
 
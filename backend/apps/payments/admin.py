@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Transaction
+from .models import LedgerEntry, SettlementRun, Transaction, VendorSettlement, WebhookEvent
 
 
 @admin.register(Transaction)
@@ -12,6 +12,13 @@ class TransactionAdmin(admin.ModelAdmin):
     
     actions = ['reconcile_transactions']
     
+    def get_queryset(self, request):
+        # The change list never shows raw_response; only load it on the detail page
+        queryset = super().get_queryset(request)
+        if request.resolver_match and request.resolver_match.url_name.endswith('_changelist'):
+            queryset = queryset.defer('raw_response')
+        return queryset
+    
     def reconcile_transactions(self, request, queryset):
         """Admin action to reconcile pending transactions."""
         from .tasks import reconcile_pending_transactions
@@ -19,3 +26,52 @@ class TransactionAdmin(admin.ModelAdmin):
         self.message_user(request, 'Reconciliation task queued')
     reconcile_transactions.short_description = 'Reconcile pending transactions'
 
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('id', 'checkout_request_id', 'status', 'outcome', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('status', 'outcome')
+    search_fields = ('checkout_request_id',)
+    readonly_fields = ('checkout_request_id', 'payload', 'status', 'outcome', 'error', 'attempts',
+                       'received_at', 'claimed_at', 'processed_at')
+    
+    actions = ['replay_events']
+    
+    def replay_events(self, request, queryset):
+        """Admin action to requeue webhook events."""
+        from .webhooks import replay
+        self.message_user(request, f'{replay(queryset)} webhook events requeued')
+    replay_events.short_description = 'Replay selected webhook events'
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'transaction', 'order', 'status', 'amount', 'mpesa_transaction_id', 'created_at')
+    list_filter = ('status',)
+    search_fields = ('mpesa_transaction_id', 'transaction__checkout_request_id', 'order_ref')
+    raw_id_fields = ('transaction', 'order')
+    
+    # Append-only; see apps.payments.transitions
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(VendorSettlement)
+class VendorSettlementAdmin(admin.ModelAdmin):
+    list_display = ('date', 'vendor', 'gross_amount', 'items', 'orders', 'updated_at')
+    list_filter = ('date',)
+    search_fields = ('vendor__business_name',)
+    raw_id_fields = ('vendor',)
+    readonly_fields = ('vendor', 'date', 'gross_amount', 'items', 'orders', 'updated_at')
+
+
+@admin.register(SettlementRun)
+class SettlementRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'last_entry_id', 'entries', 'created_at')
+    readonly_fields = ('last_entry_id', 'entries', 'created_at')
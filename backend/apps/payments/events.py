@@ -0,0 +1,95 @@
+"""
+Structured, sampled and redacted logging for payment events.
+
+    events.log('webhook.received', checkout_request_id=..., result_code=..., phone=...)
+
+Each event is one log record on the apps.payments.events logger. Its
+message is the event name followed by its fields as JSON, e.g.
+
+    INFO ... webhook.received {"checkout_request_id": "ws_CO_1", "phone": "2547******678", ...}
+
+and the record carries the name as record.event for filters and handlers.
+
+Cost is paid only for records that are emitted. Nothing is built when the
+logger is disabled for the level or when the event is sampled out. The
+JSON and the redaction run when a handler formats the record, not at the
+call site. Routine events are sampled: PAYMENT_LOG_SAMPLING gives the
+share of each event that is logged, and PAYMENT_LOG_SAMPLE_RATE covers
+events it does not list. Warnings and errors are always logged.
+
+Phone numbers are masked to their last three digits and credentials are
+removed, including inside nested Daraja payloads (CallbackMetadata items
+are Name/Value pairs).
+"""
+import json
+import random
+import logging
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PHONE_FIELDS = {'phone', 'phone_number', 'PhoneNumber', 'PartyA', 'MSISDN'}
+SECRET_FIELDS = {'Password', 'access_token', 'token', 'consumer_secret', 'passkey'}
+SENSITIVE_FIELDS = PHONE_FIELDS | SECRET_FIELDS
+
+
+def mask_phone(value):
+    """2547******678: country and network prefix and the last three digits."""
+    digits = str(value)
+    if len(digits) <= 3:
+        return '*' * len(digits)
+    prefix = digits[:4] if len(digits) >= 10 else ''
+    return prefix + '*' * (len(digits) - len(prefix) - 3) + digits[-3:]
+
+
+def redact(value, key=None):
+    """Copy of value with phone numbers masked and secrets removed, at any depth."""
+    if key in SECRET_FIELDS:
+        return '[redacted]'
+    if key in PHONE_FIELDS and value is not None:
+        return mask_phone(value)
+    if isinstance(value, dict):
+        if 'Name' in value and 'Value' in value:
+            # CallbackMetadata item
+            return dict(value, Value=redact(value['Value'], key=value['Name']))
+        return {
+            k: redact(v, key=k) if k in SENSITIVE_FIELDS or isinstance(v, (dict, list, tuple)) else v
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+class Event:
+    """Log message that formats itself only when a handler asks for it."""
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return f'{self.name} {json.dumps(redact(self.fields), default=str)}'
+
+
+def sample_rate(name):
+    return settings.PAYMENT_LOG_SAMPLING.get(name, settings.PAYMENT_LOG_SAMPLE_RATE)
+
+
+def log(name, level=logging.INFO, **fields):
+    """
+    Log a payment event.
+
+    Args:
+        name: Event name, e.g. 'webhook.received'
+        level: Logging level; WARNING and above are never sampled out
+        **fields: Event data (redacted when formatted)
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING:
+        rate = sample_rate(name)
+        if rate < 1 and (rate <= 0 or random.random() >= rate):
+            return
+    logger.log(level, Event(name, fields), extra={'event': name})
@@ -0,0 +1,119 @@
+"""
+Single-flight STK push initiation.
+
+A flaky mobile client often sends the same payment request several times.
+Each push costs a Daraja call and makes the customer's phone ask for the
+PIN again. Initiations are therefore coalesced per order: the first caller
+takes a short-lived lock in the shared cache and makes the Daraja call,
+and concurrent callers for the same order and phone wait for it. The
+result is kept for MPESA_STK_COALESCE_WINDOW seconds, so callers that
+arrive while the push is in flight, or shortly after, get the same
+checkout_request_id and transaction.
+
+The lock and the result live in the default cache, which is Redis
+(REDIS_URL) so that every gunicorn worker and Celery process sees them:
+cache.add is an atomic SET NX there, so double taps that land on
+different workers still make one Daraja call. A process-local cache
+(LocMemCache, used by the tests) only coalesces within one process.
+"""
+import time
+import uuid
+import logging
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from .models import Transaction
+from .mpesa_service import MPesaService
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'payments:stk:lock:{}'
+RESULT_KEY = 'payments:stk:result:{}'
+
+
+class InitiationInProgress(APIException):
+    """409 with a Retry-After header, when an earlier push is still running."""
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'A payment request for this order is already in progress.'
+    default_code = 'initiation_in_progress'
+
+    def __init__(self, wait, detail=None):
+        super().__init__(detail)
+        self.wait = wait
+
+
+def shared_result(order_id, phone):
+    """The recent push for this order and phone, if any."""
+    result = cache.get(RESULT_KEY.format(order_id))
+    if result and result['phone'] == phone:
+        return dict(result, shared=True)
+    return None
+
+
+def initiate(order, phone, service=None):
+    """
+    Send an STK push for the order, or join the one already in flight.
+
+    Args:
+        order: Order to pay
+        phone: Customer phone number (+2547XXXXXXXX)
+        service: MPesaService to use (default a new one)
+
+    Returns:
+        dict with checkout_request_id, transaction_id, customer_message and
+        shared (True when another request made the Daraja call)
+
+    Raises:
+        InitiationInProgress: When the push in flight did not finish within
+            MPESA_STK_LOCK_TIMEOUT seconds
+        Exception: When Daraja rejects the push
+    """
+    result = shared_result(order.id, phone)
+    if result:
+        return result
+
+    lock_key = LOCK_KEY.format(order.id)
+    owner = uuid.uuid4().hex
+    timeout = settings.MPESA_STK_LOCK_TIMEOUT
+    deadline = time.monotonic() + timeout
+    while not cache.add(lock_key, owner, timeout):
+        if time.monotonic() >= deadline:
+            raise InitiationInProgress(1)
+        time.sleep(0.05)
+        result = shared_result(order.id, phone)
+        if result:
+            return result
+
+    try:
+        # The previous holder may have finished between our last check and the lock
+        result = shared_result(order.id, phone)
+        if result:
+            return result
+
+        response = (service or MPesaService()).initiate_stk_push(
+            phone_number=phone,
+            amount=order.total_amount,
+            account_reference=f'ORDER{order.id}',
+            transaction_desc=f'Payment for order {order.id}'
+        )
+        transaction = Transaction.objects.create(
+            order=order,
+            checkout_request_id=response['checkout_request_id'],
+            amount=order.total_amount,
+            phone=phone,
+            status='initiated',
+            raw_response=response['raw_response']
+        )
+        result = {
+            'checkout_request_id': response['checkout_request_id'],
+            'transaction_id': transaction.id,
+            'customer_message': response.get('customer_message', 'STK Push initiated'),
+            'phone': phone,
+        }
+        cache.set(RESULT_KEY.format(order.id), result, settings.MPESA_STK_COALESCE_WINDOW)
+        return dict(result, shared=False)
+    finally:
+        # Only release our own lock; a lease that expired may have passed to someone else
+        if cache.get(lock_key) == owner:
+            cache.delete(lock_key)
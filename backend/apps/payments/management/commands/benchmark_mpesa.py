@@ -0,0 +1,107 @@
+"""
+Benchmark M-Pesa payment initiation against the local Daraja simulator.
+
+Compares three ways of calling Daraja:
+
+* fresh: a new OAuth token and connection for every payment (how
+  MPesaService behaved before the shared token and pooled session),
+* shared: the pooled session with the shared, cached token,
+* async: AsyncMPesaService with --concurrency payments in flight.
+
+Usage:
+    python manage.py benchmark_mpesa
+    python manage.py benchmark_mpesa --payments 200 --latency 0.05 --oauth-latency 0.2 --output mpesa.json
+"""
+import time
+import asyncio
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from apps.payments.mpesa_service import AsyncMPesaService, MPesaService, reset_client
+from apps.payments.simulator import DarajaSimulator
+from digi_farm.benchmarking import build_report, summarize, write_report
+
+MODES = ('fresh', 'shared', 'async')
+
+
+def initiate(service, i):
+    started = time.perf_counter()
+    service.initiate_stk_push('+254712345678', 100, f'ORDER{i}', f'Payment for order {i}')
+    return time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = 'Measure STK push initiation latency with and without the shared token and pooled session'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=100, help='Payments per mode')
+        parser.add_argument('--latency', type=float, default=0.02, help='Simulated Daraja latency (seconds)')
+        parser.add_argument('--oauth-latency', type=float, default=0.1, help='Simulated OAuth latency (seconds)')
+        parser.add_argument('--concurrency', type=int, default=10, help='Payments in flight in async mode')
+        parser.add_argument('--modes', default=','.join(MODES), help='Comma-separated modes to run')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def run_fresh(self, payments):
+        samples = []
+        for i in range(payments):
+            reset_client()
+            cache.clear()
+            samples.append(initiate(MPesaService(), i))
+        return samples
+
+    def run_shared(self, payments):
+        return [initiate(MPesaService(), i) for i in range(payments)]
+
+    def run_async(self, payments, concurrency):
+        async def main():
+            async with AsyncMPesaService(concurrency=concurrency) as service:
+                async def one(i):
+                    started = time.perf_counter()
+                    await service.initiate_stk_push('+254712345678', 100, f'ORDER{i}', f'Payment for order {i}')
+                    return time.perf_counter() - started
+
+                return await asyncio.gather(*(one(i) for i in range(payments)))
+
+        return asyncio.run(main())
+
+    def handle(self, *args, **options):
+        modes = [m for m in options['modes'].split(',') if m]
+        results = []
+        with DarajaSimulator(latency=options['latency'], oauth_latency=options['oauth_latency']) as simulator:
+            with override_settings(MPESA_BASE_URL=simulator.url, MPESA_POOL_SIZE=max(options['concurrency'], 1)):
+                for mode in modes:
+                    reset_client()
+                    cache.clear()
+                    simulator.requests.clear()
+                    simulator.connections.clear()
+
+                    started = time.perf_counter()
+                    if mode == 'async':
+                        samples = self.run_async(options['payments'], options['concurrency'])
+                    else:
+                        samples = getattr(self, f'run_{mode}')(options['payments'])
+                    elapsed = time.perf_counter() - started
+
+                    results.append({
+                        'mode': mode,
+                        'latency': summarize(samples),
+                        'payments_per_second': round(options['payments'] / elapsed, 2),
+                        'oauth_requests': simulator.requests['oauth'],
+                        'connections': len(simulator.connections),
+                    })
+            reset_client()
+
+        report = build_report('mpesa', {
+            'payments': options['payments'],
+            'latency': options['latency'],
+            'oauth_latency': options['oauth_latency'],
+            'concurrency': options['concurrency'],
+        }, results)
+        write_report(report, path=options['output'], stream=self.stdout)
+        if options['output']:
+            for row in results:
+                self.stdout.write(
+                    f"{row['mode']:>7}: mean {row['latency']['mean_ms']} ms, "
+                    f"p95 {row['latency']['p95_ms']} ms, {row['payments_per_second']} payments/s, "
+                    f"{row['oauth_requests']} token requests, {row['connections']} connections"
+                )
@@ -0,0 +1,139 @@
+"""
+Benchmark payment event logging against the old full-payload f-string logs.
+
+Logs a realistic M-Pesa callback --events times per mode:
+
+* fstring: logger.info(f'M-Pesa webhook received: {data}'), as the webhook did,
+* event: events.log('webhook.received', ...) with every event logged,
+* sampled: events.log with the configured webhook sample rate,
+
+each once with the records written to a handler and once with INFO
+disabled. The report gives the cost per call, the log volume, and whether
+the customer's phone number reached the log.
+
+Usage:
+    python manage.py benchmark_payment_logging
+    python manage.py benchmark_payment_logging --events 50000 --output logging.json
+"""
+import io
+import time
+import logging
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from apps.payments import events
+from apps.payments.mpesa_service import parse_mpesa_callback
+from digi_farm.benchmarking import build_report, write_report
+
+PHONE = 254712345678
+CALLBACK = {
+    'Body': {
+        'stkCallback': {
+            'MerchantRequestID': '29115-34620561-1',
+            'CheckoutRequestID': 'ws_CO_191220191020363925',
+            'ResultCode': 0,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {
+                'Item': [
+                    {'Name': 'Amount', 'Value': 1.00},
+                    {'Name': 'MpesaReceiptNumber', 'Value': 'NLJ7RT61SV'},
+                    {'Name': 'TransactionDate', 'Value': 20191219102115},
+                    {'Name': 'PhoneNumber', 'Value': PHONE},
+                ]
+            }
+        }
+    }
+}
+
+
+class CountingStream(io.TextIOBase):
+    """Discards what is written, keeping its size and whether the phone number appeared."""
+
+    def __init__(self):
+        self.size = 0
+        self.leaked = False
+
+    def write(self, text):
+        self.size += len(text)
+        self.leaked = self.leaked or str(PHONE) in text
+        return len(text)
+
+
+@contextmanager
+def capture(level):
+    """Send everything under the apps logger to a CountingStream at the given level."""
+    stream = CountingStream()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('{levelname} {asctime} {module} {message}', style='{'))
+    root = logging.getLogger('apps')
+    saved = root.handlers, root.level
+    root.handlers = [handler]
+    # setLevel, unlike assigning level, clears the loggers' isEnabledFor caches
+    root.setLevel(level)
+    try:
+        yield stream
+    finally:
+        root.handlers = saved[0]
+        root.setLevel(saved[1])
+
+
+def log_fstring(logger, data, callback):
+    logger.info(f'M-Pesa webhook received: {data}')
+
+
+def log_event(logger, data, callback):
+    # The webhook parses the callback whether or not it logs, so that is not timed
+    events.log(
+        'webhook.received',
+        checkout_request_id=callback.get('checkout_request_id'),
+        result_code=callback.get('result_code'),
+        result_desc=callback.get('result_desc'),
+        amount=callback.get('amount'),
+        phone=callback.get('phone_number')
+    )
+
+
+class Command(BaseCommand):
+    help = 'Measure the cost of payment event logging against full-payload f-string logs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=20000, help='Log calls per mode')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def run(self, function, count, level):
+        logger = logging.getLogger('apps.payments.views')
+        callback = parse_mpesa_callback(CALLBACK)
+        with capture(level) as stream:
+            started = time.perf_counter()
+            for _ in range(count):
+                function(logger, CALLBACK, callback)
+            elapsed = time.perf_counter() - started
+        return {
+            'us_per_call': round(elapsed / count * 1e6, 3),
+            'bytes_logged': stream.size,
+            'bytes_per_call': round(stream.size / count, 1),
+            'phone_logged': stream.leaked,
+        }
+
+    def handle(self, *args, **options):
+        count = options['events']
+        sampled_rate = settings.PAYMENT_LOG_SAMPLING.get('webhook.received', settings.PAYMENT_LOG_SAMPLE_RATE)
+        modes = {
+            'fstring': (log_fstring, {}),
+            'event': (log_event, {'webhook.received': 1.0}),
+            'sampled': (log_event, {'webhook.received': sampled_rate}),
+        }
+        results = []
+        for mode, (function, sampling) in modes.items():
+            for sink, level in (('emitted', logging.DEBUG), ('disabled', logging.WARNING)):
+                with override_settings(PAYMENT_LOG_SAMPLING=dict(settings.PAYMENT_LOG_SAMPLING, **sampling)):
+                    row = {'mode': mode, 'sink': sink}
+                    row.update(self.run(function, count, level))
+                results.append(row)
+                self.stderr.write(
+                    f"{mode:>8} {sink:>8}: {row['us_per_call']} us/call, {row['bytes_per_call']} bytes/call"
+                )
+
+        report = build_report('payment_logging', {'events': count, 'sampled_rate': sampled_rate}, results)
+        write_report(report, path=options['output'], stream=self.stdout)
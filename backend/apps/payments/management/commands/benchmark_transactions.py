@@ -0,0 +1,121 @@
+"""
+Benchmark the transaction list endpoint against large payment histories.
+
+For each row count, one customer gets that many transactions and the
+command measures response time, payload size and query count for:
+
+* unpaginated: every transaction serialized in one response, with
+  raw_response loaded (how transaction_list behaved before pagination);
+  measured once per row count, as it takes minutes at 100k rows,
+* first_page: the first keyset page,
+* deep_page: a page 90% of the way through the history,
+* sparse: the first page with ?fields=id,status,amount,created_at.
+
+Usage:
+    python manage.py benchmark_transactions
+    python manage.py benchmark_transactions --rows 10000,100000 --repeat 5 --output transactions.json
+"""
+import time
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from apps.marketplace.models import Order
+from apps.payments.models import Transaction
+from apps.payments.pagination import KeysetPagination
+from apps.payments.serializers import TransactionSerializer
+from digi_farm.benchmarking import benchmark_environment, build_report, summarize, write_report
+
+User = get_user_model()
+MODES = ('unpaginated', 'first_page', 'deep_page', 'sparse')
+URL = '/api/payments/transactions/'
+RAW_RESPONSE = {
+    'MerchantRequestID': '29115-34620561-1',
+    'CheckoutRequestID': 'ws_CO_191220191020363925',
+    'ResponseCode': '0',
+    'ResponseDescription': 'Success. Request accepted for processing',
+    'CustomerMessage': 'Success. Request accepted for processing',
+}
+
+
+class Command(BaseCommand):
+    help = 'Measure transaction list latency and payload size at large row counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', default='10000,100000', help='Comma-separated transaction counts')
+        parser.add_argument('--repeat', type=int, default=5, help='Requests per mode')
+        parser.add_argument('--modes', default=','.join(MODES), help='Comma-separated modes to run')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def create_history(self, rows):
+        customer = User.objects.create_user(email=f'history-{rows}@example.com', password='benchpass123')
+        orders = Order.objects.bulk_create([
+            Order(customer=customer, total_amount=Decimal('100.00'), shipping_address='Benchmark',
+                  shipping_county='Nairobi', shipping_phone='+254712345678')
+            for _ in range(max(rows // 10, 1))
+        ])
+        batch = []
+        for i in range(rows):
+            batch.append(Transaction(
+                order=orders[i % len(orders)], checkout_request_id=f'ws_CO_{rows}_{i}',
+                amount=Decimal('100.00'), phone='+254712345678', status='success',
+                raw_response=RAW_RESPONSE
+            ))
+            if len(batch) == 5000:
+                Transaction.objects.bulk_create(batch)
+                batch = []
+        Transaction.objects.bulk_create(batch)
+        return customer
+
+    def unpaginated(self, customer):
+        transactions = Transaction.objects.filter(order__customer=customer).select_related('order').order_by('-created_at')
+        return JSONRenderer().render(TransactionSerializer(transactions, many=True).data)
+
+    def measure(self, request, repeat):
+        samples, sizes, queries = [], [], []
+        executed = []
+
+        def count(execute, sql, params, many, context):
+            executed.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            for _ in range(repeat):
+                executed.clear()
+                started = time.perf_counter()
+                body = request()
+                samples.append(time.perf_counter() - started)
+                sizes.append(len(body))
+                queries.append(len(executed))
+        return {'latency': summarize(samples), 'payload_bytes': max(sizes), 'queries': max(queries)}
+
+    def handle(self, *args, **options):
+        modes = [m for m in options['modes'].split(',') if m]
+        results = []
+        with benchmark_environment():
+            for rows in [int(r) for r in options['rows'].split(',') if r]:
+                self.stdout.write(f'Creating {rows} transactions...')
+                customer = self.create_history(rows)
+                client = APIClient()
+                client.force_authenticate(customer)
+                deep = Transaction.objects.filter(order__customer=customer).order_by('-created_at', '-id')[int(rows * 0.9)]
+                requests = {
+                    'unpaginated': lambda: self.unpaginated(customer),
+                    'first_page': lambda: client.get(URL).content,
+                    'deep_page': lambda: client.get(URL, {'cursor': KeysetPagination.encode_cursor(deep)}).content,
+                    'sparse': lambda: client.get(URL, {'fields': 'id,status,amount,created_at'}).content,
+                }
+                for mode in modes:
+                    row = {'rows': rows, 'mode': mode}
+                    repeat = 1 if mode == 'unpaginated' else options['repeat']
+                    row.update(self.measure(requests[mode], repeat))
+                    results.append(row)
+                    self.stdout.write(
+                        f"{rows:>7} {mode:>12}: p50 {row['latency']['p50_ms']} ms, "
+                        f"{row['payload_bytes']} bytes, {row['queries']} queries"
+                    )
+
+        report = build_report('transaction_list', {'repeat': options['repeat']}, results)
+        write_report(report, path=options['output'], stream=self.stdout)
@@ -0,0 +1,266 @@
+"""
+Load-test the payment flow end to end against the Daraja simulator.
+
+Customers check out concurrently: each places an order and starts an STK
+push, some double-tap the pay button, and failed requests are retried
+once. The simulator answers each push after --callback-delay seconds with
+an outcome drawn from --outcomes, posting the callback to the webhook (a
+share of callbacks is lost or duplicated, and --error-rate of Daraja calls
+fail with 503). Once the callbacks have arrived, the reconciler settles
+whatever is still open, and the final state is checked against what the
+simulator decided.
+
+Reported: checkout throughput, latency percentiles and database queries
+per request for each endpoint, the reconciliation run, and the number of
+orders that ended in an inconsistent state (paid without a successful
+transaction, charged but not paid, charged twice, or settled differently
+from the customer's answer).
+
+SQLite allows one writer at a time, so on SQLite requests are serialized;
+use PostgreSQL (DATABASE_URL) to measure real concurrency.
+
+Usage:
+    python manage.py payment_load
+    python manage.py payment_load --checkouts 500 --concurrency 8 --error-rate 0.05 --webhook-mode inbox
+"""
+import json
+import time
+import random
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, Q
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from apps.marketplace.models import Order, OrderItem, Product, Vendor
+from apps.payments import webhooks
+from apps.payments.models import Transaction
+from apps.payments.mpesa_service import reset_client
+from apps.payments.simulator import DarajaSimulator
+from apps.payments.tasks import reconcile_pending_transactions
+from apps.payments.transitions import OPEN_STATUSES
+from digi_farm.benchmarking import benchmark_environment, build_report, summarize, write_report
+
+User = get_user_model()
+INITIATE_URL = '/api/payments/mpesa/initiate/'
+WEBHOOK_URL = '/api/payments/mpesa/webhook/'
+
+
+def parse_outcomes(value):
+    """'0:75,1:10' -> {0: 75.0, 1: 10.0}"""
+    try:
+        return {int(code): float(weight) for code, weight in (part.split(':') for part in value.split(','))}
+    except ValueError:
+        raise CommandError('--outcomes must look like 0:75,1:10,1037:10')
+
+
+class Recorder:
+    """Latency, status codes and query counts per endpoint, from any thread."""
+
+    def __init__(self, db_lock):
+        self.db_lock = db_lock
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def call(self, name, request):
+        executed = []
+
+        def count(execute, sql, params, many, context):
+            executed.append(sql)
+            return execute(sql, params, many, context)
+
+        with self.db_lock, connection.execute_wrapper(count):
+            started = time.perf_counter()
+            response = request()
+            elapsed = time.perf_counter() - started
+        with self.lock:
+            self.samples[name].append(elapsed)
+            self.queries[name].append(len(executed))
+            self.statuses[name][response.status_code] += 1
+        return response
+
+    def summary(self, elapsed):
+        return {
+            name: {
+                'requests': len(samples),
+                'requests_per_second': round(len(samples) / elapsed, 2) if elapsed else None,
+                'latency': summarize(samples),
+                'queries_per_request': round(sum(self.queries[name]) / len(samples), 2),
+                'max_queries': max(self.queries[name]),
+                'statuses': dict(self.statuses[name]),
+            }
+            for name, samples in self.samples.items()
+        }
+
+
+class Command(BaseCommand):
+    help = 'Run concurrent checkouts against the Daraja simulator and check the payments end consistent'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=4, help='Customers checking out at once')
+        parser.add_argument('--latency', type=float, default=0.05, help='Daraja latency (seconds)')
+        parser.add_argument('--jitter', type=float, default=0.05, help='Extra random Daraja latency (seconds)')
+        parser.add_argument('--error-rate', type=float, default=0.02, help='Share of Daraja calls failing with 503')
+        parser.add_argument('--callback-delay', type=float, default=0.5, help='Seconds until the customer answers')
+        parser.add_argument('--callback-loss', type=float, default=0.05, help='Share of callbacks never sent')
+        parser.add_argument('--callback-duplicates', type=float, default=0.05, help='Share of callbacks sent twice')
+        parser.add_argument('--outcomes', default='0:75,1:10,1037:10,2001:5', help='ResultCode:weight pairs')
+        parser.add_argument('--double-tap', type=float, default=0.1, help='Share of customers who pay twice')
+        parser.add_argument('--webhook-mode', choices=['sync', 'inbox'], default='sync')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def create_orders(self, count):
+        vendor_user = User.objects.create_user(email='load-vendor@example.com', password='benchpass123', role='vendor')
+        vendor = Vendor.objects.create(user=vendor_user, business_name='Load Test Farm')
+        products = Product.objects.bulk_create([
+            Product(vendor=vendor, title=f'Produce {i}', description='Load test', price=Decimal(50 + 25 * i),
+                    stock=1_000_000)
+            for i in range(5)
+        ])
+        customers = User.objects.bulk_create([User(email=f'load-{i}@example.com') for i in range(count)])
+        orders = Order.objects.bulk_create([
+            Order(customer=customer, total_amount=Decimal('0'), shipping_address='Load test',
+                  shipping_county='Nairobi', shipping_phone='+254712345678')
+            for customer in customers
+        ])
+        items = []
+        for i, order in enumerate(orders):
+            for product in products[:1 + i % 3]:
+                items.append(OrderItem(order=order, product=product, quantity=1 + i % 2, price=product.price))
+                order.total_amount += product.price * (1 + i % 2)
+        OrderItem.objects.bulk_create(items)
+        Order.objects.bulk_update(orders, ['total_amount'])
+        return list(zip(customers, orders))
+
+    def checkout(self, recorder, customer, order, double_tap):
+        client = APIClient()
+        client.force_authenticate(customer)
+        body = {'order_id': order.id, 'phone': '+254712345678'}
+        for attempt in range(2):
+            response = recorder.call('initiate', lambda: client.post(INITIATE_URL, body, format='json'))
+            if double_tap:
+                recorder.call('initiate', lambda: client.post(INITIATE_URL, body, format='json'))
+            if response.status_code == 200:
+                return
+            # Daraja was busy; the customer taps again
+            time.sleep(0.2)
+
+    def consistency(self, simulator):
+        """Orders whose final state disagrees with the payments made for them."""
+        orders = Order.objects.annotate(successes=Count('transactions', filter=Q(transactions__status='success')))
+        problems = {
+            'paid_without_success': set(orders.filter(status='paid', successes=0).values_list('id', flat=True)),
+            'success_not_paid': set(orders.filter(successes__gt=0).exclude(status='paid').values_list('id', flat=True)),
+            'charged_twice': set(orders.filter(successes__gt=1).values_list('id', flat=True)),
+            'wrong_outcome': set(),
+        }
+        for order_id, checkout_request_id, status in Transaction.objects.exclude(
+            status__in=OPEN_STATUSES
+        ).values_list('order_id', 'checkout_request_id', 'status'):
+            paid = simulator.outcome_for.get(checkout_request_id) == 0
+            if paid != (status == 'success'):
+                problems['wrong_outcome'].add(order_id)
+        report = {name: len(ids) for name, ids in problems.items()}
+        report['inconsistent_orders'] = len(set().union(*problems.values()))
+        report['still_open'] = Transaction.objects.filter(status__in=OPEN_STATUSES).count()
+        report['orders_paid'] = Order.objects.filter(status='paid').count()
+        return report
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        db_lock = threading.Lock() if connection.vendor == 'sqlite' else nullcontext()
+        recorder = Recorder(db_lock)
+        webhook_client = Client()
+
+        def deliver(body):
+            recorder.call('webhook', lambda: webhook_client.post(
+                WEBHOOK_URL, data=json.dumps(body), content_type='application/json'
+            ))
+
+        simulator = DarajaSimulator(
+            latency=options['latency'], jitter=options['jitter'], error_rate=options['error_rate'],
+            callback=deliver, callback_delay=options['callback_delay'], outcomes=parse_outcomes(options['outcomes']),
+            callback_loss=options['callback_loss'], callback_duplicates=options['callback_duplicates'],
+            seed=options['seed']
+        )
+        with benchmark_environment(), simulator, override_settings(
+            MPESA_BASE_URL=simulator.url, MPESA_WEBHOOK_MODE=options['webhook_mode'], MPESA_RECONCILE_RATE=0
+        ):
+            reset_client()
+            work = [
+                (customer, order, rng.random() < options['double_tap'])
+                for customer, order in self.create_orders(options['checkouts'])
+            ]
+            queue_lock = threading.Lock()
+
+            def customer_thread():
+                try:
+                    while True:
+                        with queue_lock:
+                            if not work:
+                                return
+                            customer, order, double_tap = work.pop()
+                        self.checkout(recorder, customer, order, double_tap)
+                finally:
+                    if threading.current_thread() is not threading.main_thread():
+                        connection.close()
+
+            started = time.perf_counter()
+            threads = [threading.Thread(target=customer_thread) for _ in range(options['concurrency'])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            checkout_seconds = time.perf_counter() - started
+            if not simulator.wait_for_callbacks(timeout=60):
+                self.stderr.write('Timed out waiting for simulated callbacks')
+            callbacks_seconds = time.perf_counter() - started
+
+            consumer = None
+            if options['webhook_mode'] == 'inbox':
+                consumer = webhooks.consume()
+
+            # Let time pass: every open transaction is due for a status check
+            Transaction.objects.filter(status__in=OPEN_STATUSES).update(next_check_at=timezone.now())
+            executed = []
+            with connection.execute_wrapper(lambda execute, *a: executed.append(a[0]) or execute(*a)):
+                reconcile_started = time.perf_counter()
+                reconciliation = reconcile_pending_transactions()
+                reconciliation['elapsed_seconds'] = round(time.perf_counter() - reconcile_started, 3)
+            reconciliation['queries'] = len(executed)
+
+            consistency = self.consistency(simulator)
+            daraja = dict(simulator.requests)
+            reset_client()
+
+        results = [{
+            'checkouts': options['checkouts'],
+            'checkouts_per_second': round(options['checkouts'] / checkout_seconds, 2),
+            'seconds_until_last_callback': round(callbacks_seconds, 3),
+            'endpoints': recorder.summary(callbacks_seconds),
+            'inbox_consumer': consumer,
+            'reconciliation': reconciliation,
+            'daraja_requests': daraja,
+            'consistency': consistency,
+        }]
+        config = {key: options[key] for key in (
+            'checkouts', 'concurrency', 'latency', 'jitter', 'error_rate', 'callback_delay', 'callback_loss',
+            'callback_duplicates', 'outcomes', 'double_tap', 'webhook_mode', 'seed'
+        )}
+        config['database'] = connection.vendor
+        write_report(build_report('payment_load', config, results), path=options['output'], stream=self.stdout)
+        if options['output']:
+            self.stdout.write(
+                f"{results[0]['checkouts_per_second']} checkouts/s, "
+                f"{consistency['inconsistent_orders']} inconsistent orders, {consistency['still_open']} still open"
+            )
@@ -0,0 +1,46 @@
+"""
+Requeue M-Pesa callbacks from the webhook inbox.
+
+Applying a callback is idempotent, so replaying is always safe: events for
+transactions that have already settled are recorded as duplicates.
+
+Usage:
+    python manage.py replay_webhooks                       # failed events
+    python manage.py replay_webhooks --checkout-request-id ws_CO_123
+    python manage.py replay_webhooks --since 2024-01-01T00:00 --all --apply
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from apps.payments import webhooks
+from apps.payments.models import WebhookEvent
+
+
+class Command(BaseCommand):
+    help = 'Requeue inbox webhook events (failed ones by default) and optionally apply them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--id', type=int, action='append', dest='ids', help='Event id (repeatable)')
+        parser.add_argument('--checkout-request-id', help='Events for one checkout request')
+        parser.add_argument('--since', help='Events received at or after this ISO datetime')
+        parser.add_argument('--all', action='store_true', help='Include processed events, not only failed ones')
+        parser.add_argument('--apply', action='store_true', help='Apply the requeued events now')
+
+    def handle(self, *args, **options):
+        events = WebhookEvent.objects.all()
+        if options['ids']:
+            events = events.filter(id__in=options['ids'])
+        if options['checkout_request_id']:
+            events = events.filter(checkout_request_id=options['checkout_request_id'])
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(f"Invalid --since datetime: {options['since']}")
+            events = events.filter(received_at__gte=since)
+        if not (options['all'] or options['ids'] or options['checkout_request_id']):
+            events = events.filter(status='failed')
+
+        count = webhooks.replay(events)
+        self.stdout.write(f'Requeued {count} webhook events')
+        if options['apply']:
+            stats = webhooks.consume()
+            self.stdout.write(self.style.SUCCESS(f"Applied {stats['events']} events: {stats['outcomes']}"))
@@ -0,0 +1,61 @@
+"""
+Apply M-Pesa callbacks from the webhook inbox.
+
+Usage:
+    python manage.py run_webhook_consumer
+    python manage.py run_webhook_consumer --threads 4 --batch-size 200
+    python manage.py run_webhook_consumer --once
+"""
+import json
+import time
+import threading
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from apps.payments import webhooks
+
+
+class Command(BaseCommand):
+    help = 'Apply queued M-Pesa webhook events in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=1, help='Consumers claiming batches in parallel')
+        parser.add_argument('--batch-size', type=int, default=None, help='Events per batch')
+        parser.add_argument('--once', action='store_true', help='Exit when the inbox is empty')
+        parser.add_argument('--idle-sleep', type=float, default=0.5, help='Seconds between polls when idle')
+
+    def consume(self, options, totals, lock, stop):
+        try:
+            while not stop.is_set():
+                stats = webhooks.consume(batch_size=options['batch_size'])
+                with lock:
+                    totals['events'] += stats['events']
+                    for outcome, count in stats['outcomes'].items():
+                        totals['outcomes'][outcome] = totals['outcomes'].get(outcome, 0) + count
+                if options['once']:
+                    return
+                if not stats['events']:
+                    stop.wait(options['idle_sleep'])
+        finally:
+            close_old_connections()
+
+    def handle(self, *args, **options):
+        totals = {'events': 0, 'outcomes': {}}
+        lock, stop = threading.Lock(), threading.Event()
+        threads = [
+            threading.Thread(target=self.consume, args=(options, totals, lock, stop), daemon=True)
+            for _ in range(max(options['threads'], 1))
+        ]
+        self.stdout.write(f'Starting webhook consumer with {len(threads)} threads')
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        totals['elapsed_seconds'] = round(time.perf_counter() - started, 3)
+        self.stdout.write(json.dumps(totals, indent=2))
@@ -0,0 +1,173 @@
+"""
+Load-test the M-Pesa webhook in sync and inbox mode.
+
+Creates pending transactions in a throwaway database, posts a callback for
+each (plus redeliveries) through the full Django stack and reports webhook
+latency percentiles. In inbox mode it then drains the inbox and reports how
+fast the consumer applies events. --db-delay adds a pause to every query to
+show how a slow database affects acknowledgement latency.
+
+SQLite serializes writers, so keep --concurrency at 1 unless the database
+is PostgreSQL.
+
+Usage:
+    python manage.py webhook_load
+    python manage.py webhook_load --callbacks 1000 --db-delay 2 --output webhooks.json
+"""
+import json
+import time
+import random
+import threading
+from contextlib import nullcontext
+from decimal import Decimal
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from apps.marketplace.models import Order
+from apps.payments import webhooks
+from apps.payments.models import Transaction
+from digi_farm.benchmarking import benchmark_environment, build_report, summarize, write_report
+
+User = get_user_model()
+MODES = ('sync', 'inbox')
+WEBHOOK_URL = '/api/payments/mpesa/webhook/'
+
+
+def callback(checkout_request_id, result_code, receipt):
+    items = [
+        {'Name': 'Amount', 'Value': 100},
+        {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+        {'Name': 'TransactionDate', 'Value': 20240101120000},
+        {'Name': 'PhoneNumber', 'Value': 254712345678},
+    ] if result_code == 0 else []
+    return {'Body': {'stkCallback': {
+        'MerchantRequestID': f'MR{receipt}',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0 else 'Request cancelled by user',
+        'CallbackMetadata': {'Item': items},
+    }}}
+
+
+class Command(BaseCommand):
+    help = 'Measure M-Pesa webhook latency under load, applying callbacks in the request or via the inbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--callbacks', type=int, default=300, help='Transactions to settle per mode')
+        parser.add_argument('--duplicates', type=float, default=0.1, help='Share of callbacks redelivered')
+        parser.add_argument('--failures', type=float, default=0.2, help='Share of failed payments')
+        parser.add_argument('--concurrency', type=int, default=1, help='Threads posting callbacks')
+        parser.add_argument('--db-delay', type=float, default=0.0, help='Milliseconds added to every query')
+        parser.add_argument('--modes', default=','.join(MODES), help='Comma-separated modes to run')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the callback mix')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def create_transactions(self, mode, count):
+        customer = User.objects.create_user(email=f'webhook-load-{mode}@example.com', password='benchpass123')
+        orders = Order.objects.bulk_create([
+            Order(customer=customer, total_amount=Decimal('100.00'), shipping_address='Load test',
+                  shipping_county='Nairobi', shipping_phone='+254712345678')
+            for _ in range(count)
+        ])
+        Transaction.objects.bulk_create([
+            Transaction(order=order, checkout_request_id=f'ws_CO_{mode}_{i}', amount=order.total_amount,
+                        phone='+254712345678', status='initiated')
+            for i, order in enumerate(orders)
+        ])
+
+    def post_all(self, bodies, concurrency, delay):
+        samples, statuses = [], []
+        lock = threading.Lock()
+        queue = list(enumerate(bodies))
+
+        def slow_query(execute, sql, params, many, context):
+            time.sleep(delay)
+            return execute(sql, params, many, context)
+
+        def worker():
+            client = Client()
+            try:
+                with connection.execute_wrapper(slow_query) if delay else nullcontext():
+                    while True:
+                        with lock:
+                            if not queue:
+                                return
+                            _, body = queue.pop(0)
+                        started = time.perf_counter()
+                        response = client.post(WEBHOOK_URL, data=json.dumps(body), content_type='application/json')
+                        elapsed = time.perf_counter() - started
+                        with lock:
+                            samples.append(elapsed)
+                            statuses.append(response.status_code)
+            finally:
+                if threading.current_thread() is not threading.main_thread():
+                    connection.close()
+
+        if concurrency <= 1:
+            worker()
+        else:
+            threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return samples, statuses
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        modes = [m for m in options['modes'].split(',') if m]
+        count = options['callbacks']
+        results = []
+        with benchmark_environment():
+            for mode in modes:
+                self.create_transactions(mode, count)
+                bodies = [
+                    callback(f'ws_CO_{mode}_{i}', 1032 if rng.random() < options['failures'] else 0, f'LT{mode[:1].upper()}{i:08d}')
+                    for i in range(count)
+                ]
+                bodies += rng.sample(bodies, int(count * options['duplicates']))
+                rng.shuffle(bodies)
+
+                with override_settings(MPESA_WEBHOOK_MODE=mode):
+                    started = time.perf_counter()
+                    samples, statuses = self.post_all(bodies, options['concurrency'], options['db_delay'] / 1000)
+                    elapsed = time.perf_counter() - started
+
+                row = {
+                    'mode': mode,
+                    'callbacks': len(bodies),
+                    'latency': summarize(samples),
+                    'callbacks_per_second': round(len(bodies) / elapsed, 2),
+                    'errors': sum(1 for s in statuses if s >= 400),
+                }
+                if mode == 'inbox':
+                    drain = webhooks.consume()
+                    row['consumer'] = {
+                        'events': drain['events'],
+                        'outcomes': drain['outcomes'],
+                        'events_per_second': round(drain['events'] / drain['elapsed_seconds'], 2)
+                        if drain['elapsed_seconds'] else None,
+                    }
+                row['unsettled'] = Transaction.objects.filter(
+                    checkout_request_id__startswith=f'ws_CO_{mode}_', status__in=['initiated', 'pending']
+                ).count()
+                results.append(row)
+
+        report = build_report('webhooks', {
+            'callbacks': count,
+            'duplicates': options['duplicates'],
+            'failures': options['failures'],
+            'concurrency': options['concurrency'],
+            'db_delay_ms': options['db_delay'],
+            'seed': options['seed'],
+        }, results)
+        write_report(report, path=options['output'], stream=self.stdout)
+        if options['output']:
+            for row in results:
+                self.stdout.write(
+                    f"{row['mode']:>6}: p50 {row['latency']['p50_ms']} ms, p99 {row['latency']['p99_ms']} ms, "
+                    f"{row['callbacks_per_second']} callbacks/s, {row['unsettled']} unsettled"
+                )
+
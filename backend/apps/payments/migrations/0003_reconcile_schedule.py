@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:46
+
+import apps.payments.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0002_webhookevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="transaction",
+            name="check_attempts",
+            field=models.PositiveIntegerField(
+                default=0, help_text="STK status queries made so far"
+            ),
+        ),
+        migrations.AddField(
+            model_name="transaction",
+            name="next_check_at",
+            field=models.DateTimeField(
+                default=apps.payments.models.first_check_at,
+                help_text="When reconciliation next queries the STK push status",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["status", "next_check_at"], name="transaction_status_e927b8_idx"
+            ),
+        ),
+    ]
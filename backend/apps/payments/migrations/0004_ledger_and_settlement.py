@@ -0,0 +1,145 @@
+# Generated by Django 4.2.7 on 2026-10-18 01:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("marketplace", "0002_alter_product_is_verified"),
+        ("payments", "0003_reconcile_schedule"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SettlementRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("last_entry_id", models.PositiveBigIntegerField(default=0)),
+                (
+                    "entries",
+                    models.PositiveIntegerField(
+                        default=0, help_text="Payments settled in this run"
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "db_table": "settlement_runs",
+                "ordering": ["-id"],
+            },
+        ),
+        migrations.CreateModel(
+            name="VendorSettlement",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                (
+                    "gross_amount",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "items",
+                    models.PositiveIntegerField(default=0, help_text="Units sold"),
+                ),
+                ("orders", models.PositiveIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "vendor",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="settlements",
+                        to="marketplace.vendor",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "vendor_settlements",
+                "ordering": ["date", "vendor"],
+                "indexes": [
+                    models.Index(fields=["date"], name="vendor_sett_date_2e142c_idx")
+                ],
+                "unique_together": {("vendor", "date")},
+            },
+        ),
+        migrations.CreateModel(
+            name="LedgerEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("initiated", "Initiated"),
+                            ("pending", "Pending"),
+                            ("success", "Success"),
+                            ("failed", "Failed"),
+                            ("cancelled", "Cancelled"),
+                        ],
+                        help_text="Status entered",
+                        max_length=20,
+                    ),
+                ),
+                ("amount", models.DecimalField(decimal_places=2, max_digits=10)),
+                ("mpesa_transaction_id", models.CharField(blank=True, max_length=50)),
+                (
+                    "created_at",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now
+                    ),
+                ),
+                (
+                    "order",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="ledger_entries",
+                        to="marketplace.order",
+                    ),
+                ),
+                (
+                    "transaction",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="ledger_entries",
+                        to="payments.transaction",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "Ledger entries",
+                "db_table": "ledger_entries",
+                "ordering": ["id"],
+                "indexes": [
+                    models.Index(
+                        fields=["status", "id"], name="ledger_entr_status_de3250_idx"
+                    )
+                ],
+            },
+        ),
+    ]
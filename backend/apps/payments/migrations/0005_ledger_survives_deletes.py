@@ -0,0 +1,71 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.db.models import F
+import django.db.models.deletion
+
+
+def copy_refs(apps, schema_editor):
+    """Keep the ids of existing entries' transactions and orders."""
+    LedgerEntry = apps.get_model("payments", "LedgerEntry")
+    LedgerEntry.objects.update(
+        transaction_ref=F("transaction_id"), order_ref=F("order_id")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("marketplace", "0002_alter_product_is_verified"),
+        ("payments", "0004_ledger_and_settlement"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ledgerentry",
+            name="order_ref",
+            field=models.PositiveBigIntegerField(
+                default=0, help_text="Order id, kept if it is deleted"
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="ledgerentry",
+            name="transaction_ref",
+            field=models.PositiveBigIntegerField(
+                default=0, help_text="Transaction id, kept if it is deleted"
+            ),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copy_refs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="ledgerentry",
+            name="order",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="ledger_entries",
+                to="marketplace.order",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="ledgerentry",
+            name="transaction",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="ledger_entries",
+                to="payments.transaction",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="vendorsettlement",
+            name="vendor",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="settlements",
+                to="marketplace.vendor",
+            ),
+        ),
+    ]
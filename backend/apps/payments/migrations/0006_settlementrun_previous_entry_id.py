@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+def chain_runs(apps, schema_editor):
+    """Each existing run started where the one before it stopped."""
+    SettlementRun = apps.get_model("payments", "SettlementRun")
+    previous = 0
+    for run in SettlementRun.objects.order_by("id"):
+        run.previous_entry_id = previous
+        run.save(update_fields=["previous_entry_id"])
+        previous = run.last_entry_id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("payments", "0005_ledger_survives_deletes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="settlementrun",
+            name="previous_entry_id",
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.RunPython(chain_runs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="settlementrun",
+            name="previous_entry_id",
+            field=models.PositiveBigIntegerField(
+                help_text="last_entry_id of the run before", unique=True
+            ),
+        ),
+    ]
@@ -1,8 +1,16 @@
+from datetime import timedelta
+from django.conf import settings
 from django.db import models
 from django.core.validators import RegexValidator
+from django.utils import timezone
 from apps.marketplace.models import Order
 
 
+def first_check_at():
+    """When the reconciler should first ask Daraja about a new STK push."""
+    return timezone.now() + timedelta(seconds=settings.MPESA_RECONCILE_FIRST_CHECK)
+
+
 class Transaction(models.Model):
     """Transaction model for M-Pesa payments."""
     STATUS_CHOICES = [
@@ -46,6 +54,11 @@ class Transaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     completed_at = models.DateTimeField(null=True, blank=True)
+    next_check_at = models.DateTimeField(
+        default=first_check_at,
+        help_text='When reconciliation next queries the STK push status'
+    )
+    check_attempts = models.PositiveIntegerField(default=0, help_text='STK status queries made so far')
     
     class Meta:
         db_table = 'transactions'
@@ -54,10 +67,145 @@ class Transaction(models.Model):
             models.Index(fields=['checkout_request_id']),
             models.Index(fields=['status']),
             models.Index(fields=['order']),
-            models.Index(fields=['created_at']),
+            # Keyset pagination seeks on (created_at, id); see apps.payments.pagination
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['status', 'next_check_at']),
         ]
         ordering = ['-created_at']
     
     def __str__(self):
         return f"Transaction {self.id} - {self.status} - {self.amount}"
 
+
+class WebhookEvent(models.Model):
+    """
+    Inbox of raw M-Pesa callbacks.
+    
+    In inbox mode the webhook stores each callback here in a single insert
+    and acknowledges it at once; consumers apply the events in batches (see
+    apps.payments.webhooks).
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('processed', 'Processed'),
+        ('failed', 'Failed'),
+    ]
+    
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
+    payload = models.JSONField(help_text='Callback body as received')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    outcome = models.CharField(max_length=20, blank=True, help_text='What applying the event did, e.g. success or duplicate')
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    received_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'webhook_events'
+        indexes = [
+            models.Index(fields=['status', 'id']),
+            models.Index(fields=['received_at']),
+        ]
+        ordering = ['-received_at']
+    
+    def __str__(self):
+        return f"Webhook {self.id} - {self.checkout_request_id} - {self.status}"
+
+
+class LedgerEntryQuerySet(models.QuerySet):
+    """Bulk updates and deletes would bypass LedgerEntry.save() and delete()."""
+    
+    def update(self, **kwargs):
+        raise ValueError('Ledger entries are append-only')
+    
+    def delete(self):
+        raise ValueError('Ledger entries are append-only')
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only record of payment status changes.
+    
+    One row is written in the same database transaction as each status
+    change (see apps.payments.transitions); rows are never updated or
+    deleted. Settlement and finance exports read from here instead of
+    scanning transactions.
+    
+    Deleting an order (or the customer who placed it) keeps its entries:
+    the foreign keys are cleared and transaction_ref and order_ref still
+    say what the entry was for.
+    """
+    transaction = models.ForeignKey(Transaction, on_delete=models.SET_NULL, null=True, related_name='ledger_entries')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, related_name='ledger_entries')
+    transaction_ref = models.PositiveBigIntegerField(help_text='Transaction id, kept if it is deleted')
+    order_ref = models.PositiveBigIntegerField(help_text='Order id, kept if it is deleted')
+    status = models.CharField(max_length=20, choices=Transaction.STATUS_CHOICES, help_text='Status entered')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    mpesa_transaction_id = models.CharField(max_length=50, blank=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    
+    objects = LedgerEntryQuerySet.as_manager()
+    
+    class Meta:
+        db_table = 'ledger_entries'
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+        ordering = ['id']
+        verbose_name_plural = 'Ledger entries'
+    
+    def __str__(self):
+        return f"Ledger {self.id} - transaction {self.transaction_ref} {self.status} {self.amount}"
+    
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError('Ledger entries are append-only')
+        super().save(*args, **kwargs)
+    
+    def delete(self, *args, **kwargs):
+        raise ValueError('Ledger entries are append-only')
+
+
+class VendorSettlement(models.Model):
+    """Paid order item totals per vendor and payment day (see apps.payments.settlement)."""
+    # Cleared if the vendor is deleted; the totals stay for the books
+    vendor = models.ForeignKey('marketplace.Vendor', on_delete=models.SET_NULL, null=True, related_name='settlements')
+    date = models.DateField()
+    gross_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    items = models.PositiveIntegerField(default=0, help_text='Units sold')
+    orders = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'vendor_settlements'
+        unique_together = ['vendor', 'date']
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+        ordering = ['date', 'vendor']
+    
+    def __str__(self):
+        return f"Settlement {self.vendor_id} {self.date} - {self.gross_amount}"
+
+
+class SettlementRun(models.Model):
+    """
+    One incremental settlement pass. last_entry_id is the highest ledger
+    entry included so far; the next run starts after it.
+    
+    previous_entry_id is where the pass started. It is unique, so two runs
+    that read the same checkpoint cannot both settle the entries after it.
+    """
+    previous_entry_id = models.PositiveBigIntegerField(unique=True, help_text='last_entry_id of the run before')
+    last_entry_id = models.PositiveBigIntegerField(default=0)
+    entries = models.PositiveIntegerField(default=0, help_text='Payments settled in this run')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'settlement_runs'
+        ordering = ['-id']
+    
+    def __str__(self):
+        return f"Settlement run {self.id} up to ledger entry {self.last_entry_id}"
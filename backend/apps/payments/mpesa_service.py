@@ -1,17 +1,74 @@
 """
 M-Pesa Daraja API integration service.
+
+Every MPesaService shares two things, so constructing one per payment is
+cheap:
+
+* one keep-alive requests.Session per process, with a connection pool of
+  MPESA_POOL_SIZE, so calls reuse TLS connections to Daraja;
+* one OAuth access token for all processes and workers, kept in the Django
+  cache (and memoised in the process). It is refreshed MPESA_TOKEN_REFRESH_MARGIN
+  seconds before it expires, by a single caller at a time: concurrent
+  callers wait for that refresh instead of each requesting a token.
+
+AsyncMPesaService offers the same calls to asyncio code.
 """
 import os
+import time
+import uuid
 import base64
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import json
 from datetime import datetime
 from django.conf import settings
-from django.utils import timezone
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from . import events
 import logging
 
 logger = logging.getLogger(__name__)
 
+BASE_URLS = {
+    'sandbox': 'https://sandbox.safaricom.co.ke',
+    'production': 'https://api.safaricom.co.ke',
+}
+TOKEN_LOCK_TIMEOUT = 30  # seconds; longest a token refresh may hold the lock
+
+_sessions = {}
+_session_lock = threading.Lock()
+_token_lock = threading.Lock()
+_token = {}
+
+
+def get_session():
+    """Process-wide pooled HTTP session (recreated after a fork)."""
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        with _session_lock:
+            session = _sessions.get(pid)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=settings.MPESA_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions.clear()
+                _sessions[pid] = session
+    return session
+
+
+def reset_client():
+    """Drop pooled connections and the memoised token (used by tests and benchmarks)."""
+    with _session_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+    _token.clear()
+
 
 class MPesaService:
     """Service class for M-Pesa Daraja API operations."""
@@ -26,23 +83,67 @@ class MPesaService:
         self.lnm_expiry = settings.MPESA_LNM_EXPIRY
         
         # Base URLs
-        if self.env == 'sandbox':
-            self.base_url = 'https://sandbox.safaricom.co.ke'
-        else:
-            self.base_url = 'https://api.safaricom.co.ke'
+        self.base_url = settings.MPESA_BASE_URL or BASE_URLS.get(self.env, BASE_URLS['production'])
+        self.session = get_session()
         
-        self.access_token = None
-        self.token_expiry = None
+        # Tokens belong to an app's credentials on one environment
+        credentials = hashlib.sha256(f'{self.base_url}:{self.consumer_key}'.encode()).hexdigest()[:16]
+        self.token_key = f'mpesa:access-token:{credentials}'
     
-    def get_access_token(self):
+    def get_access_token(self, rejected=None):
         """
-        Get OAuth access token from M-Pesa.
+        Get the shared OAuth access token, refreshing it shortly before expiry.
+        
+        Args:
+            rejected: A token Daraja refused; it is discarded unless another
+                caller has already replaced it
+        
         Returns: access_token string
         """
-        # Check if we have a valid cached token
-        if self.access_token and self.token_expiry and timezone.now() < self.token_expiry:
-            return self.access_token
+        token = self.valid_token(_token.get(self.token_key))
+        if token and token != rejected:
+            return token
+        
+        with _token_lock:
+            lock_key = f'{self.token_key}:lock'
+            owner = uuid.uuid4().hex
+            deadline = time.monotonic() + TOKEN_LOCK_TIMEOUT
+            while True:
+                token = self.valid_token(cache.get(self.token_key))
+                if token == rejected:
+                    cache.delete(self.token_key)
+                    token = None
+                if token:
+                    _token[self.token_key] = cache.get(self.token_key)
+                    return token
+                # Single flight across processes: one caller refreshes, the rest wait for it.
+                # A holder that outlives the lock timeout no longer blocks the others.
+                if cache.add(lock_key, owner, TOKEN_LOCK_TIMEOUT) or time.monotonic() >= deadline:
+                    break
+                time.sleep(0.05)
+            try:
+                entry = self.request_access_token()
+                cache.set(self.token_key, entry, max(int(entry['expires_at'] - time.time()), 1))
+                _token[self.token_key] = entry
+                return entry['token']
+            finally:
+                # Only release our own lock, not one taken after we gave up waiting
+                if cache.get(lock_key) == owner:
+                    cache.delete(lock_key)
+    
+    @staticmethod
+    def valid_token(entry):
+        if entry and entry['expires_at'] - settings.MPESA_TOKEN_REFRESH_MARGIN > time.time():
+            return entry['token']
+        return None
+    
+    def request_access_token(self):
+        """
+        Request a new OAuth access token from M-Pesa.
         
+        Returns:
+            dict with the token and its expiry as a Unix timestamp
+        """
         url = f'{self.base_url}/oauth/v1/generate?grant_type=client_credentials'
         
         # Basic authentication
@@ -55,17 +156,14 @@ class MPesaService:
         }
         
         try:
-            response = requests.get(url, headers=headers, timeout=10)
+            response = self.session.get(url, headers=headers, timeout=10)
             response.raise_for_status()
             data = response.json()
             
-            self.access_token = data.get('access_token')
-            # Token expires in ~3600 seconds, cache for 3500 seconds
-            from datetime import timedelta
-            self.token_expiry = timezone.now() + timedelta(seconds=3500)
-            
+            # Daraja tokens last an hour; expires_in is a string of seconds
+            expires_in = int(data.get('expires_in') or 3600)
             logger.info('M-Pesa access token obtained successfully')
-            return self.access_token
+            return {'token': data.get('access_token'), 'expires_at': time.time() + expires_in}
         
         except requests.exceptions.RequestException as e:
             logger.error(f'Failed to get M-Pesa access token: {str(e)}')
@@ -82,6 +180,27 @@ class MPesaService:
         password_b64 = base64.b64encode(password_bytes).decode('ascii')
         return password_b64, timestamp
     
+    def post(self, path, payload, timeout):
+        """
+        POST to Daraja with the shared token, refreshing it once if rejected.
+        
+        Returns:
+            requests.Response (status already checked)
+        """
+        url = f'{self.base_url}{path}'
+        token = self.get_access_token()
+        for attempt in range(2):
+            headers = {
+                'Authorization': f'Bearer {token}',
+                'Content-Type': 'application/json'
+            }
+            response = self.session.post(url, json=payload, headers=headers, timeout=timeout)
+            # 401: the token was revoked or expired early
+            if response.status_code != 401 or attempt:
+                response.raise_for_status()
+                return response
+            token = self.get_access_token(rejected=token)
+    
     def initiate_stk_push(self, phone_number, amount, account_reference, transaction_desc):
         """
         Initiate STK Push payment request.
@@ -95,13 +214,9 @@ class MPesaService:
         Returns:
             dict with checkout_request_id and response_code
         """
-        access_token = self.get_access_token()
-        
         # Remove + from phone number for M-Pesa API
         phone = phone_number.replace('+', '')
         
-        url = f'{self.base_url}/mpesa/stkpush/v1/processrequest'
-        
         password, timestamp = self.generate_password()
         
         payload = {
@@ -118,17 +233,18 @@ class MPesaService:
             'TransactionDesc': transaction_desc
         }
         
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
+            response = self.post('/mpesa/stkpush/v1/processrequest', payload, timeout=30)
             data = response.json()
             
-            logger.info(f'STK Push initiated: {data}')
+            events.log(
+                'stk.initiated',
+                checkout_request_id=data.get('CheckoutRequestID'),
+                merchant_request_id=data.get('MerchantRequestID'),
+                response_code=data.get('ResponseCode'),
+                account_reference=str(account_reference),
+                phone=phone
+            )
             
             return {
                 'checkout_request_id': data.get('CheckoutRequestID'),
@@ -159,10 +275,6 @@ class MPesaService:
         Returns:
             dict with transaction status
         """
-        access_token = self.get_access_token()
-        
-        url = f'{self.base_url}/mpesa/stkpushquery/v1/query'
-        
         password, timestamp = self.generate_password()
         
         payload = {
@@ -172,14 +284,8 @@ class MPesaService:
             'CheckoutRequestID': checkout_request_id
         }
         
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
+            response = self.post('/mpesa/stkpushquery/v1/query', payload, timeout=30)
             data = response.json()
             
             return {
@@ -194,6 +300,49 @@ class MPesaService:
             raise Exception(f'Failed to query STK status: {str(e)}')
 
 
+class AsyncMPesaService:
+    """
+    asyncio front end for MPesaService.
+    
+    Calls run on a small thread pool over the same pooled session and shared
+    token, so many coroutines can have payments in flight while at most
+    concurrency (default MPESA_POOL_SIZE) Daraja calls, and connections, are
+    open at once.
+    
+    Use as an async context manager, or call close() when done.
+    """
+    
+    def __init__(self, service=None, concurrency=None):
+        self.service = service or MPesaService()
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency or settings.MPESA_POOL_SIZE, thread_name_prefix='mpesa'
+        )
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        self.executor.shutdown(wait=False)
+    
+    async def call(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, getattr(self.service, method), *args)
+    
+    async def get_access_token(self):
+        return await self.call('get_access_token')
+    
+    async def initiate_stk_push(self, phone_number, amount, account_reference, transaction_desc):
+        return await self.call(
+            'initiate_stk_push', phone_number, amount, account_reference, transaction_desc
+        )
+    
+    async def query_stk_status(self, checkout_request_id):
+        return await self.call('query_stk_status', checkout_request_id)
+
+
 def parse_mpesa_callback(data):
     """
     Parse M-Pesa callback/webhook data.
@@ -0,0 +1,265 @@
+"""
+Reconciliation of STK pushes that never received a callback.
+
+Each open transaction carries next_check_at. A run only queries the ones
+that are due (indexed on status, next_check_at), so the Daraja query volume
+follows the number of due checks rather than the size of the backlog. A
+push that is still being processed is checked again after an exponential
+backoff (MPESA_RECONCILE_BACKOFF, doubling up to MPESA_RECONCILE_MAX_BACKOFF)
+and cancelled once MPESA_LNM_EXPIRY has passed. A push whose status query
+fails stays open and keeps being checked, past expiry if need be: only a
+Daraja result settles it.
+
+Due transactions are processed in id order, in chunks of
+MPESA_RECONCILE_BATCH_SIZE. For each chunk the STK status queries are
+fanned out over a thread pool of MPESA_RECONCILE_CONCURRENCY, paced to
+MPESA_RECONCILE_RATE queries per second in total, and the outcomes are
+applied through transitions in one short transaction.
+
+A chunk is claimed before it is queried, by moving next_check_at
+CLAIM_LEASE ahead, so a run that overlaps a slow earlier one does not
+query the same transactions again. If a run dies, its transactions become
+due again once the lease has passed.
+
+Large backlogs can be split by id range into MPESA_RECONCILE_SHARDS Celery
+tasks (see tasks.reconcile_pending_transactions); each shard gets an equal
+share of the query rate. Progress for each shard is kept in the cache.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+from . import transitions
+from .models import Transaction
+from .mpesa_service import MPesaService
+
+logger = logging.getLogger(__name__)
+
+PROCESSING_CODE = 1032  # Daraja: request still being processed
+PROGRESS_KEY = 'payments:reconcile:progress:{}'
+CLAIM_LEASE = timedelta(minutes=15)  # longer than one chunk of queries takes
+
+
+class RateLimiter:
+    """Spaces calls from any number of threads to at most rate per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_at)
+            self.next_at = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def result_code(result):
+    """Daraja returns ResultCode as a string from the query API."""
+    try:
+        return int(result.get('result_code'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempts):
+    """Seconds to wait after the given number of inconclusive status queries."""
+    delay = settings.MPESA_RECONCILE_BACKOFF * 2 ** max(attempts - 1, 0)
+    return min(delay, settings.MPESA_RECONCILE_MAX_BACKOFF)
+
+
+def expires_at(txn):
+    """When Daraja gives up on the STK push and it can no longer be paid."""
+    return txn.created_at + timedelta(seconds=settings.MPESA_LNM_EXPIRY)
+
+
+def pending_transactions(start_id=None, end_id=None, now=None):
+    """Open STK pushes whose next status check is due, optionally in [start_id, end_id)."""
+    queryset = Transaction.objects.filter(
+        status__in=transitions.OPEN_STATUSES,
+        next_check_at__lte=now or timezone.now(),
+        checkout_request_id__isnull=False
+    )
+    if start_id is not None:
+        queryset = queryset.filter(id__gte=start_id)
+    if end_id is not None:
+        queryset = queryset.filter(id__lt=end_id)
+    return queryset
+
+
+def shard_ranges(shards):
+    """
+    Split the id range of pending transactions into equal parts.
+
+    Returns:
+        list of (start_id, end_id) with end_id exclusive
+    """
+    ids = pending_transactions().order_by('id').values_list('id', flat=True)
+    first = ids.first()
+    if first is None:
+        return []
+    last = ids.reverse().first()
+    step = max((last - first + 1 + shards - 1) // shards, 1)
+    return [(start, min(start + step, last + 1)) for start in range(first, last + 1, step)]
+
+
+class Reconciler:
+    """
+    Reconcile one id range of pending transactions.
+
+    Args:
+        start_id, end_id: Id range to work on (end exclusive); None for all
+        shard: Name used for the progress key and logs
+        rate: Status queries per second for this reconciler
+    """
+
+    def __init__(self, start_id=None, end_id=None, shard='all', rate=None, concurrency=None, batch_size=None):
+        self.start_id = start_id
+        self.end_id = end_id
+        self.shard = shard
+        self.limiter = RateLimiter(settings.MPESA_RECONCILE_RATE if rate is None else rate)
+        self.concurrency = concurrency or settings.MPESA_RECONCILE_CONCURRENCY
+        self.batch_size = batch_size or settings.MPESA_RECONCILE_BATCH_SIZE
+        self.service = MPesaService()
+        self.stats = {
+            'shard': shard,
+            'queried': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'still_pending': 0,
+            'cancelled': 0,
+            'errors': 0,
+            'last_id': None,
+            'elapsed_seconds': 0.0,
+        }
+
+    def claim(self, chunk, due_at):
+        """
+        Take the transactions of a chunk that are still due for this run.
+
+        Returns:
+            the claimed transactions
+        """
+        lease = timezone.now() + CLAIM_LEASE
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                ids = list(
+                    Transaction.objects.filter(id__in=[txn.id for txn in chunk], next_check_at__lte=due_at)
+                    .select_for_update(skip_locked=True).values_list('id', flat=True)
+                )
+                Transaction.objects.filter(id__in=ids).update(next_check_at=lease)
+        else:
+            ids = [
+                txn.id for txn in chunk
+                if Transaction.objects.filter(id=txn.id, next_check_at=txn.next_check_at).update(next_check_at=lease)
+            ]
+        ids = set(ids)
+        return [txn for txn in chunk if txn.id in ids]
+
+    def query(self, txn):
+        self.limiter.wait()
+        try:
+            return txn, self.service.query_stk_status(txn.checkout_request_id)
+        except Exception as e:
+            logger.error(f'Error reconciling transaction {txn.id}: {str(e)}')
+            return txn, None
+
+    def apply(self, outcomes):
+        """Write one chunk of query results in a single short transaction."""
+        now = timezone.now()
+        succeeded, failed, expired, retry = [], [], [], []
+        for txn, result in outcomes:
+            code = result_code(result) if result is not None else None
+            if result is None:
+                self.stats['errors'] += 1
+            elif code == 0:
+                succeeded.append((txn, result))
+                continue
+            elif code == PROCESSING_CODE:
+                self.stats['still_pending'] += 1
+            else:
+                failed.append((txn, result))
+                continue
+            # Inconclusive: check again later. Only a push Daraja still reports as
+            # processing is given up once expired; a query that failed never
+            # cancels, as the customer may have been charged
+            if result is not None and expires_at(txn) <= now:
+                expired.append(txn)
+            else:
+                txn.check_attempts += 1
+                next_check_at = now + timedelta(seconds=backoff(txn.check_attempts))
+                txn.next_check_at = min(next_check_at, expires_at(txn)) if expires_at(txn) > now else next_check_at
+                retry.append(txn)
+
+        paid_orders = set()
+        with transaction.atomic():
+            # A webhook may have settled some of these since they were read;
+            # transitions leaves those alone
+            for txn, result in succeeded:
+                receipt = result.get('raw_response', {}).get('MpesaReceiptNumber')
+                if transitions.succeed(txn, receipt, result['raw_response'], now=now, pay_order=False):
+                    paid_orders.add(txn.order_id)
+                    self.stats['succeeded'] += 1
+            for txn, result in failed:
+                reason = result.get('result_desc') or 'Transaction failed'
+                if transitions.fail(txn, reason, result['raw_response'], now=now):
+                    self.stats['failed'] += 1
+            for txn in expired:
+                if transitions.fail(txn, 'STK push expired without confirmation', now=now, to='cancelled'):
+                    self.stats['cancelled'] += 1
+            transitions.pay_orders(paid_orders, now=now)
+            # Schedule fields only; the status of a row settled meanwhile is untouched
+            Transaction.objects.bulk_update(retry, ['check_attempts', 'next_check_at'])
+
+    def report_progress(self, started):
+        self.stats['elapsed_seconds'] = round(time.perf_counter() - started, 3)
+        cache.set(PROGRESS_KEY.format(self.shard), dict(self.stats, updated_at=timezone.now().isoformat()), 24 * 60 * 60)
+
+    def run(self):
+        """
+        Work through the range chunk by chunk.
+
+        Returns:
+            dict of counts for this run
+        """
+        started = time.perf_counter()
+        # Due as of the start, so rows rescheduled in this run are not picked up again
+        due_at = timezone.now()
+        queryset = pending_transactions(self.start_id, self.end_id, now=due_at).only(
+            'id', 'order_id', 'checkout_request_id', 'status', 'created_at', 'check_attempts', 'next_check_at'
+        ).order_by('id')
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='reconcile') as pool:
+            while True:
+                chunk = list(queryset.filter(id__gt=last_id)[:self.batch_size])
+                if not chunk:
+                    break
+                last_id = chunk[-1].id
+                claimed = self.claim(chunk, due_at)
+                self.apply(list(pool.map(self.query, claimed)))
+                self.stats['queried'] += len(claimed)
+                self.stats['last_id'] = last_id
+                self.report_progress(started)
+                logger.info(
+                    f"Reconciliation {self.shard}: {self.stats['queried']} queried, "
+                    f"{self.stats['succeeded']} succeeded, {self.stats['failed']} failed (up to id {last_id})"
+                )
+        self.report_progress(started)
+        return dict(self.stats)
+
+
+def progress(shards=None):
+    """Latest progress reports, keyed by shard name."""
+    shards = shards or settings.MPESA_RECONCILE_SHARDS
+    keys = {PROGRESS_KEY.format(name): name for name in ['all'] + [f'{i + 1}/{shards}' for i in range(shards)]}
+    return {keys[key]: report for key, report in cache.get_many(list(keys)).items()}
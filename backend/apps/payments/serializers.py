@@ -4,9 +4,19 @@ from apps.marketplace.serializers import OrderSerializer
 
 
 class TransactionSerializer(serializers.ModelSerializer):
-    """Serializer for Transaction model."""
+    """
+    Serializer for Transaction model.
+    
+    Pass fields=[...] to return only those fields (sparse fieldsets).
+    """
     order = OrderSerializer(read_only=True)
     
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+    
     class Meta:
         model = Transaction
         fields = ('id', 'order', 'mpesa_transaction_id', 'checkout_request_id',
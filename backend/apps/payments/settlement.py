@@ -0,0 +1,204 @@
+"""
+Daily per-vendor settlement and streamed finance exports.
+
+settle() folds new successful payments from the ledger into
+VendorSettlement rows: for each paid order, the order items are summed per
+vendor on the day its first payment succeeded. It is incremental. Every chunk of
+SETTLEMENT_BATCH_SIZE ledger entries is applied together with a
+SettlementRun that records the last entry included, so a run picks up
+where the previous one stopped and an interrupted run loses nothing.
+Runs are serialised by a cache lock, and a SettlementRun can only be
+written once from each checkpoint: a run that outlived its lock and finds
+the checkpoint moved rolls back its chunk instead of counting it twice.
+Entries younger than SETTLEMENT_LAG seconds are left for the next run, so
+a payment whose database transaction commits late is not skipped.
+
+The exports stream query results in chunks of SETTLEMENT_EXPORT_CHUNK_SIZE
+rows, so memory stays flat however many rows there are. CSV writes one row
+per line. The columnar format writes one JSON object per chunk, holding a
+list of values per column (row groups, as in Parquet).
+"""
+import io
+import csv
+import json
+import uuid
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DecimalField, Exists, F, OuterRef, Subquery, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from apps.marketplace.models import OrderItem
+from .models import LedgerEntry, SettlementRun, VendorSettlement
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = 'payments:settlement:lock'
+LOCK_TIMEOUT = 60 * 60
+
+SETTLEMENT_COLUMNS = ['date', 'vendor_id', 'vendor__business_name', 'gross_amount', 'items', 'orders']
+LEDGER_COLUMNS = ['id', 'created_at', 'status', 'transaction_ref', 'order_ref', 'amount', 'mpesa_transaction_id']
+FORMATS = {
+    # format -> (content type, file extension)
+    'csv': ('text/csv', 'csv'),
+    'columns': ('application/x-ndjson', 'jsonl'),
+}
+
+
+def vendor_totals(first_id, last_id):
+    """
+    Order item totals per vendor and payment day for the orders first paid
+    among ledger entries first_id..last_id.
+
+    An order is counted once, on the day of its first successful payment,
+    however many successful payments it has.
+    """
+    payments = LedgerEntry.objects.filter(order=OuterRef('order_id'), status='success')
+    return (
+        OrderItem.objects
+        .annotate(paid_at=Subquery(
+            payments.filter(id__gte=first_id, id__lte=last_id).order_by('id').values('created_at')[:1]
+        ))
+        .filter(~Exists(payments.filter(id__lt=first_id)), paid_at__isnull=False)
+        .values(vendor_id=F('product__vendor_id'), date=TruncDate('paid_at'))
+        .annotate(
+            gross_amount=Sum(F('quantity') * F('price'), output_field=DecimalField(max_digits=14, decimal_places=2)),
+            items=Sum('quantity'),
+            orders=Count('order_id', distinct=True)
+        )
+        .order_by()
+    )
+
+
+def add_totals(rows):
+    """Add per-vendor, per-day totals to the settlement table."""
+    rows = list(rows)
+    existing = {
+        (s.vendor_id, s.date): s.id
+        for s in VendorSettlement.objects.filter(
+            vendor_id__in={row['vendor_id'] for row in rows},
+            date__in={row['date'] for row in rows}
+        ).only('id', 'vendor_id', 'date')
+    }
+    new = []
+    for row in rows:
+        settlement_id = existing.get((row['vendor_id'], row['date']))
+        if settlement_id is None:
+            new.append(VendorSettlement(**row))
+        else:
+            VendorSettlement.objects.filter(id=settlement_id).update(
+                gross_amount=F('gross_amount') + row['gross_amount'],
+                items=F('items') + row['items'],
+                orders=F('orders') + row['orders'],
+                updated_at=timezone.now()
+            )
+    VendorSettlement.objects.bulk_create(new)
+
+
+def settle(batch_size=None, now=None):
+    """
+    Settle ledger entries added since the last run.
+
+    Returns:
+        dict with the number of payments settled and the last ledger entry
+        included, or None if another run holds the lock
+    """
+    owner = uuid.uuid4().hex
+    if not cache.add(LOCK_KEY, owner, LOCK_TIMEOUT):
+        logger.info('Settlement already running')
+        return None
+    try:
+        batch_size = batch_size or settings.SETTLEMENT_BATCH_SIZE
+        cutoff = (now or timezone.now()) - timedelta(seconds=settings.SETTLEMENT_LAG)
+        last_id = SettlementRun.objects.values_list('last_entry_id', flat=True).first() or 0
+        settled = 0
+        while True:
+            ids = list(
+                LedgerEntry.objects.filter(id__gt=last_id, created_at__lt=cutoff)
+                .order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            payments = LedgerEntry.objects.filter(id__in=ids, status='success').count()
+            try:
+                with transaction.atomic():
+                    if payments:
+                        add_totals(vendor_totals(ids[0], ids[-1]))
+                    SettlementRun.objects.create(previous_entry_id=last_id, last_entry_id=ids[-1], entries=payments)
+            except IntegrityError:
+                logger.warning(f'Settlement checkpoint {last_id} was moved by another run; stopping')
+                break
+            last_id = ids[-1]
+            settled += payments
+        if settled:
+            logger.info(f'Settled {settled} payments up to ledger entry {last_id}')
+        return {'payments': settled, 'last_entry_id': last_id}
+    finally:
+        # Only release our own lock; a lease that expired may have passed to another run
+        if cache.get(LOCK_KEY) == owner:
+            cache.delete(LOCK_KEY)
+
+
+def settlements(start=None, end=None, vendor_id=None):
+    """Settlement rows for start <= date <= end, as export columns."""
+    queryset = VendorSettlement.objects.all()
+    if start:
+        queryset = queryset.filter(date__gte=start)
+    if end:
+        queryset = queryset.filter(date__lte=end)
+    if vendor_id:
+        queryset = queryset.filter(vendor_id=vendor_id)
+    return queryset.order_by('date', 'vendor_id').values_list(*SETTLEMENT_COLUMNS)
+
+
+def ledger(start=None, end=None):
+    """Ledger entries created on days start..end (inclusive), as export columns."""
+    queryset = LedgerEntry.objects.all()
+    if start:
+        queryset = queryset.filter(created_at__date__gte=start)
+    if end:
+        queryset = queryset.filter(created_at__date__lte=end)
+    return queryset.order_by('id').values_list(*LEDGER_COLUMNS)
+
+
+def chunks(rows, chunk_size):
+    """Group a values_list queryset into lists of chunk_size rows, reading it with a server-side cursor."""
+    chunk = []
+    for row in rows.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def stream_csv(rows, columns, chunk_size=None):
+    """Yield CSV text: a header line, then one piece per chunk of rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for chunk in chunks(rows, chunk_size or settings.SETTLEMENT_EXPORT_CHUNK_SIZE):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+
+
+def stream_columns(rows, columns, chunk_size=None):
+    """Yield one JSON line per chunk of rows, holding a list of values per column."""
+    for chunk in chunks(rows, chunk_size or settings.SETTLEMENT_EXPORT_CHUNK_SIZE):
+        group = {'rows': len(chunk)}
+        group.update(zip(columns, map(list, zip(*chunk))))
+        yield json.dumps(group, cls=DjangoJSONEncoder) + '\n'
+
+
+def stream(rows, columns, format='csv', chunk_size=None):
+    if format not in FORMATS:
+        raise ValueError(f'Unknown export format: {format}')
+    writer = stream_csv if format == 'csv' else stream_columns
+    return writer(rows, columns, chunk_size)
@@ -0,0 +1,296 @@
+"""
+Local stand-in for the Safaricom Daraja API.
+
+Implements the endpoints MPesaService uses (OAuth token, STK push and STK
+push query) on a local HTTP server, so tests and benchmarks can exercise
+the real HTTP client without credentials or network access. Point
+MPESA_BASE_URL at DarajaSimulator.url to use it.
+
+For load tests it can add latency jitter, fail a share of requests the way
+Daraja does when busy, and complete each push asynchronously: after
+callback_delay seconds the customer's answer (drawn from outcomes) is
+posted to the callback, and status queries report it from then on.
+Callbacks can be lost or delivered twice, as they sometimes are in
+production.
+"""
+import json
+import time
+import heapq
+import itertools
+import uuid
+import random
+import logging
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+RESULT_DESCRIPTIONS = {
+    0: 'The service request is processed successfully.',
+    1: 'The balance is insufficient for the transaction.',
+    1032: 'The transaction is being processed',
+    1037: 'DS timeout user cannot be reached',
+    2001: 'The initiator information is invalid.',
+}
+_sequence = itertools.count()
+BUSY = {'errorCode': '500.003.02', 'errorMessage': 'System is busy. Please retry in few minutes.'}
+
+
+class DarajaHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like Daraja
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def authorized(self):
+        header = self.headers.get('Authorization', '')
+        return header.startswith('Bearer ') and header[len('Bearer '):] in self.server.simulator.tokens
+
+    def do_GET(self):
+        simulator = self.server.simulator
+        simulator.record(self, 'oauth')
+        if not self.path.startswith('/oauth/v1/generate'):
+            return self.send_json(404, {'errorMessage': 'Not found'})
+        simulator.delay(simulator.oauth_latency)
+        token = uuid.uuid4().hex
+        simulator.tokens.add(token)
+        self.send_json(200, {'access_token': token, 'expires_in': str(simulator.token_lifetime)})
+
+    def do_POST(self):
+        simulator = self.server.simulator
+        routes = {
+            '/mpesa/stkpush/v1/processrequest': ('stk_push', simulator.stk_push),
+            '/mpesa/stkpushquery/v1/query': ('stk_query', simulator.stk_query),
+        }
+        if self.path not in routes:
+            return self.send_json(404, {'errorMessage': 'Not found'})
+        name, handler = routes[self.path]
+        simulator.record(self, name)
+        payload = self.read_json()
+        simulator.delay(simulator.latency)
+        if not self.authorized():
+            return self.send_json(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+        if simulator.fails():
+            simulator.record(self, f'{name}_error')
+            return self.send_json(503, dict(BUSY, requestId=uuid.uuid4().hex[:12]))
+        self.send_json(200, handler(payload))
+
+
+class DarajaSimulator:
+    """
+    Threaded local Daraja server.
+
+    Args:
+        latency: Seconds added to every STK push and query
+        oauth_latency: Seconds added to every token request
+        token_lifetime: expires_in returned with tokens
+        jitter: Up to this many extra seconds, at random, on every request
+        error_rate: Share of STK pushes and queries answered 503 (busy)
+        callback: Webhook URL, or a callable taking the callback body, that
+            receives each push's result; None sends no callbacks
+        callback_delay: Seconds between a push and its result
+        outcomes: {ResultCode: weight} for push results (default all paid)
+        callback_loss: Share of callbacks never sent
+        callback_duplicates: Share of callbacks sent twice
+        seed: Seed for the random choices
+
+    Use as a context manager; requests holds per-endpoint call counts and
+    connections the client ports seen (one per pooled connection). Set
+    results[checkout_request_id] to the ResultCode a status query should
+    report; otherwise queries report 1032 (processing) until the push's
+    result is due and the drawn outcome after that.
+    """
+
+    def __init__(self, latency=0.0, oauth_latency=0.0, token_lifetime=3599, jitter=0.0, error_rate=0.0,
+                 callback=None, callback_delay=0.0, outcomes=None, callback_loss=0.0, callback_duplicates=0.0,
+                 seed=None):
+        self.latency = latency
+        self.oauth_latency = oauth_latency
+        self.token_lifetime = token_lifetime
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.callback = callback
+        self.callback_delay = callback_delay
+        self.outcomes = outcomes or {0: 1}
+        self.callback_loss = callback_loss
+        self.callback_duplicates = callback_duplicates
+        self.random = random.Random(seed)
+        self.tokens = set()
+        self.requests = Counter()
+        self.connections = set()
+        self.checkouts = {}
+        self.results = {}
+        self.outcome_for = {}
+        self.completes_at = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DarajaHandler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self.thread = None
+        self.scheduled = []
+        self.scheduler = threading.Condition(self.lock)
+        self.dispatcher = None
+        self.in_flight = 0
+        self.stopping = False
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        if self.callback:
+            self.dispatcher = threading.Thread(target=self.dispatch_callbacks, daemon=True)
+            self.dispatcher.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.scheduler.notify()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def record(self, handler, name):
+        with self.lock:
+            self.requests[name] += 1
+            self.connections.add(handler.client_address)
+
+    def delay(self, seconds):
+        if self.jitter:
+            with self.lock:
+                seconds += self.random.uniform(0, self.jitter)
+        if seconds:
+            time.sleep(seconds)
+
+    def fails(self):
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def revoke_tokens(self):
+        self.tokens.clear()
+
+    def stk_push(self, payload):
+        checkout_request_id = f'ws_CO_{uuid.uuid4().hex[:20]}'
+        merchant_request_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.checkouts[checkout_request_id] = payload
+            codes, weights = zip(*self.outcomes.items())
+            code = self.random.choices(codes, weights)[0]
+            self.outcome_for[checkout_request_id] = code
+            due = time.monotonic() + self.callback_delay
+            self.completes_at[checkout_request_id] = due
+            if self.callback and self.random.random() >= self.callback_loss:
+                copies = 2 if self.random.random() < self.callback_duplicates else 1
+                body = self.callback_body(checkout_request_id, merchant_request_id, code, payload)
+                for _ in range(copies):
+                    heapq.heappush(self.scheduled, (due, next(_sequence), body))
+                self.in_flight += copies
+                self.scheduler.notify()
+        return {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def callback_body(self, checkout_request_id, merchant_request_id, code, payload):
+        callback = {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': code,
+            'ResultDesc': RESULT_DESCRIPTIONS.get(code, 'The transaction failed.'),
+        }
+        if code == 0:
+            callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': payload.get('Amount')},
+                {'Name': 'MpesaReceiptNumber', 'Value': f'SIM{uuid.uuid4().hex[:7].upper()}'},
+                {'Name': 'TransactionDate', 'Value': int(time.strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': int(payload.get('PhoneNumber') or 0)},
+            ]}
+        return {'Body': {'stkCallback': callback}}
+
+    def dispatch_callbacks(self):
+        """Send scheduled callbacks when they fall due, one at a time."""
+        while True:
+            with self.lock:
+                while not self.stopping and (not self.scheduled or self.scheduled[0][0] > time.monotonic()):
+                    timeout = self.scheduled[0][0] - time.monotonic() if self.scheduled else None
+                    self.scheduler.wait(timeout)
+                if self.stopping:
+                    return
+                _, _, body = heapq.heappop(self.scheduled)
+            sent = 'callback'
+            try:
+                if callable(self.callback):
+                    self.callback(body)
+                else:
+                    requests.post(self.callback, json=body, timeout=30).raise_for_status()
+            except Exception as e:
+                sent = 'callback_error'
+                logger.warning(f'Simulated callback failed: {str(e)}')
+            finally:
+                with self.lock:
+                    self.requests[sent] += 1
+                    self.in_flight -= 1
+                    self.scheduler.notify_all()
+
+    def wait_for_callbacks(self, timeout=None):
+        """Block until every scheduled callback has been sent; False on timeout."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.lock:
+            while self.in_flight:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.scheduler.wait(remaining)
+        return True
+
+    def stk_query(self, payload):
+        checkout_request_id = payload.get('CheckoutRequestID')
+        if checkout_request_id in self.results:
+            code = self.results[checkout_request_id]
+        elif checkout_request_id not in self.checkouts:
+            code = 2001
+        elif time.monotonic() < self.completes_at[checkout_request_id]:
+            code = 1032
+        else:
+            code = self.outcome_for[checkout_request_id]
+        return {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': uuid.uuid4().hex[:12],
+            'CheckoutRequestID': checkout_request_id,
+            # Daraja sends the query ResultCode as a string
+            'ResultCode': str(code),
+            'ResultDesc': RESULT_DESCRIPTIONS.get(code, 'The transaction failed.'),
+        }
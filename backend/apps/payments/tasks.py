@@ -2,63 +2,57 @@
 Celery tasks for payment processing and reconciliation.
 """
 from celery import shared_task
-from django.utils import timezone
-from datetime import timedelta
-from .models import Transaction
-from .mpesa_service import MPesaService
+from django.conf import settings
+from . import settlement, webhooks
+from .reconciliation import Reconciler, shard_ranges
 import logging
 
 logger = logging.getLogger(__name__)
 
 
 @shared_task
-def reconcile_pending_transactions():
+def reconcile_pending_transactions(shards=None):
     """
     Reconcile pending transactions by querying M-Pesa API.
     This task should run periodically (e.g., every 5 minutes).
-    """
-    # Get transactions that are pending and older than 2 minutes
-    cutoff_time = timezone.now() - timedelta(minutes=2)
-    pending_transactions = Transaction.objects.filter(
-        status__in=['initiated', 'pending'],
-        created_at__lt=cutoff_time,
-        checkout_request_id__isnull=False
-    )
     
-    mpesa_service = MPesaService()
-    reconciled_count = 0
+    With more than one shard (MPESA_RECONCILE_SHARDS) the pending id range is
+    split and each part is reconciled by its own reconcile_transaction_range
+    task, so the work spreads over the Celery workers.
     
-    for transaction in pending_transactions:
-        try:
-            result = mpesa_service.query_stk_status(transaction.checkout_request_id)
-            
-            if result['result_code'] == 0:
-                # Transaction successful
-                transaction.status = 'success'
-                transaction.mpesa_transaction_id = result.get('raw_response', {}).get('MpesaReceiptNumber')
-                transaction.completed_at = timezone.now()
-                transaction.raw_response = result['raw_response']
-                
-                # Update order status
-                transaction.order.status = 'paid'
-                transaction.order.save()
-                
-                transaction.save()
-                reconciled_count += 1
-                logger.info(f'Transaction {transaction.id} reconciled as success')
-            
-            elif result['result_code'] != 1032:  # 1032 = Request processing
-                # Transaction failed or cancelled
-                transaction.status = 'failed'
-                transaction.error_message = result.get('result_desc', 'Transaction failed')
-                transaction.raw_response = result['raw_response']
-                transaction.save()
-                logger.info(f'Transaction {transaction.id} reconciled as failed')
-        
-        except Exception as e:
-            logger.error(f'Error reconciling transaction {transaction.id}: {str(e)}')
-            continue
+    Returns:
+        the run's counts, or the number of shard tasks queued
+    """
+    shards = shards or settings.MPESA_RECONCILE_SHARDS
+    if shards <= 1:
+        stats = Reconciler().run()
+        logger.info(f"Reconciled {stats['succeeded'] + stats['failed']} transactions")
+        return stats
     
-    logger.info(f'Reconciled {reconciled_count} transactions')
-    return reconciled_count
+    ranges = shard_ranges(shards)
+    for i, (start_id, end_id) in enumerate(ranges):
+        reconcile_transaction_range.delay(start_id, end_id, shard=f'{i + 1}/{shards}', shards=shards)
+    return {'shards': len(ranges)}
+
+
+@shared_task
+def reconcile_transaction_range(start_id, end_id, shard=None, shards=1):
+    """Reconcile pending transactions with start_id <= id < end_id, at a 1/shards share of the query rate."""
+    reconciler = Reconciler(
+        start_id, end_id,
+        shard=shard or f'{start_id}-{end_id}',
+        rate=settings.MPESA_RECONCILE_RATE / shards
+    )
+    return reconciler.run()
+
+
+@shared_task
+def process_webhook_inbox(batch_size=None, max_batches=None):
+    """Apply pending M-Pesa callbacks from the inbox (see webhooks)."""
+    return webhooks.consume(batch_size=batch_size, max_batches=max_batches)
+
 
+@shared_task
+def settle_payments():
+    """Fold new successful payments into the daily vendor settlements."""
+    return settlement.settle()
@@ -1,5 +1,8 @@
 import pytest
+import logging
+from decimal import Decimal
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from rest_framework.test import APIClient
 from rest_framework import status
 from apps.marketplace.models import Order, Product, Vendor
@@ -10,6 +13,8 @@ User = get_user_model()
 
 @pytest.fixture
 def api_client():
+    # Throttle history lives in the cache and user ids are reused between tests
+    cache.clear()
     return APIClient()
 
 
@@ -136,3 +141,843 @@ class TestMPesaWebhook:
             transaction.refresh_from_db()
             assert transaction.status in ['success', 'failed']
 
+
+@pytest.fixture
+def daraja(settings):
+    """Local Daraja simulator with MPesaService pointed at it."""
+    from apps.payments.mpesa_service import reset_client
+    from apps.payments.simulator import DarajaSimulator
+    
+    cache.clear()
+    reset_client()
+    with DarajaSimulator(oauth_latency=0.05) as simulator:
+        settings.MPESA_BASE_URL = simulator.url
+        yield simulator
+    reset_client()
+
+
+@pytest.mark.django_db
+class TestDarajaClient:
+    def test_payments_share_token_and_connection(self, test_order, daraja, settings):
+        api_client, order = test_order
+        # Every request makes its own push
+        settings.MPESA_STK_COALESCE_WINDOW = 0
+        
+        responses = [
+            api_client.post('/api/payments/mpesa/initiate/', {'order_id': order.id, 'phone': '+254712345678'})
+            for _ in range(3)
+        ]
+        
+        assert [r.status_code for r in responses] == [200] * 3
+        assert len({r.data['checkout_request_id'] for r in responses}) == 3
+        assert daraja.requests['oauth'] == 1
+        assert daraja.requests['stk_push'] == 3
+        # One keep-alive connection carried the token request and every push
+        assert len(daraja.connections) == 1
+    
+    def test_repeated_initiation_reuses_the_push(self, test_order, daraja):
+        api_client, order = test_order
+        
+        first, second = [
+            api_client.post('/api/payments/mpesa/initiate/', {'order_id': order.id, 'phone': '+254712345678'})
+            for _ in range(2)
+        ]
+        other_phone = api_client.post('/api/payments/mpesa/initiate/', {'order_id': order.id, 'phone': '+254798765432'})
+        
+        assert first.data['checkout_request_id'] == second.data['checkout_request_id']
+        assert first.data['transaction_id'] == second.data['transaction_id']
+        assert other_phone.data['checkout_request_id'] != first.data['checkout_request_id']
+        assert daraja.requests['stk_push'] == 2
+        assert Transaction.objects.filter(order=order).count() == 2
+    
+    def test_token_refresh_leaves_a_lock_it_does_not_own(self, daraja, monkeypatch):
+        from apps.payments import mpesa_service
+        
+        monkeypatch.setattr(mpesa_service, 'TOKEN_LOCK_TIMEOUT', 0.2)
+        service = mpesa_service.MPesaService()
+        cache.set(f'{service.token_key}:lock', 'another-worker', 60)
+        
+        assert service.get_access_token()
+        assert cache.get(f'{service.token_key}:lock') == 'another-worker'
+    
+    def test_concurrent_token_refresh_is_single_flight(self, daraja):
+        import threading
+        from apps.payments.mpesa_service import MPesaService
+        
+        tokens = []
+        threads = [
+            threading.Thread(target=lambda: tokens.append(MPesaService().get_access_token()))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert len(tokens) == 8
+        assert len(set(tokens)) == 1
+        assert daraja.requests['oauth'] == 1
+    
+    def test_rejected_token_is_refreshed_once(self, daraja):
+        from apps.payments.mpesa_service import MPesaService
+        
+        service = MPesaService()
+        first = service.get_access_token()
+        daraja.revoke_tokens()
+        
+        result = service.query_stk_status('ws_CO_UNKNOWN')
+        
+        assert result['response_code'] == '0'
+        assert daraja.requests['oauth'] == 2
+        assert service.get_access_token() != first
+    
+    def test_token_refreshed_before_expiry(self, daraja, settings):
+        from apps.payments.mpesa_service import MPesaService
+        
+        settings.MPESA_TOKEN_REFRESH_MARGIN = 60
+        daraja.token_lifetime = 30  # already inside the refresh margin when issued
+        
+        service = MPesaService()
+        assert service.get_access_token() != service.get_access_token()
+        assert daraja.requests['oauth'] == 2
+    
+    def test_async_service_shares_token(self, daraja):
+        import asyncio
+        from apps.payments.mpesa_service import AsyncMPesaService
+        
+        async def pay_all():
+            async with AsyncMPesaService(concurrency=4) as service:
+                return await asyncio.gather(*(
+                    service.initiate_stk_push('+254712345678', 100, f'ORDER{i}', 'Async payment')
+                    for i in range(6)
+                ))
+        
+        results = asyncio.run(pay_all())
+        
+        assert len({r['checkout_request_id'] for r in results}) == 6
+        assert daraja.requests['oauth'] == 1
+        assert len(daraja.connections) <= 4
+
+
+def create_transaction(order, checkout_request_id, status='initiated', age_minutes=10):
+    """Transaction created age_minutes ago, first checked two minutes after that."""
+    from datetime import timedelta
+    from django.utils import timezone
+    
+    created_at = timezone.now() - timedelta(minutes=age_minutes)
+    transaction = Transaction.objects.create(
+        order=order,
+        checkout_request_id=checkout_request_id,
+        amount=order.total_amount,
+        phone='+254712345678',
+        status=status
+    )
+    Transaction.objects.filter(id=transaction.id).update(
+        created_at=created_at, next_check_at=created_at + timedelta(minutes=2)
+    )
+    transaction.refresh_from_db()
+    return transaction
+
+
+def create_order(customer):
+    return Order.objects.create(
+        customer=customer,
+        total_amount=100.00,
+        shipping_address='Test',
+        shipping_county='Nairobi',
+        shipping_phone='+254712345678'
+    )
+
+
+@pytest.mark.django_db
+class TestReconciliation:
+    def test_reconciles_in_batches(self, daraja, settings):
+        from apps.payments import reconciliation
+        from apps.payments.tasks import reconcile_pending_transactions
+        
+        settings.MPESA_RECONCILE_BATCH_SIZE = 2
+        settings.MPESA_RECONCILE_RATE = 0
+        settings.MPESA_LNM_EXPIRY = 3600
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        orders = [create_order(customer) for _ in range(5)]
+        paid = create_transaction(orders[0], 'ws_CO_PAID')
+        declined = create_transaction(orders[1], 'ws_CO_DECLINED')
+        processing = create_transaction(orders[2], 'ws_CO_PROCESSING')
+        settled = create_transaction(orders[3], 'ws_CO_SETTLED', status='failed')
+        recent = create_transaction(orders[4], 'ws_CO_RECENT', age_minutes=0)
+        daraja.results.update({'ws_CO_PAID': 0, 'ws_CO_DECLINED': 1, 'ws_CO_PROCESSING': 1032})
+        
+        stats = reconcile_pending_transactions()
+        
+        assert (stats['queried'], stats['succeeded'], stats['failed'], stats['still_pending']) == (3, 1, 1, 1)
+        assert daraja.requests['stk_query'] == 3
+        assert Transaction.objects.get(id=paid.id).status == 'success'
+        assert Order.objects.get(id=orders[0].id).status == 'paid'
+        declined.refresh_from_db()
+        assert declined.status == 'failed'
+        assert declined.error_message == 'The balance is insufficient for the transaction.'
+        assert Transaction.objects.get(id=processing.id).status == 'initiated'
+        assert Transaction.objects.get(id=settled.id).status == 'failed'
+        assert Transaction.objects.get(id=recent.id).status == 'initiated'
+        assert Order.objects.filter(status='paid').count() == 1
+        assert reconciliation.progress()['all']['last_id'] == processing.id
+    
+    def test_shards_split_the_id_range(self, daraja, settings):
+        from digi_farm.celery import app
+        from apps.payments import reconciliation
+        from apps.payments.tasks import reconcile_pending_transactions
+        
+        settings.MPESA_RECONCILE_RATE = 0
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        transactions = [create_transaction(create_order(customer), f'ws_CO_{i}') for i in range(5)]
+        daraja.results.update({f'ws_CO_{i}': 0 for i in range(5)})
+        
+        ranges = reconciliation.shard_ranges(2)
+        assert ranges[0][0] == transactions[0].id
+        assert ranges[-1][1] == transactions[-1].id + 1
+        
+        original_eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        try:
+            assert reconcile_pending_transactions(shards=2) == {'shards': 2}
+        finally:
+            app.conf.task_always_eager = original_eager
+        
+        assert Transaction.objects.filter(status='success').count() == 5
+        progress = reconciliation.progress(shards=2)
+        assert progress['1/2']['succeeded'] + progress['2/2']['succeeded'] == 5
+    
+    def test_inconclusive_checks_back_off_until_expiry(self, daraja, settings):
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.payments.reconciliation import Reconciler
+        
+        settings.MPESA_RECONCILE_RATE = 0
+        settings.MPESA_RECONCILE_BACKOFF = 60
+        settings.MPESA_LNM_EXPIRY = 3600
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        slow = create_transaction(create_order(customer), 'ws_CO_SLOW')
+        expired = create_transaction(create_order(customer), 'ws_CO_EXPIRED', age_minutes=61)
+        daraja.results.update({'ws_CO_SLOW': 1032, 'ws_CO_EXPIRED': 1032})
+        
+        stats = Reconciler().run()
+        
+        assert (stats['queried'], stats['still_pending'], stats['cancelled']) == (2, 2, 1)
+        assert Transaction.objects.get(id=expired.id).status == 'cancelled'
+        slow.refresh_from_db()
+        assert (slow.status, slow.check_attempts) == ('initiated', 1)
+        assert timedelta(seconds=55) < slow.next_check_at - timezone.now() <= timedelta(seconds=60)
+        
+        # Nothing is due until the backoff has passed
+        assert Reconciler().run()['queried'] == 0
+        assert daraja.requests['stk_query'] == 2
+        
+        Transaction.objects.filter(id=slow.id).update(next_check_at=timezone.now())
+        Reconciler().run()
+        slow.refresh_from_db()
+        assert slow.check_attempts == 2
+        assert timedelta(seconds=115) < slow.next_check_at - timezone.now() <= timedelta(seconds=120)
+    
+    def test_overlapping_runs_query_each_transaction_once(self, daraja, settings, monkeypatch):
+        from apps.payments.reconciliation import Reconciler
+        
+        settings.MPESA_RECONCILE_RATE = 0
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        for i in range(3):
+            create_transaction(create_order(customer), f'ws_CO_SLOW{i}')
+            daraja.results[f'ws_CO_SLOW{i}'] = 1032
+        first = Reconciler()
+        overlapping = []
+        claim = Reconciler.claim
+        
+        def claim_then_overlap(reconciler, chunk, due_at):
+            claimed = claim(reconciler, chunk, due_at)
+            if reconciler is first:
+                # The next scheduled run starts while this one is still querying
+                overlapping.append(Reconciler().run())
+            return claimed
+        
+        monkeypatch.setattr(Reconciler, 'claim', claim_then_overlap)
+        
+        assert first.run()['queried'] == 3
+        assert overlapping[0]['queried'] == 0
+        assert daraja.requests['stk_query'] == 3
+    
+    def test_failed_queries_never_cancel(self, daraja, settings, monkeypatch):
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.payments.mpesa_service import MPesaService
+        from apps.payments.reconciliation import Reconciler
+        
+        def unreachable(service, checkout_request_id):
+            raise ConnectionError('Daraja unreachable')
+        
+        settings.MPESA_RECONCILE_RATE = 0
+        settings.MPESA_RECONCILE_BACKOFF = 60
+        settings.MPESA_LNM_EXPIRY = 3600
+        monkeypatch.setattr(MPesaService, 'query_stk_status', unreachable)
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        unanswered = create_transaction(create_order(customer), 'ws_CO_UNANSWERED', age_minutes=61)
+        
+        stats = Reconciler().run()
+        
+        assert (stats['queried'], stats['errors'], stats['cancelled']) == (1, 1, 0)
+        unanswered.refresh_from_db()
+        assert (unanswered.status, unanswered.check_attempts) == ('initiated', 1)
+        assert timedelta(seconds=55) < unanswered.next_check_at - timezone.now() <= timedelta(seconds=60)
+    
+    def test_late_success_restores_a_cancelled_order(self):
+        from apps.marketplace import stock
+        from apps.marketplace.models import OrderItem
+        from apps.payments import transitions, webhooks
+        from apps.payments.models import LedgerEntry
+        
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        vendor = Vendor.objects.create(
+            user=User.objects.create_user(email='vendor@example.com', password='test', role='vendor'),
+            business_name='Maize Traders'
+        )
+        product = Product.objects.create(vendor=vendor, title='maize', description='maize', price='50.00', stock=1)
+        order = create_order(customer)
+        OrderItem.objects.create(order=order, product=product, quantity=2, price=product.price)
+        txn = create_transaction(order, 'ws_CO_LATE')
+        # Given up without an answer, then the order expired and returned its stock
+        assert transitions.fail(txn, 'STK push expired without confirmation', to='cancelled')
+        assert stock.cancel(order.id, statuses=('pending',))
+        
+        webhooks.ingest(stk_callback('ws_CO_LATE'))
+        
+        assert webhooks.consume()['outcomes'] == {'success': 1}
+        assert Transaction.objects.get(id=txn.id).status == 'success'
+        assert Order.objects.get(id=order.id).status == 'paid'
+        assert Product.objects.get(id=product.id).stock == 1
+        assert list(LedgerEntry.objects.values_list('status', flat=True)) == ['cancelled', 'success']
+    
+    def test_rate_limiter_paces_threads(self):
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from apps.payments.reconciliation import RateLimiter
+        
+        limiter = RateLimiter(50)
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(lambda _: limiter.wait(), range(11)))
+        
+        assert time.monotonic() - started >= 0.19
+
+
+def stk_callback(checkout_request_id, result_code=0, receipt='QLTEST123'):
+    return {
+        'Body': {
+            'stkCallback': {
+                'ResultCode': result_code,
+                'ResultDesc': 'The service request is processed successfully.' if result_code == 0 else 'Request cancelled by user',
+                'CheckoutRequestID': checkout_request_id,
+                'CallbackMetadata': {
+                    'Item': [{'Name': 'MpesaReceiptNumber', 'Value': receipt}] if result_code == 0 else []
+                }
+            }
+        }
+    }
+
+
+@pytest.mark.django_db
+class TestWebhookInbox:
+    def test_inbox_acknowledges_before_applying(self, api_client, settings):
+        from apps.payments import webhooks
+        from apps.payments.models import WebhookEvent
+        
+        settings.MPESA_WEBHOOK_MODE = 'inbox'
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        paid = create_transaction(create_order(customer), 'ws_CO_PAID')
+        declined = create_transaction(create_order(customer), 'ws_CO_DECLINED')
+        
+        for body in [stk_callback('ws_CO_PAID'), stk_callback('ws_CO_DECLINED', 1032), stk_callback('ws_CO_UNKNOWN')]:
+            response = api_client.post('/api/payments/mpesa/webhook/', body, format='json')
+            assert response.status_code == status.HTTP_200_OK
+            assert response.data == {'status': 'accepted'}
+        
+        assert WebhookEvent.objects.filter(status='pending').count() == 3
+        assert Transaction.objects.get(id=paid.id).status == 'initiated'
+        
+        stats = webhooks.consume(batch_size=2)
+        
+        assert stats['batches'] == 2
+        assert stats['outcomes'] == {'success': 1, 'failed': 1, 'not_found': 1}
+        paid.refresh_from_db()
+        assert (paid.status, paid.mpesa_transaction_id) == ('success', 'QLTEST123')
+        assert Order.objects.get(id=paid.order_id).status == 'paid'
+        assert Transaction.objects.get(id=declined.id).status == 'failed'
+        assert not WebhookEvent.objects.exclude(status='processed').exists()
+    
+    def test_redelivery_and_replay_are_idempotent(self):
+        from apps.payments import webhooks
+        from apps.payments.models import WebhookEvent
+        
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        txn = create_transaction(create_order(customer), 'ws_CO_PAID')
+        webhooks.ingest(stk_callback('ws_CO_PAID'))
+        webhooks.ingest(stk_callback('ws_CO_PAID'))
+        # A late failure callback must not undo the payment
+        webhooks.ingest(stk_callback('ws_CO_PAID', 1032))
+        
+        assert webhooks.consume()['outcomes'] == {'success': 1, 'duplicate': 2}
+        assert webhooks.replay(WebhookEvent.objects.all()) == 3
+        assert webhooks.consume()['outcomes'] == {'duplicate': 3}
+        
+        txn.refresh_from_db()
+        assert txn.status == 'success'
+        assert WebhookEvent.objects.filter(attempts=2).count() == 3
+    
+    def test_abandoned_claims_are_taken_over(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.payments import webhooks
+        from apps.payments.models import WebhookEvent
+        
+        fresh = webhooks.ingest(stk_callback('ws_CO_FRESH'))
+        stale = webhooks.ingest(stk_callback('ws_CO_STALE'))
+        WebhookEvent.objects.filter(id=fresh.id).update(status='processing', claimed_at=timezone.now())
+        WebhookEvent.objects.filter(id=stale.id).update(
+            status='processing', claimed_at=timezone.now() - webhooks.CLAIM_TIMEOUT - timedelta(seconds=1)
+        )
+        
+        assert [event.id for event in webhooks.claim_batch(10)] == [stale.id]
+
+
+@pytest.mark.django_db
+class TestPaymentTransitions:
+    def test_late_failure_does_not_undo_success(self, api_client):
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        txn = create_transaction(create_order(customer), 'ws_CO_PAID')
+        
+        responses = [
+            api_client.post('/api/payments/mpesa/webhook/', body, format='json').data['status']
+            for body in [stk_callback('ws_CO_PAID'), stk_callback('ws_CO_PAID'), stk_callback('ws_CO_PAID', 1032)]
+        ]
+        
+        assert responses == ['success', 'duplicate', 'duplicate']
+        txn.refresh_from_db()
+        assert (txn.status, txn.error_message) == ('success', '')
+        assert Order.objects.get(id=txn.order_id).status == 'paid'
+    
+    def test_paid_order_is_not_moved_back(self):
+        from apps.payments import transitions
+        
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        txn = create_transaction(create_order(customer), 'ws_CO_PAID')
+        Order.objects.filter(id=txn.order_id).update(status='shipped')
+        
+        assert transitions.succeed(txn, 'QLTEST123')
+        assert Order.objects.get(id=txn.order_id).status == 'shipped'
+        with pytest.raises(ValueError):
+            transitions.transition(txn.id, 'initiated')
+
+
+@pytest.mark.django_db(transaction=True)
+class TestPaymentTransitionsConcurrency:
+    def test_racing_writers_apply_exactly_once(self):
+        import threading
+        from django.db import OperationalError, connection
+        from apps.payments import transitions
+        
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        txn = create_transaction(create_order(customer), 'ws_CO_RACE')
+        threads = 16
+        barrier = threading.Barrier(threads)
+        results = []
+        
+        def settle(i):
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        if i % 2:
+                            changed = transitions.fail(txn, f'Failed by writer {i}')
+                        else:
+                            changed = transitions.succeed(txn, 'QLRACE123')
+                        break
+                    except OperationalError:
+                        # SQLite reports a locked table instead of waiting for the lock
+                        continue
+                results.append((i, changed))
+            finally:
+                connection.close()
+        
+        workers = [threading.Thread(target=settle, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        winners = [i for i, changed in results if changed]
+        assert len(results) == threads
+        assert len(winners) == 1
+        txn.refresh_from_db()
+        order = Order.objects.get(id=txn.order_id)
+        if winners[0] % 2:
+            assert (txn.status, txn.error_message, order.status) == ('failed', f'Failed by writer {winners[0]}', 'pending')
+        else:
+            assert (txn.status, txn.mpesa_transaction_id, order.status) == ('success', 'QLRACE123', 'paid')
+
+
+def create_paid_order(customer, items, checkout_request_id):
+    """Order with (product, quantity) items whose payment has just succeeded."""
+    from apps.marketplace.models import OrderItem
+    from apps.payments import transitions
+    
+    order = create_order(customer)
+    for product, quantity in items:
+        OrderItem.objects.create(order=order, product=product, quantity=quantity, price=product.price)
+    txn = create_transaction(order, checkout_request_id)
+    assert transitions.succeed(txn, f'QL{checkout_request_id[-6:]}')
+    return order
+
+
+@pytest.mark.django_db
+class TestSettlement:
+    @pytest.fixture
+    def products(self):
+        products = []
+        for name, price in [('maize', '50.00'), ('beans', '120.00')]:
+            vendor = Vendor.objects.create(
+                user=User.objects.create_user(email=f'{name}@example.com', password='test', role='vendor'),
+                business_name=f'{name.title()} Traders'
+            )
+            products.append(Product.objects.create(
+                vendor=vendor, title=name, description=name, price=price, stock=100
+            ))
+        return products
+    
+    def test_settles_incrementally_per_vendor(self, products):
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.payments import settlement, transitions
+        from apps.payments.models import LedgerEntry, VendorSettlement
+        
+        maize, beans = products
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        create_paid_order(customer, [(maize, 2), (beans, 1)], 'ws_CO_000001')
+        create_paid_order(customer, [(maize, 3)], 'ws_CO_000002')
+        unpaid = create_transaction(create_order(customer), 'ws_CO_000003')
+        transitions.fail(unpaid, 'Request cancelled by user')
+        later = timezone.now() + timedelta(hours=1)
+        
+        assert list(LedgerEntry.objects.values_list('status', flat=True)) == ['success', 'success', 'failed']
+        assert settlement.settle(now=later)['payments'] == 2
+        assert settlement.settle(now=later)['payments'] == 0
+        create_paid_order(customer, [(beans, 2)], 'ws_CO_000004')
+        assert settlement.settle(now=later)['payments'] == 1
+        
+        totals = {
+            s.vendor_id: (s.gross_amount, s.items, s.orders)
+            for s in VendorSettlement.objects.filter(date=timezone.localdate())
+        }
+        assert totals == {
+            maize.vendor_id: (Decimal('250.00'), 5, 2),
+            beans.vendor_id: (Decimal('360.00'), 3, 2),
+        }
+    
+    def test_order_paid_twice_is_settled_once(self, products, settings):
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.payments import settlement, transitions
+        from apps.payments.models import VendorSettlement
+        
+        settings.SETTLEMENT_BATCH_SIZE = 1
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        order = create_paid_order(customer, [(products[0], 2)], 'ws_CO_000001')
+        transitions.succeed(create_transaction(order, 'ws_CO_000002'), 'QL000002')
+        transitions.succeed(create_transaction(order, 'ws_CO_000003'), 'QL000003')
+        later = timezone.now() + timedelta(hours=1)
+        
+        assert settlement.settle(now=later)['payments'] == 3
+        assert VendorSettlement.objects.values_list('gross_amount', 'items', 'orders').get() == (Decimal('100.00'), 2, 1)
+        
+        # And with every payment in one chunk
+        assert list(settlement.vendor_totals(0, 10 ** 9).values_list('gross_amount', 'items')) == [(Decimal('100.00'), 2)]
+    
+    def test_overlapping_runs_do_not_settle_twice(self, products, monkeypatch):
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.payments import settlement
+        from apps.payments.models import LedgerEntry, SettlementRun, VendorSettlement
+        
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        create_paid_order(customer, [(products[0], 2)], 'ws_CO_000001')
+        add_totals = settlement.add_totals
+        
+        def add_totals_while_another_run_settles(rows):
+            # This run's lock expired: another run took it and settled the same entries
+            cache.set(settlement.LOCK_KEY, 'another-run', 60)
+            SettlementRun.objects.create(previous_entry_id=0, last_entry_id=LedgerEntry.objects.get().id, entries=1)
+            add_totals(rows)
+        
+        monkeypatch.setattr(settlement, 'add_totals', add_totals_while_another_run_settles)
+        
+        assert settlement.settle(now=timezone.now() + timedelta(hours=1))['payments'] == 0
+        assert not VendorSettlement.objects.exists()
+        assert cache.get(settlement.LOCK_KEY) == 'another-run'
+        cache.delete(settlement.LOCK_KEY)
+    
+    def test_recent_entries_wait_for_the_next_run(self, products, settings):
+        from apps.payments import settlement
+        
+        settings.SETTLEMENT_LAG = 300
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        create_paid_order(customer, [(products[0], 1)], 'ws_CO_000001')
+        
+        assert settlement.settle()['payments'] == 0
+    
+    def test_ledger_is_append_only(self):
+        from apps.payments.models import LedgerEntry
+        
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        create_paid_order(customer, [], 'ws_CO_000001')
+        entry = LedgerEntry.objects.get()
+        
+        with pytest.raises(ValueError):
+            entry.save()
+        with pytest.raises(ValueError):
+            entry.delete()
+        with pytest.raises(ValueError):
+            LedgerEntry.objects.filter(id=entry.id).update(amount=0)
+        with pytest.raises(ValueError):
+            LedgerEntry.objects.all().delete()
+        assert LedgerEntry.objects.filter(id=entry.id, amount=entry.amount).exists()
+    
+    def test_deleting_accounts_keeps_the_books(self, products):
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.payments import settlement
+        from apps.payments.models import LedgerEntry, VendorSettlement
+        
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        order = create_paid_order(customer, [(products[0], 2)], 'ws_CO_000001')
+        transaction_id = order.transactions.get().id
+        settlement.settle(now=timezone.now() + timedelta(hours=1))
+        
+        customer.delete()
+        products[0].vendor.user.delete()
+        
+        entry = LedgerEntry.objects.get()
+        assert (entry.order_id, entry.transaction_id) == (None, None)
+        assert (entry.order_ref, entry.transaction_ref) == (order.id, transaction_id)
+        assert VendorSettlement.objects.values_list('vendor_id', 'gross_amount').get() == (None, Decimal('100.00'))
+    
+    def test_exports_stream_in_chunks(self, api_client, products, settings):
+        import json
+        from datetime import timedelta
+        from django.utils import timezone
+        from apps.payments import settlement
+        
+        settings.SETTLEMENT_EXPORT_CHUNK_SIZE = 2
+        customer = User.objects.create_user(email='buyer@example.com', password='test')
+        for i in range(5):
+            create_paid_order(customer, [(products[i % 2], 1)], f'ws_CO_{i:06d}')
+        settlement.settle(now=timezone.now() + timedelta(hours=1))
+        admin = User.objects.create_user(email='finance@example.com', password='test', is_staff=True)
+        api_client.force_authenticate(admin)
+        
+        response = api_client.get('/api/payments/ledger/export/')
+        pieces = list(response.streaming_content)
+        lines = b''.join(pieces).decode().splitlines()
+        assert response['Content-Type'] == 'text/csv'
+        assert len(pieces) == 1 + 3  # header, then one piece per chunk of rows
+        assert lines[0] == ','.join(settlement.LEDGER_COLUMNS)
+        assert len(lines) == 6
+        
+        response = api_client.get('/api/payments/settlements/export/', {'output': 'columns'})
+        groups = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        assert [group['rows'] for group in groups] == [2]
+        assert groups[0]['gross_amount'] == ['150.00', '240.00']
+        
+        customer_client = APIClient()
+        customer_client.force_authenticate(customer)
+        assert customer_client.get('/api/payments/ledger/export/').status_code == status.HTTP_403_FORBIDDEN
+    
+    def test_exports_reject_bad_filters_up_front(self, api_client):
+        api_client.force_authenticate(User.objects.create_user(email='finance@example.com', password='test', is_staff=True))
+        
+        for url, params in [
+            ('/api/payments/settlements/export/', {'vendor': 'abc'}),
+            ('/api/payments/settlements/export/', {'start': '2024-02-30'}),
+            ('/api/payments/ledger/export/', {'end': 'yesterday'}),
+        ]:
+            response = api_client.get(url, params)
+            assert response.status_code == status.HTTP_400_BAD_REQUEST, params
+        assert api_client.get('/api/payments/settlements/export/', {'vendor': '3', 'start': '2024-02-01'}).status_code == 200
+
+
+@pytest.mark.django_db(transaction=True)
+class TestInitiationConcurrency:
+    def test_concurrent_initiations_share_one_push(self, daraja):
+        import threading
+        from django.db import connection
+        from apps.payments import initiation
+        
+        daraja.latency = 0.2
+        order = create_order(User.objects.create_user(email='buyer@example.com', password='test'))
+        threads = 8
+        barrier = threading.Barrier(threads)
+        results = []
+        
+        def tap():
+            barrier.wait()
+            try:
+                results.append(initiation.initiate(order, '+254712345678'))
+            finally:
+                connection.close()
+        
+        workers = [threading.Thread(target=tap) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        assert daraja.requests['stk_push'] == 1
+        assert len(results) == threads
+        assert len({(r['checkout_request_id'], r['transaction_id']) for r in results}) == 1
+        assert sorted(r['shared'] for r in results) == [False] + [True] * (threads - 1)
+        assert Transaction.objects.filter(order=order).count() == 1
+    
+    def test_waiters_give_up_after_the_lock_timeout(self, daraja, settings):
+        from apps.payments import initiation
+        
+        settings.MPESA_STK_LOCK_TIMEOUT = 0.2
+        order = create_order(User.objects.create_user(email='buyer@example.com', password='test'))
+        cache.add(initiation.LOCK_KEY.format(order.id), 'someone-else', 60)
+        
+        with pytest.raises(initiation.InitiationInProgress):
+            initiation.initiate(order, '+254712345678')
+        assert daraja.requests['stk_push'] == 0
+
+
+@pytest.mark.django_db
+class TestTransactionList:
+    def test_keyset_pages_cover_every_transaction_once(self, test_order):
+        from django.utils import timezone
+        
+        api_client, order = test_order
+        same_instant = timezone.now()
+        for i in range(7):
+            txn = create_transaction(order, f'ws_CO_{i}', age_minutes=i)
+            if i >= 3:
+                # Ties on created_at are broken by id
+                Transaction.objects.filter(id=txn.id).update(created_at=same_instant)
+        
+        seen, url = [], '/api/payments/transactions/?page_size=3'
+        while url:
+            response = api_client.get(url)
+            assert response.status_code == status.HTTP_200_OK
+            assert len(response.data['results']) <= 3
+            seen += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        
+        expected = list(Transaction.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        assert seen == expected
+        assert 'raw_response' not in response.data['results'][0]
+    
+    def test_sparse_fieldsets(self, test_order, django_assert_num_queries):
+        api_client, order = test_order
+        create_transaction(order, 'ws_CO_1')
+        
+        with django_assert_num_queries(2):  # user, transactions
+            response = api_client.get('/api/payments/transactions/', {'fields': 'id,status,amount'})
+        
+        assert response.data['results'] == [{'id': Transaction.objects.get().id, 'status': 'initiated', 'amount': '100.00'}]
+        assert response.data['next'] is None
+        assert api_client.get('/api/payments/transactions/', {'fields': 'id,raw_response'}).status_code == 400
+        assert api_client.get('/api/payments/transactions/', {'cursor': 'garbage'}).status_code == 404
+
+
+@pytest.mark.django_db
+class TestDarajaSimulator:
+    def test_results_arrive_by_callback_after_the_delay(self, settings):
+        from apps.payments.mpesa_service import MPesaService, reset_client
+        from apps.payments.simulator import DarajaSimulator
+        
+        received = []
+        cache.clear()
+        reset_client()
+        with DarajaSimulator(callback=received.append, callback_delay=0.2, outcomes={1: 1},
+                             callback_duplicates=1.0, seed=1) as simulator:
+            settings.MPESA_BASE_URL = simulator.url
+            service = MPesaService()
+            checkout_request_id = service.initiate_stk_push('+254712345678', 100, 'ORDER1', 'Test')['checkout_request_id']
+            
+            assert service.query_stk_status(checkout_request_id)['result_code'] == '1032'
+            assert simulator.wait_for_callbacks(timeout=5)
+            assert service.query_stk_status(checkout_request_id)['result_code'] == '1'
+        reset_client()
+        
+        assert len(received) == 2
+        callback = received[0]['Body']['stkCallback']
+        assert (callback['CheckoutRequestID'], callback['ResultCode']) == (checkout_request_id, 1)
+    
+    def test_busy_errors_surface_to_the_client(self, daraja):
+        from apps.payments.mpesa_service import MPesaService
+        
+        daraja.error_rate = 1.0
+        with pytest.raises(Exception, match='System is busy'):
+            MPesaService().initiate_stk_push('+254712345678', 100, 'ORDER1', 'Test')
+        assert daraja.requests['stk_push_error'] == 1
+
+
+@pytest.fixture
+def event_log(caplog):
+    """caplog for payment events; the apps logger does not propagate to the root handler."""
+    logger = logging.getLogger('apps.payments.events')
+    logger.addHandler(caplog.handler)
+    with caplog.at_level(logging.INFO, logger='apps.payments.events'):
+        yield caplog
+    logger.removeHandler(caplog.handler)
+
+
+class TestPaymentEvents:
+    def test_phone_numbers_and_secrets_are_redacted_at_any_depth(self):
+        from apps.payments.events import redact
+        
+        payload = {
+            'Password': 'c2VjcmV0',
+            'PartyA': '254712345678',
+            'Body': {'stkCallback': {'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': 100},
+                {'Name': 'PhoneNumber', 'Value': 254712345678},
+            ]}}},
+        }
+        redacted = redact(payload)
+        
+        assert redacted['Password'] == '[redacted]'
+        assert redacted['PartyA'] == '2547*****678'
+        assert redacted['Body']['stkCallback']['CallbackMetadata']['Item'] == [
+            {'Name': 'Amount', 'Value': 100},
+            {'Name': 'PhoneNumber', 'Value': '2547*****678'},
+        ]
+        assert payload['PartyA'] == '254712345678'
+    
+    def test_sampling_never_drops_warnings(self, event_log, settings):
+        from apps.payments import events
+        
+        settings.PAYMENT_LOG_SAMPLING = {'webhook.received': 0}
+        events.log('webhook.received', checkout_request_id='ws_CO_1')
+        events.log('webhook.not_found', logging.WARNING, checkout_request_id='ws_CO_1')
+        events.log('stk.initiated', checkout_request_id='ws_CO_1', phone='+254712345678')
+        
+        assert [record.event for record in event_log.records] == ['webhook.not_found', 'stk.initiated']
+        assert event_log.records[1].getMessage() == (
+            'stk.initiated {"checkout_request_id": "ws_CO_1", "phone": "+254******678"}'
+        )
+    
+    @pytest.mark.django_db
+    def test_webhook_logs_no_phone_number(self, api_client, event_log, settings):
+        settings.PAYMENT_LOG_SAMPLING = {}
+        callback = stk_callback('ws_CO_LOGGED')
+        callback['Body']['stkCallback']['CallbackMetadata']['Item'].append(
+            {'Name': 'PhoneNumber', 'Value': 254712345678}
+        )
+        api_client.post('/api/payments/mpesa/webhook/', callback, format='json')
+        
+        assert [record.event for record in event_log.records] == ['webhook.received', 'webhook.not_found']
+        assert '2547*****678' in event_log.text
+        assert '254712345678' not in event_log.text
@@ -0,0 +1,160 @@
+"""
+Payment state machine.
+
+Every change to a transaction's status goes through transition(), which
+issues a single conditional UPDATE ... WHERE status IN (allowed sources).
+The database applies it atomically, so when a callback, a redelivery and
+the reconciler race on the same transaction exactly one of them wins and
+the others see that nothing changed. No row is read first and written
+back, so a settled payment can never be flipped by a late writer. The
+change and its LedgerEntry are written in one database transaction.
+
+    initiated -> pending -> success | failed | cancelled
+
+success and failed are final. cancelled is final except for a confirmed
+payment: the reconciler cancels a push that never got an answer, and if
+the customer was charged after all the success callback still applies
+(see succeed).
+"""
+import logging
+from django.db import transaction
+from django.utils import timezone
+from apps.marketplace.models import Order
+from . import events
+from .models import LedgerEntry, Transaction
+
+logger = logging.getLogger(__name__)
+
+OPEN_STATUSES = ['initiated', 'pending']
+
+# Target status -> statuses it may be entered from
+TRANSITIONS = {
+    'pending': ['initiated'],
+    'success': OPEN_STATUSES,
+    'failed': OPEN_STATUSES,
+    'cancelled': OPEN_STATUSES,
+}
+# Given up without a confirmed result, so a confirmed payment still applies
+LATE_SUCCESS_SOURCES = ['cancelled']
+
+
+def transition(transaction_id, to, now=None, sources=None, **fields):
+    """
+    Move a transaction to status to, if its current status allows it.
+
+    Args:
+        transaction_id: Transaction id
+        to: Target status (a key of TRANSITIONS)
+        now: Timestamp for updated_at (default now)
+        sources: Statuses it may be entered from (default TRANSITIONS[to])
+        **fields: Other Transaction fields to set with the status
+
+    Returns:
+        True if this call made the transition, False if the transaction was
+        already past it (or does not exist)
+    """
+    if to not in TRANSITIONS:
+        raise ValueError(f'Unknown transaction status: {to}')
+    now = now or timezone.now()
+    with transaction.atomic():
+        changed = bool(
+            Transaction.objects.filter(id=transaction_id, status__in=sources or TRANSITIONS[to]).update(
+                status=to, updated_at=now, **fields
+            )
+        )
+        if changed:
+            record(transaction_id, to, now)
+    return changed
+
+
+def record(transaction_id, status, now):
+    """Append the ledger entry for a status change that just happened."""
+    txn = Transaction.objects.values('order_id', 'amount', 'mpesa_transaction_id').get(id=transaction_id)
+    LedgerEntry.objects.create(
+        transaction_id=transaction_id,
+        order_id=txn['order_id'],
+        transaction_ref=transaction_id,
+        order_ref=txn['order_id'],
+        status=status,
+        amount=txn['amount'],
+        mpesa_transaction_id=txn['mpesa_transaction_id'] or '',
+        created_at=now
+    )
+
+
+def pay_orders(order_ids, now=None):
+    """
+    Mark orders paid. Only pending orders change; orders already paid or
+    further along (or cancelled) are left as they are.
+
+    Returns:
+        number of orders updated
+    """
+    if not order_ids:
+        return 0
+    return Order.objects.filter(id__in=order_ids, status='pending').update(
+        status='paid', updated_at=now or timezone.now()
+    )
+
+
+def succeed(txn, receipt, raw_response=None, now=None, pay_order=True):
+    """
+    Record a completed payment and mark its order paid.
+
+    A payment confirmed for a transaction that was cancelled without an
+    answer is applied too: the customer has been charged. Its order is paid
+    if still pending, or restored if it was cancelled meanwhile (see
+    apps.marketplace.stock.restore).
+
+    Args:
+        txn: Transaction (only id and order_id are used)
+        receipt: M-Pesa receipt number
+        raw_response: Callback or query response to keep
+        pay_order: False when the caller pays orders in bulk (see pay_orders)
+
+    Returns:
+        True if the transaction moved to success
+    """
+    now = now or timezone.now()
+    fields = {'mpesa_transaction_id': receipt, 'completed_at': now}
+    if raw_response is not None:
+        fields['raw_response'] = raw_response
+    late = False
+    with transaction.atomic():
+        changed = transition(txn.id, 'success', now=now, **fields)
+        if not changed:
+            late = changed = transition(txn.id, 'success', now=now, sources=LATE_SUCCESS_SOURCES, **fields)
+            if late:
+                pay_late_order(txn.order_id, now)
+        elif pay_order:
+            pay_orders([txn.order_id], now=now)
+    if late:
+        events.log('transaction.late_success', logging.WARNING, transaction_id=txn.id, order_id=txn.order_id)
+    if changed:
+        events.log('transaction.settled', transaction_id=txn.id, status='success')
+    return changed
+
+
+def pay_late_order(order_id, now):
+    """Pay the order of a payment confirmed after its transaction was cancelled."""
+    from apps.marketplace import stock  # stock imports this module
+    
+    if pay_orders([order_id], now=now) or stock.restore(order_id, now=now):
+        return
+    events.log('order.unpaid_after_payment', logging.ERROR, order_id=order_id)
+
+
+def fail(txn, reason, raw_response=None, now=None, to='failed'):
+    """
+    Record a failed (or, with to='cancelled', abandoned) payment.
+
+    Returns:
+        True if the transaction moved to the failed status
+    """
+    fields = {'error_message': reason}
+    if raw_response is not None:
+        fields['raw_response'] = raw_response
+    changed = transition(txn.id, to, now=now, **fields)
+    if changed:
+        events.log('transaction.settled', transaction_id=txn.id, status=to)
+    return changed
@@ -8,5 +8,7 @@ urlpatterns = [
     path('mpesa/webhook/', views.mpesa_webhook, name='mpesa_webhook'),
     path('mpesa/confirmation_sim/', views.simulate_webhook, name='simulate_webhook'),
     path('transactions/', views.transaction_list, name='transaction_list'),
+    path('settlements/export/', views.settlement_export, name='settlement_export'),
+    path('ledger/export/', views.ledger_export, name='ledger_export'),
 ]
 
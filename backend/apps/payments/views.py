@@ -1,19 +1,24 @@
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes, throttle_classes
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.throttling import UserRateThrottle
+from django.conf import settings
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_date
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_http_methods
-from django.utils import timezone
 import json
 import logging
 
+from . import events, initiation, settlement, transitions, webhooks
 from .models import Transaction
+from .pagination import KeysetPagination
 from .serializers import TransactionSerializer, STKPushRequestSerializer
-from .mpesa_service import MPesaService, parse_mpesa_callback
-from apps.marketplace.models import Order
+from .mpesa_service import parse_mpesa_callback
+from apps.marketplace.models import Order, OrderItem
 
 logger = logging.getLogger(__name__)
 
@@ -58,6 +63,13 @@ def initiate_stk_push(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
+    # Cancelled (or expired) orders have released their stock
+    if order.status != 'pending':
+        return Response(
+            {'error': f'Order is {order.status} and cannot be paid'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
     # Check if there's already a successful transaction
     if Transaction.objects.filter(order=order, status='success').exists():
         return Response(
@@ -65,37 +77,21 @@ def initiate_stk_push(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    # Initialize M-Pesa service
-    mpesa_service = MPesaService()
-    
     try:
-        # Initiate STK Push
-        result = mpesa_service.initiate_stk_push(
-            phone_number=phone,
-            amount=order.total_amount,
-            account_reference=f'ORDER{order.id}',
-            transaction_desc=f'Payment for order {order.id}'
-        )
-        
-        # Create transaction record
-        transaction = Transaction.objects.create(
-            order=order,
-            checkout_request_id=result['checkout_request_id'],
-            amount=order.total_amount,
-            phone=phone,
-            status='initiated',
-            raw_response=result['raw_response']
-        )
+        # Double taps share one in-flight STK push (see initiation)
+        result = initiation.initiate(order, phone)
         
         return Response({
-            'message': result.get('customer_message', 'STK Push initiated'),
+            'message': result['customer_message'],
             'checkout_request_id': result['checkout_request_id'],
-            'transaction_id': transaction.id,
+            'transaction_id': result['transaction_id'],
             'order_id': order.id
         }, status=status.HTTP_200_OK)
     
+    except initiation.InitiationInProgress:
+        raise
     except Exception as e:
-        logger.error(f'STK Push initiation failed: {str(e)}')
+        events.log('stk.failed', logging.ERROR, order_id=order.id, phone=phone, error=str(e))
         return Response(
             {'error': f'Failed to initiate payment: {str(e)}'},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -104,6 +100,7 @@ def initiate_stk_push(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])  # M-Pesa webhook doesn't use JWT
+@throttle_classes([])  # Callbacks come in bursts from a few Safaricom IPs; never drop them
 @csrf_exempt
 def mpesa_webhook(request):
     """
@@ -111,63 +108,66 @@ def mpesa_webhook(request):
     
     POST /api/payments/mpesa/webhook/
     This endpoint is called by M-Pesa when payment is completed.
+    
+    With MPESA_WEBHOOK_MODE = 'inbox' the callback is stored durably and
+    acknowledged at once; consumers apply it later (see webhooks).
     """
     try:
         data = json.loads(request.body)
-        logger.info(f'M-Pesa webhook received: {data}')
+        
+        if settings.MPESA_WEBHOOK_MODE == 'inbox':
+            event = webhooks.ingest(data)
+            events.log('webhook.queued', event_id=event.id, checkout_request_id=event.checkout_request_id)
+            return Response({'status': 'accepted'}, status=status.HTTP_200_OK)
         
         # Parse callback data
         callback_data = parse_mpesa_callback(data)
         
         checkout_request_id = callback_data.get('checkout_request_id')
         result_code = callback_data.get('result_code')
+        events.log(
+            'webhook.received',
+            checkout_request_id=checkout_request_id,
+            result_code=result_code,
+            result_desc=callback_data.get('result_desc'),
+            amount=callback_data.get('amount'),
+            phone=callback_data.get('phone_number')
+        )
         
         if not checkout_request_id:
-            logger.warning('Webhook missing checkout_request_id')
+            events.log('webhook.invalid', logging.WARNING, reason='missing checkout_request_id')
             return Response({'status': 'error', 'message': 'Missing checkout_request_id'}, 
                           status=status.HTTP_400_BAD_REQUEST)
         
         # Find transaction
         try:
-            transaction = Transaction.objects.get(checkout_request_id=checkout_request_id)
+            transaction = Transaction.objects.only('id', 'order_id').get(checkout_request_id=checkout_request_id)
         except Transaction.DoesNotExist:
-            logger.warning(f'Transaction not found for checkout_request_id: {checkout_request_id}')
+            events.log('webhook.not_found', logging.WARNING, checkout_request_id=checkout_request_id)
             return Response({'status': 'error', 'message': 'Transaction not found'}, 
                           status=status.HTTP_404_NOT_FOUND)
         
-        # Update transaction based on result code
+        # Update transaction based on result code; only an open transaction changes
+        raw_response = callback_data.get('raw_data', {})
         if result_code == 0:
-            # Payment successful
-            transaction.status = 'success'
-            transaction.mpesa_transaction_id = callback_data.get('mpesa_receipt_number')
-            transaction.completed_at = timezone.now()
-            transaction.raw_response = callback_data.get('raw_data', {})
-            
-            # Update order status
-            transaction.order.status = 'paid'
-            transaction.order.save()
-            
-            transaction.save()
-            
-            logger.info(f'Transaction {transaction.id} marked as success')
-            return Response({'status': 'success'}, status=status.HTTP_200_OK)
-        
+            changed = transitions.succeed(transaction, callback_data.get('mpesa_receipt_number'), raw_response)
+            outcome = 'success'
         else:
-            # Payment failed
-            transaction.status = 'failed'
-            transaction.error_message = callback_data.get('result_desc', 'Payment failed')
-            transaction.raw_response = callback_data.get('raw_data', {})
-            transaction.save()
-            
-            logger.info(f'Transaction {transaction.id} marked as failed')
-            return Response({'status': 'failed'}, status=status.HTTP_200_OK)
+            changed = transitions.fail(transaction, callback_data.get('result_desc') or 'Payment failed', raw_response)
+            outcome = 'failed'
+        
+        if not changed:
+            # Redelivered callback, or the reconciler settled it first
+            events.log('webhook.duplicate', transaction_id=transaction.id, checkout_request_id=checkout_request_id)
+            return Response({'status': 'duplicate'}, status=status.HTTP_200_OK)
+        return Response({'status': outcome}, status=status.HTTP_200_OK)
     
     except json.JSONDecodeError:
-        logger.error('Invalid JSON in webhook payload')
+        events.log('webhook.invalid', logging.WARNING, reason='invalid JSON')
         return Response({'status': 'error', 'message': 'Invalid JSON'}, 
                       status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
-        logger.error(f'Webhook processing error: {str(e)}')
+        events.log('webhook.error', logging.ERROR, error=str(e))
         return Response({'status': 'error', 'message': str(e)}, 
                       status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -186,7 +186,6 @@ def simulate_webhook(request):
         "mpesa_receipt_number": "QLXXXXX"
     }
     """
-    from django.conf import settings
     if not settings.DEBUG:
         return Response(
             {'error': 'This endpoint is only available in DEBUG mode'},
@@ -204,7 +203,7 @@ def simulate_webhook(request):
         )
     
     try:
-        transaction = Transaction.objects.get(checkout_request_id=checkout_request_id)
+        transaction = Transaction.objects.only('id', 'order_id').get(checkout_request_id=checkout_request_id)
     except Transaction.DoesNotExist:
         return Response(
             {'error': 'Transaction not found'},
@@ -213,16 +212,10 @@ def simulate_webhook(request):
     
     # Simulate webhook callback
     if result_code == 0:
-        transaction.status = 'success'
-        transaction.mpesa_transaction_id = mpesa_receipt_number
-        transaction.completed_at = timezone.now()
-        transaction.order.status = 'paid'
-        transaction.order.save()
+        transitions.succeed(transaction, mpesa_receipt_number)
     else:
-        transaction.status = 'failed'
-        transaction.error_message = 'Simulated failure'
-    
-    transaction.save()
+        transitions.fail(transaction, 'Simulated failure')
+    transaction.refresh_from_db(fields=['status'])
     
     return Response({
         'message': 'Webhook simulated successfully',
@@ -234,11 +227,116 @@ def simulate_webhook(request):
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def transaction_list(request):
-    """Get list of transactions for the current user's orders."""
-    transactions = Transaction.objects.filter(
-        order__customer=request.user
-    ).select_related('order').order_by('-created_at')
+    """
+    Get the current user's transactions, newest first.
+    
+    GET /api/payments/transactions/?page_size=50&fields=id,status,amount
+    
+    Results are keyset-paginated: follow next (which carries a cursor)
+    for older transactions. fields limits each result to the listed
+    fields; leaving out order also skips loading orders and their items.
+    """
+    fields = None
+    if request.query_params.get('fields'):
+        fields = [name for name in request.query_params['fields'].split(',') if name]
+        unknown = set(fields) - set(TransactionSerializer.Meta.fields)
+        if unknown:
+            return Response(
+                {'error': f"Unknown fields: {', '.join(sorted(unknown))}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+    
+    transactions = Transaction.objects.filter(order__customer=request.user)
+    if fields is None or 'order' in fields:
+        transactions = transactions.select_related('order__customer').prefetch_related(
+            Prefetch(
+                'order__items',
+                queryset=OrderItem.objects.select_related('product__vendor', 'product__category')
+                .prefetch_related('product__images', 'product__ratings')
+            )
+        )
+    if fields is None:
+        # raw_response is never returned and can be large
+        transactions = transactions.defer('raw_response')
+    else:
+        # The cursor needs created_at and id
+        transactions = transactions.only(*{'id', 'created_at', *fields})
+    
+    paginator = KeysetPagination()
+    page = paginator.paginate_queryset(transactions, request)
+    serializer = TransactionSerializer(page, many=True, fields=fields, context={'request': request})
+    return paginator.get_paginated_response(serializer.data)
+
+
+def export_response(request, name, rows, columns):
+    """
+    Stream an export in the format given by ?output= (csv or columns).
+    
+    The query parameter is not called format because DRF uses that one to
+    choose a renderer.
+    """
+    output = request.query_params.get('output', 'csv')
+    if output not in settlement.FORMATS:
+        return Response(
+            {'error': f"output must be one of: {', '.join(settlement.FORMATS)}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    content_type, extension = settlement.FORMATS[output]
+    response = StreamingHttpResponse(settlement.stream(rows, columns, output), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{name}.{extension}"'
+    return response
+
+
+def date_range(request):
+    """
+    start and end query parameters (YYYY-MM-DD), or None where missing.
+    
+    Raises:
+        ValueError: When one is not a valid date
+    """
+    dates = []
+    for name in ('start', 'end'):
+        value = request.query_params.get(name)
+        try:
+            date = parse_date(value) if value else None
+        except ValueError:
+            date = None
+        if value and date is None:
+            raise ValueError(f'{name} must be a date (YYYY-MM-DD)')
+        dates.append(date)
+    return dates
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def settlement_export(request):
+    """
+    Daily per-vendor settlement totals for finance.
     
-    serializer = TransactionSerializer(transactions, many=True)
-    return Response(serializer.data)
+    GET /api/payments/settlements/export/?start=2024-01-01&end=2024-01-31&vendor=3&output=csv
+    """
+    # Checked here: an error inside the stream would cut the file short
+    try:
+        start, end = date_range(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    vendor_id = request.query_params.get('vendor')
+    if vendor_id is not None and not vendor_id.isdigit():
+        return Response({'error': 'vendor must be a vendor id'}, status=status.HTTP_400_BAD_REQUEST)
+    rows = settlement.settlements(start, end, vendor_id=vendor_id)
+    return export_response(request, 'settlements', rows, settlement.SETTLEMENT_COLUMNS)
 
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def ledger_export(request):
+    """
+    Payment ledger entries for finance, without the raw M-Pesa payloads.
+    
+    GET /api/payments/ledger/export/?start=2024-01-01&end=2024-01-31&output=columns
+    """
+    try:
+        start, end = date_range(request)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return export_response(request, 'ledger', settlement.ledger(start, end), settlement.LEDGER_COLUMNS)
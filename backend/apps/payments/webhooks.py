@@ -0,0 +1,180 @@
+"""
+Durable inbox for M-Pesa callbacks.
+
+With MPESA_WEBHOOK_MODE = 'inbox' the webhook only parses the body and
+stores it as a WebhookEvent (one INSERT), then acknowledges Safaricom. A
+slow database therefore delays the acknowledgement by one write at most,
+instead of the transaction lookup and order updates.
+
+Consumers (the run_webhook_consumer command, or the process_webhook_inbox
+task) claim pending events in batches and apply each batch in one
+transaction. Applying is idempotent on checkout_request_id: transitions
+only moves a transaction out of initiated/pending once, so redelivered
+callbacks and replayed events are recorded as duplicates and change nothing.
+"""
+import time
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Transaction, WebhookEvent
+from . import events, transitions
+from .mpesa_service import parse_mpesa_callback
+
+logger = logging.getLogger(__name__)
+
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def ingest(data):
+    """Store a parsed callback body in the inbox."""
+    checkout_request_id = (data.get('Body') or {}).get('stkCallback', {}).get('CheckoutRequestID') or ''
+    return WebhookEvent.objects.create(checkout_request_id=checkout_request_id[:100], payload=data)
+
+
+def claim_batch(limit):
+    """
+    Atomically claim up to limit pending events, oldest first.
+
+    Events left in processing for longer than CLAIM_TIMEOUT (a consumer
+    died) are claimed again.
+
+    Returns:
+        list of WebhookEvents now owned by this caller
+    """
+    now = timezone.now()
+    claimable = WebhookEvent.objects.filter(
+        Q(status='pending') | Q(status='processing', claimed_at__lt=now - CLAIM_TIMEOUT)
+    ).order_by('id')
+    changes = {'status': 'processing', 'claimed_at': now, 'attempts': F('attempts') + 1}
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(claimable.select_for_update(skip_locked=True).values_list('id', flat=True)[:limit])
+            WebhookEvent.objects.filter(id__in=ids).update(**changes)
+    else:
+        ids = [
+            event_id for event_id, status, claimed_at in claimable.values_list('id', 'status', 'claimed_at')[:limit]
+            if WebhookEvent.objects.filter(id=event_id, status=status, claimed_at=claimed_at).update(**changes)
+        ]
+    return list(WebhookEvent.objects.filter(id__in=ids).order_by('id')) if ids else []
+
+
+def apply_event(event, transactions, now):
+    """
+    Apply one callback to its transaction.
+
+    Returns:
+        tuple (outcome, id of an order that is now paid or None)
+    """
+    callback = parse_mpesa_callback(event.payload)
+    checkout_request_id = callback.get('checkout_request_id')
+    if not checkout_request_id:
+        return 'invalid', None
+    txn = transactions.get(checkout_request_id)
+    if txn is None:
+        events.log('webhook.not_found', logging.WARNING, checkout_request_id=checkout_request_id, event_id=event.id)
+        return 'not_found', None
+
+    if callback.get('result_code') == 0:
+        if transitions.succeed(txn, callback.get('mpesa_receipt_number'), event.payload, now=now, pay_order=False):
+            return 'success', txn.order_id
+    elif transitions.fail(txn, callback.get('result_desc') or 'Payment failed', event.payload, now=now):
+        return 'failed', None
+    return 'duplicate', None
+
+
+def apply_batch(batch):
+    """
+    Apply a batch of claimed events in one transaction.
+
+    Returns:
+        dict of outcome -> count
+    """
+    now = timezone.now()
+    checkout_ids = {event.checkout_request_id for event in batch if event.checkout_request_id}
+    with transaction.atomic():
+        transactions = {
+            txn.checkout_request_id: txn
+            for txn in Transaction.objects.filter(checkout_request_id__in=checkout_ids).only(
+                'id', 'order_id', 'checkout_request_id'
+            )
+        }
+        paid_orders = set()
+        for event in batch:
+            event.outcome, order_id = apply_event(event, transactions, now)
+            if order_id:
+                paid_orders.add(order_id)
+            event.status = 'processed'
+            event.processed_at = now
+            event.error = ''
+        transitions.pay_orders(paid_orders, now=now)
+        WebhookEvent.objects.bulk_update(batch, ['status', 'outcome', 'processed_at', 'error'])
+
+    counts = {}
+    for event in batch:
+        counts[event.outcome] = counts.get(event.outcome, 0) + 1
+    return counts
+
+
+def process(batch):
+    """
+    Apply events, falling back to one at a time if the batch fails.
+
+    A bad event is marked failed (see replay) without holding up the rest.
+    """
+    try:
+        return apply_batch(batch)
+    except Exception as e:
+        logger.error(f'Webhook batch of {len(batch)} failed, applying one by one: {str(e)}')
+
+    counts = {}
+    for event in batch:
+        try:
+            result = apply_batch([event])
+        except Exception as e:
+            logger.error(f'Webhook event {event.id} failed: {str(e)}')
+            WebhookEvent.objects.filter(id=event.id).update(status='failed', error=str(e))
+            result = {'error': 1}
+        for outcome, count in result.items():
+            counts[outcome] = counts.get(outcome, 0) + count
+    return counts
+
+
+def consume(batch_size=None, max_batches=None):
+    """
+    Apply pending events until the inbox is empty.
+
+    Returns:
+        dict with the number of batches, events and counts per outcome
+    """
+    batch_size = batch_size or settings.MPESA_WEBHOOK_BATCH_SIZE
+    stats = {'batches': 0, 'events': 0, 'outcomes': {}}
+    started = time.perf_counter()
+    while max_batches is None or stats['batches'] < max_batches:
+        batch = claim_batch(batch_size)
+        if not batch:
+            break
+        for outcome, count in process(batch).items():
+            stats['outcomes'][outcome] = stats['outcomes'].get(outcome, 0) + count
+        stats['batches'] += 1
+        stats['events'] += len(batch)
+    stats['elapsed_seconds'] = round(time.perf_counter() - started, 3)
+    if stats['events']:
+        logger.info(f"Applied {stats['events']} webhook events in {stats['batches']} batches: {stats['outcomes']}")
+    return stats
+
+
+def replay(queryset):
+    """
+    Return events to the inbox to be applied again.
+
+    Safe for any event: applying is idempotent, so an event whose
+    transaction has already settled is recorded as a duplicate.
+
+    Returns:
+        number of events requeued
+    """
+    return queryset.exclude(status='processing').update(status='pending', claimed_at=None, error='', outcome='')
@@ -0,0 +1,177 @@
+"""
+Shared helpers for the benchmark management commands.
+
+Benchmarks run against a throwaway test database and media directory so
+they never touch real data, and write machine-readable JSON reports that
+can be diffed between releases.
+"""
+import os
+import sys
+import json
+import shutil
+import platform
+import resource
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+import django
+from django.db import DatabaseError, connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+
+@contextmanager
+def benchmark_environment(**settings_overrides):
+    """Create a temporary database and MEDIA_ROOT for the duration of a benchmark."""
+    setup_test_environment()
+    original_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    media_root = tempfile.mkdtemp(prefix='digifarm-bench-')
+    try:
+        with override_settings(MEDIA_ROOT=media_root, **settings_overrides):
+            yield
+    finally:
+        connection.creation.destroy_test_db(original_name, verbosity=0)
+        teardown_test_environment()
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    rank = max(int(round(q / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(samples):
+    """
+    Summarise latency samples given in seconds.
+
+    Returns:
+        dict of count, mean, p50, p95, p99 and max in milliseconds
+    """
+    ordered = sorted(samples)
+    to_ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        'count': len(ordered),
+        'mean_ms': to_ms(sum(ordered) / len(ordered)) if ordered else 0.0,
+        'p50_ms': to_ms(percentile(ordered, 50)),
+        'p95_ms': to_ms(percentile(ordered, 95)),
+        'p99_ms': to_ms(percentile(ordered, 99)),
+        'max_ms': to_ms(ordered[-1]) if ordered else 0.0,
+    }
+
+
+@contextmanager
+def track_peak_memory():
+    """
+    Track peak Python heap allocation inside the block.
+
+    Yields a dict that is filled with 'peak_python_kb' and 'max_rss_kb'
+    when the block exits.
+    """
+    usage = {}
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        yield usage
+    finally:
+        usage['peak_python_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        usage['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if not was_tracing:
+            tracemalloc.stop()
+
+
+def table_bytes(table):
+    """
+    Storage used by a table and its indexes.
+
+    Returns:
+        size in bytes, or None when the database backend cannot report it
+    """
+    with connection.cursor() as cursor:
+        try:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+            elif connection.vendor == 'sqlite':
+                cursor.execute(
+                    'SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+                    '(SELECT name FROM sqlite_master WHERE tbl_name = %s)',
+                    [table]
+                )
+            else:
+                return None
+        except DatabaseError:
+            return None
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else None
+
+
+def build_report(name, config, results):
+    """Wrap benchmark results with environment metadata."""
+    return {
+        'benchmark': name,
+        'generated_at': timezone.now().isoformat(),
+        'environment': {
+            'python': sys.version.split()[0],
+            'django': django.get_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'database': connection.vendor,
+        },
+        'config': config,
+        'results': results,
+    }
+
+
+def write_report(report, path=None, stream=None):
+    """Write a report as JSON to a file, or to stream when no path is given."""
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w') as report_file:
+            report_file.write(output + '\n')
+    elif stream is not None:
+        stream.write(output)
+
+
+def compare_reports(baseline, current, key_fields):
+    """
+    Compare numeric metrics of two reports.
+
+    Args:
+        key_fields: Result fields that identify a row (e.g. path, resolution)
+
+    Returns:
+        list of dicts with key, metric, baseline, current and change_pct
+    """
+    def flatten(row, prefix=''):
+        values = {}
+        for field, value in row.items():
+            if isinstance(value, dict):
+                values.update(flatten(value, f'{prefix}{field}.'))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) and field not in key_fields:
+                values[f'{prefix}{field}'] = value
+        return values
+
+    baseline_rows = {tuple(r[k] for k in key_fields): flatten(r) for r in baseline['results']}
+    changes = []
+    for row in current['results']:
+        key = tuple(row[k] for k in key_fields)
+        old = baseline_rows.get(key)
+        if old is None:
+            continue
+        for metric, value in flatten(row).items():
+            if metric not in old:
+                continue
+            change = ((value - old[metric]) / old[metric] * 100) if old[metric] else 0.0
+            changes.append({
+                'key': '/'.join(str(part) for part in key),
+                'metric': metric,
+                'baseline': old[metric],
+                'current': value,
+                'change_pct': round(change, 1),
+            })
+    return changes
@@ -172,6 +172,13 @@ CORS_ALLOWED_ORIGINS = env.list(
 )
 CORS_ALLOW_CREDENTIALS = True
 
+# Cache
+# Shared by every web and Celery process: the M-Pesa access token, STK push
+# locks and diagnosis admission control rely on it being the same everywhere.
+# Tests replace it with a local cache (see digi_farm/test_settings.py).
+REDIS_URL = env('REDIS_URL', default='redis://redis:6379/1')
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': REDIS_URL}}
+
 # Celery Configuration
 CELERY_BROKER_URL = env('CELERY_BROKER_URL', default='redis://redis:6379/0')
 CELERY_RESULT_BACKEND = env('CELERY_RESULT_BACKEND', default='redis://redis:6379/0')
@@ -181,6 +188,84 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 minutes
+CELERY_BEAT_SCHEDULE = {
+    'reap-stuck-diagnoses': {
+        'task': 'apps.diagnosis.tasks.reap_stuck_diagnoses',
+        'schedule': 5 * 60,  # every 5 minutes
+    },
+    'archive-old-crop-images': {
+        'task': 'apps.diagnosis.tasks.archive_old_images',
+        'schedule': 24 * 60 * 60,  # daily
+        # Stop between bundles well before the hard time limit; the next day carries on
+        'kwargs': {'max_seconds': CELERY_TASK_TIME_LIMIT - 5 * 60},
+    },
+    'reconcile-pending-transactions': {
+        'task': 'apps.payments.tasks.reconcile_pending_transactions',
+        'schedule': 5 * 60,  # every 5 minutes
+    },
+    'process-webhook-inbox': {
+        # Fallback for when no run_webhook_consumer is running
+        'task': 'apps.payments.tasks.process_webhook_inbox',
+        'schedule': 30,
+    },
+    'settle-payments': {
+        'task': 'apps.payments.tasks.settle_payments',
+        'schedule': 60 * 60,  # hourly
+    },
+    'release-expired-orders': {
+        'task': 'apps.marketplace.tasks.release_expired_orders',
+        'schedule': 5 * 60,  # every 5 minutes
+    },
+}
+
+# Crop Diagnosis Settings
+DIAGNOSIS_MODE = env('DIAGNOSIS_MODE', default='sync')  # 'sync' (in request) or 'async' (Celery)
+DIAGNOSIS_QUEUE = env('DIAGNOSIS_QUEUE', default='diagnosis')
+MAINTENANCE_QUEUE = env('MAINTENANCE_QUEUE', default='maintenance')
+DIAGNOSIS_RESULT_MAX_WAIT = env.int('DIAGNOSIS_RESULT_MAX_WAIT', default=5)  # seconds; each waiting client holds a worker
+DIAGNOSIS_RESULT_RETRY_AFTER = env.int('DIAGNOSIS_RESULT_RETRY_AFTER', default=2)  # seconds until clients ask again
+CELERY_TASK_ROUTES = {
+    # Diagnosis runs on its own queue so slow inference never delays other tasks
+    'apps.diagnosis.tasks.*': {'queue': DIAGNOSIS_QUEUE},
+    # Long, I/O-bound housekeeping stays off the inference workers
+    'apps.diagnosis.tasks.archive_old_images': {'queue': MAINTENANCE_QUEUE},
+}
+DIAGNOSIS_MODEL_VERSION = env('DIAGNOSIS_MODEL_VERSION', default='v1.0-histogram')
+DIAGNOSIS_CLASSIFIERS = {
+    # model_version -> classifier backend class
+    'v1.0-histogram': 'apps.diagnosis.classifiers.HistogramClassifier',
+    'v1.0-mean-colour': 'apps.diagnosis.classifiers.MeanColourClassifier',
+    'v1.0-cascade': 'apps.diagnosis.classifiers.CascadeClassifier',
+}
+# Calibrated confidence at which the cascade's fast stage answers on its own
+DIAGNOSIS_CASCADE_THRESHOLD = env.float('DIAGNOSIS_CASCADE_THRESHOLD', default=0.9)
+DIAGNOSIS_THUMBNAIL_SIZE = env.int('DIAGNOSIS_THUMBNAIL_SIZE', default=256)  # pixels, longest side
+DIAGNOSIS_MAX_IMAGE_PIXELS = env.int('DIAGNOSIS_MAX_IMAGE_PIXELS', default=40_000_000)
+DIAGNOSIS_CLAIM_TIMEOUT = env.int('DIAGNOSIS_CLAIM_TIMEOUT', default=10)  # minutes before a processing image is reaped
+DIAGNOSIS_BATCH_SIZE = env.int('DIAGNOSIS_BATCH_SIZE', default=32)
+DIAGNOSIS_BATCH_MAX_WAIT = env.float('DIAGNOSIS_BATCH_MAX_WAIT', default=2.0)  # seconds
+DIAGNOSIS_ADMISSION_RATE = env.float('DIAGNOSIS_ADMISSION_RATE', default=30)  # uploads per minute per user
+DIAGNOSIS_ADMISSION_BURST = env.int('DIAGNOSIS_ADMISSION_BURST', default=10)  # uploads accepted back to back
+DIAGNOSIS_ADMISSION_WEIGHTS = {
+    # role -> multiplier for the upload rate, burst and fair queueing share
+    'farmer': 1,
+    'vendor': 1,
+    'admin': 2,
+}
+DIAGNOSIS_MAX_CONCURRENCY = env.int('DIAGNOSIS_MAX_CONCURRENCY', default=4)  # images in inference at once (sync mode)
+DIAGNOSIS_MAX_QUEUE_SECONDS = env.int('DIAGNOSIS_MAX_QUEUE_SECONDS', default=120)  # shed uploads beyond this wait
+DIAGNOSIS_THROUGHPUT_WINDOW = env.int('DIAGNOSIS_THROUGHPUT_WINDOW', default=300)  # seconds of results to measure
+DIAGNOSIS_DEDUP_ENABLED = env.bool('DIAGNOSIS_DEDUP_ENABLED', default=True)
+DIAGNOSIS_DEDUP_MAX_DISTANCE = env.int('DIAGNOSIS_DEDUP_MAX_DISTANCE', default=4)  # bits out of 64
+DIAGNOSIS_DEDUP_WINDOW_HOURS = env.int('DIAGNOSIS_DEDUP_WINDOW_HOURS', default=24)
+DIAGNOSIS_DEDUP_MAX_ENTRIES = env.int('DIAGNOSIS_DEDUP_MAX_ENTRIES', default=10000)
+DIAGNOSIS_PRODUCT_MATCHES = env.int('DIAGNOSIS_PRODUCT_MATCHES', default=3)  # products embedded per result
+DIAGNOSIS_HEATMAP_CELL_DEGREES = env.float('DIAGNOSIS_HEATMAP_CELL_DEGREES', default=0.1)  # about 11 km
+DIAGNOSIS_HEATMAP_MAX_DAYS = env.int('DIAGNOSIS_HEATMAP_MAX_DAYS', default=90)
+DIAGNOSIS_ARCHIVE_AFTER_DAYS = env.int('DIAGNOSIS_ARCHIVE_AFTER_DAYS', default=90)
+DIAGNOSIS_ARCHIVE_WEBP_QUALITY = env.int('DIAGNOSIS_ARCHIVE_WEBP_QUALITY', default=80)
+DIAGNOSIS_ARCHIVE_BUNDLE_MB = env.int('DIAGNOSIS_ARCHIVE_BUNDLE_MB', default=256)
+DIAGNOSIS_ARCHIVE_MAX_MB_PER_SECOND = env.float('DIAGNOSIS_ARCHIVE_MAX_MB_PER_SECOND', default=20)  # 0 = unlimited
 
 # AWS S3 Settings (optional)
 USE_S3 = env.bool('USE_S3', default=False)
@@ -197,6 +282,9 @@ if USE_S3:
     DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
     STATICFILES_STORAGE = 'storages.backends.s3boto3.S3StaticStorage'
 
+# Marketplace Settings
+ORDER_RESERVATION_TTL = env.int('ORDER_RESERVATION_TTL', default=60 * 60)  # seconds an unpaid order holds its stock
+
 # M-Pesa Daraja Settings
 MPESA_CONSUMER_KEY = env('MPESA_CONSUMER_KEY', default='')
 MPESA_CONSUMER_SECRET = env('MPESA_CONSUMER_SECRET', default='')
@@ -204,7 +292,31 @@ MPESA_SHORTCODE = env('MPESA_SHORTCODE', default='')
 MPESA_PASSKEY = env('MPESA_PASSKEY', default='')
 MPESA_ENV = env('MPESA_ENV', default='sandbox')
 MPESA_CALLBACK_URL = env('MPESA_CALLBACK_URL', default='')
-MPESA_LNM_EXPIRY = env('MPESA_LNM_EXPIRY', default='174000')  # 2 minutes in seconds
+MPESA_LNM_EXPIRY = env.int('MPESA_LNM_EXPIRY', default=300)  # seconds before an unanswered STK push is given up
+MPESA_BASE_URL = env('MPESA_BASE_URL', default='')  # overrides the MPESA_ENV URL, e.g. for a local simulator
+MPESA_POOL_SIZE = env.int('MPESA_POOL_SIZE', default=10)  # keep-alive connections to Daraja per process
+MPESA_TOKEN_REFRESH_MARGIN = env.int('MPESA_TOKEN_REFRESH_MARGIN', default=300)  # seconds before token expiry
+MPESA_STK_LOCK_TIMEOUT = env.int('MPESA_STK_LOCK_TIMEOUT', default=65)  # seconds; covers the Daraja timeout and one token retry
+MPESA_STK_COALESCE_WINDOW = env.int('MPESA_STK_COALESCE_WINDOW', default=60)  # seconds repeat requests reuse a push
+MPESA_RECONCILE_CONCURRENCY = env.int('MPESA_RECONCILE_CONCURRENCY', default=8)  # status queries in flight
+MPESA_RECONCILE_RATE = env.float('MPESA_RECONCILE_RATE', default=20)  # status queries per second, all shards; 0 = unlimited
+MPESA_RECONCILE_BATCH_SIZE = env.int('MPESA_RECONCILE_BATCH_SIZE', default=100)  # transactions per write
+MPESA_RECONCILE_SHARDS = env.int('MPESA_RECONCILE_SHARDS', default=1)  # Celery tasks per reconciliation run
+MPESA_RECONCILE_FIRST_CHECK = env.int('MPESA_RECONCILE_FIRST_CHECK', default=120)  # seconds after an STK push before the first status query
+MPESA_RECONCILE_BACKOFF = env.int('MPESA_RECONCILE_BACKOFF', default=60)  # seconds before the first re-check, doubled per attempt
+MPESA_RECONCILE_MAX_BACKOFF = env.int('MPESA_RECONCILE_MAX_BACKOFF', default=3600)  # longest gap between status queries
+MPESA_WEBHOOK_MODE = env('MPESA_WEBHOOK_MODE', default='sync')  # 'sync' (apply in request) or 'inbox' (store and ack)
+MPESA_WEBHOOK_BATCH_SIZE = env.int('MPESA_WEBHOOK_BATCH_SIZE', default=100)  # inbox events applied per transaction
+PAYMENT_LOG_SAMPLE_RATE = env.float('PAYMENT_LOG_SAMPLE_RATE', default=1.0)  # share of routine payment events logged
+PAYMENT_LOG_SAMPLING = {
+    # event -> share logged, overriding PAYMENT_LOG_SAMPLE_RATE; warnings and errors are always logged
+    'webhook.received': env.float('PAYMENT_LOG_WEBHOOK_SAMPLE_RATE', default=0.1),
+    'webhook.queued': env.float('PAYMENT_LOG_WEBHOOK_SAMPLE_RATE', default=0.1),
+    'stk.initiated': env.float('PAYMENT_LOG_STK_SAMPLE_RATE', default=0.1),
+}
+SETTLEMENT_BATCH_SIZE = env.int('SETTLEMENT_BATCH_SIZE', default=1000)  # ledger entries settled per transaction
+SETTLEMENT_LAG = env.int('SETTLEMENT_LAG', default=300)  # seconds; newer ledger entries wait for the next run
+SETTLEMENT_EXPORT_CHUNK_SIZE = env.int('SETTLEMENT_EXPORT_CHUNK_SIZE', default=2000)  # rows read and written at a time
 
 # Email Settings
 EMAIL_BACKEND = env('EMAIL_BACKEND', default='django.core.mail.backends.console.EmailBackend')
@@ -0,0 +1,9 @@
+"""
+Settings for the test suite (see pytest.ini).
+
+Tests run in one process and must not need Redis, so the shared cache is a
+local one here.
+"""
+from .settings import *  # noqa: F401,F403
+
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}